@@ -0,0 +1,147 @@
+# This script measures recall@k (against the flat baseline), latency and size of every FAISS index type over the same vectors. Examples:
+#   python ann_report.py --index-dir index_s1
+#   python ann_report.py --synthetic 200000 --dim 384 --out ann_report.json
+import os
+import sys
+import json
+import time
+import argparse
+from typing import Dict, List, Optional
+
+import numpy as np
+import faiss
+
+from index_versions import active_index_dir
+from mini_rag_index import HNSW_M, IVF_NLIST, PQ_M, PQ_NBITS, index_type_of, new_index, search_params_for
+
+def load_vectors(index_dir: str) -> np.ndarray:
+    """Uses the index's embeddings.npy if there is one, otherwise reconstructs the vectors from a flat or HNSW index."""
+    index_dir = active_index_dir(index_dir)
+    emb_path = os.path.join(index_dir, "embeddings.npy")
+    if os.path.exists(emb_path):
+        return np.load(emb_path, mmap_mode="r").astype("float32")
+    index = faiss.read_index(os.path.join(index_dir, "faiss.index"))
+    try:
+        return index.reconstruct_n(0, index.ntotal)
+    except RuntimeError:
+        sys.exit(f"Can't reconstruct vectors from the index in '{index_dir}'. Build it as 'flat' or provide embeddings.npy.")
+
+def synthetic_vectors(n: int, dim: int, seed: int = 0) -> np.ndarray:
+    """Clustered, normalized random vectors, which behave more like real embeddings than uniform noise does."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, n // 500), dim)).astype("float32")
+    x = centers[rng.integers(0, len(centers), n)] + 0.5 * rng.standard_normal((n, dim)).astype("float32")
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    return x
+
+def time_queries(index, queries: np.ndarray, k: int):
+    # One query per search call, like the web app does, so the latency numbers match what users see.
+    latencies = []
+    ids = np.empty((len(queries), k), dtype="int64")
+    for i in range(len(queries)):
+        t = time.perf_counter()
+        _, row = index.search(queries[i:i + 1], k)
+        latencies.append(time.perf_counter() - t)
+        ids[i] = row[0]
+    return ids, np.array(latencies)
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = [len(set(f[f >= 0]) & set(t[t >= 0])) / max(1, len(t[t >= 0])) for f, t in zip(found, truth)]
+    return float(np.mean(hits))
+
+def sweep(index_type: str) -> List[Dict[str, int]]:
+    if index_type in ("ivf", "ivfpq"):
+        return [{"nprobe": p} for p in (1, 2, 4, 8, 16, 32, 64, 128)]
+    if index_type == "hnsw":
+        return [{"efSearch": ef} for ef in (16, 32, 64, 128, 256)]
+    return [{}]
+
+def run_report(vectors: np.ndarray, n_queries: int, k: int, types: List[str], nlist: int, hnsw_m: int,
+               pq_m: int, pq_nbits: int, seed: int = 0) -> Dict:
+    rng = np.random.default_rng(seed)
+    n_queries = min(n_queries, max(1, len(vectors) // 10))
+    # Held-out queries: they are removed from the indexed set so no query finds itself.
+    q_rows = rng.choice(len(vectors), n_queries, replace=False)
+    mask = np.ones(len(vectors), dtype=bool)
+    mask[q_rows] = False
+    base = np.ascontiguousarray(vectors[mask], dtype="float32")
+    queries = np.ascontiguousarray(vectors[q_rows], dtype="float32")
+    ids = np.arange(len(base), dtype="int64")
+    d = base.shape[1]
+    k = min(k, len(base))
+
+    baseline = faiss.IndexFlatIP(d)
+    baseline.add(base)
+    truth, flat_lat = time_queries(baseline, queries, k)
+
+    rows = []
+    for requested_type in types:
+        t = time.perf_counter()
+        index = new_index(d, base, requested_type, nlist=nlist, hnsw_m=hnsw_m, pq_m=pq_m, pq_nbits=pq_nbits)
+        index.add_with_ids(base, ids)
+        # Small corpora make new_index fall back to flat, and the report should say what was really measured.
+        index_type = index_type_of(index)
+        build_sec = time.perf_counter() - t
+        size_mb = len(faiss.serialize_index(index)) / 1e6
+        space = faiss.ParameterSpace()
+        for params in sweep(index_type):
+            if "nprobe" in params and params["nprobe"] > faiss.extract_index_ivf(index).nlist:
+                continue
+            for name, value in params.items():
+                space.set_index_parameter(index, name, value)
+            found, lat = time_queries(index, queries, k)
+            rows.append({
+                "requested_type": requested_type,
+                "index_type": index_type,
+                "search_params": params,
+                "recall_at_k": round(recall_at_k(found, truth), 4),
+                "mean_ms": round(float(lat.mean()) * 1000, 4),
+                "p95_ms": round(float(np.percentile(lat, 95)) * 1000, 4),
+                "build_sec": round(build_sec, 3),
+                "index_mb": round(size_mb, 3),
+            })
+    return {
+        "n_vectors": int(len(base)), "dim": int(d), "n_queries": int(n_queries), "k": int(k),
+        "flat_baseline": {"mean_ms": round(float(flat_lat.mean()) * 1000, 4), "p95_ms": round(float(np.percentile(flat_lat, 95)) * 1000, 4)},
+        "results": rows,
+    }
+
+def print_report(report: Dict) -> None:
+    print(f"\n{report['n_vectors']} vectors, dim {report['dim']}, {report['n_queries']} held-out queries, recall@{report['k']} vs exact flat search")
+    print(f"Flat baseline: mean {report['flat_baseline']['mean_ms']:.3f} ms, p95 {report['flat_baseline']['p95_ms']:.3f} ms\n")
+    print(f"{'type':<7} {'params':<16} {'recall':>7} {'mean ms':>9} {'p95 ms':>9} {'build s':>8} {'size MB':>8}")
+    for r in report["results"]:
+        params = ",".join(f"{k}={v}" for k, v in r["search_params"].items()) or "-"
+        print(f"{r['index_type']:<7} {params:<16} {r['recall_at_k']:>7.3f} {r['mean_ms']:>9.3f} {r['p95_ms']:>9.3f} {r['build_sec']:>8.2f} {r['index_mb']:>8.2f}")
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Recall@k versus latency report for the FAISS index types used by the RAG agent.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--index-dir", help="Take the vectors of an existing index (embeddings.npy or a flat faiss.index).")
+    source.add_argument("--synthetic", type=int, help="Generate this many synthetic vectors instead.")
+    parser.add_argument("--dim", type=int, default=384, help="Dimension of synthetic vectors (bge-small uses 384).")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=12)
+    parser.add_argument("--types", default="flat,ivf,hnsw,ivfpq")
+    parser.add_argument("--nlist", type=int, default=IVF_NLIST)
+    parser.add_argument("--hnsw-m", type=int, default=HNSW_M)
+    parser.add_argument("--pq-m", type=int, default=PQ_M)
+    parser.add_argument("--pq-nbits", type=int, default=PQ_NBITS)
+    parser.add_argument("--threads", type=int, default=1, help="FAISS threads; the query service runs with 1.")
+    parser.add_argument("--out", help="Also write the report as JSON to this path.")
+    args = parser.parse_args(argv)
+
+    faiss.omp_set_num_threads(args.threads)
+    vectors = load_vectors(args.index_dir) if args.index_dir else synthetic_vectors(args.synthetic, args.dim)
+    types = [t.strip() for t in args.types.split(",") if t.strip()]
+    report = run_report(vectors, args.queries, args.k, types, args.nlist, args.hnsw_m, args.pq_m, args.pq_nbits)
+    print_report(report)
+    print(f"\nTo use a setting, rebuild with RAG_INDEX_TYPE and RAG_IVF_NPROBE / RAG_HNSW_EF_SEARCH, e.g. "
+          f"RAG_INDEX_TYPE=hnsw RAG_HNSW_EF_SEARCH={search_params_for('hnsw')['efSearch']} python build_all_indexes.py")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to '{args.out}'")
+
+if __name__ == "__main__":
+    main()
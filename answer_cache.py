@@ -0,0 +1,202 @@
+# Persistent LRU cache of generated answers, reused for a similar query embedding that retrieved the same chunks (mode, model, index version).
+import os
+import sys
+import json
+import time
+import atexit
+import base64
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from rag_cache import normalize_query
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ANSWER_CACHE = os.environ.get("RAG_ANSWER_CACHE", "1") == "1"
+ANSWER_CACHE_SIZE = int(os.environ.get("RAG_ANSWER_CACHE_SIZE", "1024"))
+# Minimum cosine similarity for two queries to share an answer. Queries without an embedding only match the same normalized text.
+ANSWER_CACHE_MIN_SIM = float(os.environ.get("RAG_ANSWER_CACHE_MIN_SIM", "0.93"))
+ANSWER_CACHE_PATH = os.environ.get("RAG_ANSWER_CACHE_PATH", os.path.join(ROOT_DIR, ".answer_cache", "answers.json"))
+# New entries are written to disk at most this often (and once more at exit), so a burst of answers doesn't rewrite the file each time.
+ANSWER_CACHE_SAVE_SEC = float(os.environ.get("RAG_ANSWER_CACHE_SAVE_SEC", "30"))
+
+def answer_key(mode: str, model: str, index_version: str, chunk_ids: Sequence[int]) -> Tuple[str, str, str, Tuple[int, ...]]:
+    # The part of an entry that must match exactly, with the retrieved chunks compared as a set.
+    return (mode, model, index_version, tuple(sorted(int(c) for c in chunk_ids)))
+
+def _encode_vec(vec: np.ndarray) -> str:
+    return base64.b64encode(np.asarray(vec, dtype="<f4").tobytes()).decode("ascii")
+
+def _decode_vec(text: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(text), dtype="<f4")
+
+class SemanticAnswerCache:
+    """
+    A thread-safe, bounded LRU cache of LLM answers. get() returns the answer of the most similar cached query with the same key,
+    put() stores a new one. Query vectors are kept in a preallocated matrix, so a lookup is one product over at most max_size rows.
+    """
+
+    def __init__(self, path: Optional[str] = ANSWER_CACHE_PATH, max_size: int = ANSWER_CACHE_SIZE, min_sim: float = ANSWER_CACHE_MIN_SIM,
+                 save_interval_sec: float = ANSWER_CACHE_SAVE_SEC):
+        self.path = path
+        self.max_size = max(0, int(max_size))
+        self.min_sim = float(min_sim)
+        self.save_interval_sec = save_interval_sec
+        # entry id -> {"key", "query", "answer", "row"}; row is the entry's row in self._vectors, or None without an embedding.
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._by_text: Dict[Tuple[str, Hashable], int] = {}
+        self._vectors: Optional[np.ndarray] = None
+        self._row_entry: Optional[np.ndarray] = None
+        self._free_rows: List[int] = []
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path:
+            self._load()
+
+    # --- vector rows ---
+    def _ensure_matrix(self, dim: int) -> bool:
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_size, dim), dtype="float32")
+            self._row_entry = np.full(self.max_size, -1, dtype="int64")
+            self._free_rows = list(range(self.max_size - 1, -1, -1))
+        return self._vectors.shape[1] == dim
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        self._by_text.pop((entry["query"], entry["key"]), None)
+        if entry["row"] is not None:
+            self._row_entry[entry["row"]] = -1
+            self._free_rows.append(entry["row"])
+
+    def _add(self, key: Hashable, query: str, q_vec: Optional[np.ndarray], answer: str) -> None:
+        old = self._by_text.get((query, key))
+        if old is not None:
+            self._remove(old)
+        while self._entries and len(self._entries) >= self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        row = None
+        if q_vec is not None and self._ensure_matrix(len(q_vec)):
+            row = self._free_rows.pop()
+            self._vectors[row] = q_vec
+            self._row_entry[row] = self._next_id
+        self._entries[self._next_id] = {"key": key, "query": query, "answer": answer, "row": row}
+        self._by_text[(query, key)] = self._next_id
+        self._next_id += 1
+
+    # --- lookups ---
+    def get(self, key: Hashable, query: str, q_vec: Optional[np.ndarray]) -> Optional[str]:
+        if self.max_size == 0:
+            return None
+        query = normalize_query(query)
+        vec = None if q_vec is None else np.asarray(q_vec, dtype="float32").reshape(-1)
+        with self._lock:
+            entry_id = self._by_text.get((query, key))
+            if entry_id is None and vec is not None and self._vectors is not None and self._vectors.shape[1] == len(vec):
+                # Rows of other keys or free rows are skipped by the key check, there are at most max_size of them.
+                sims = self._vectors @ vec
+                for row in np.argsort(-sims):
+                    if sims[row] < self.min_sim:
+                        break
+                    candidate = int(self._row_entry[row])
+                    if candidate >= 0 and self._entries[candidate]["key"] == key:
+                        entry_id = candidate
+                        break
+            if entry_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            return self._entries[entry_id]["answer"]
+
+    def put(self, key: Hashable, query: str, q_vec: Optional[np.ndarray], answer: str) -> None:
+        if self.max_size == 0 or not answer:
+            return
+        vec = None if q_vec is None else np.asarray(q_vec, dtype="float32").reshape(-1)
+        with self._lock:
+            self._add(key, normalize_query(query), vec, answer)
+            self._dirty = True
+            due = time.monotonic() - self._saved_at >= self.save_interval_sec
+        if due:
+            self.save()
+
+    def clear(self) -> None:
+        with self._lock:
+            for entry_id in list(self._entries):
+                self._remove(entry_id)
+            self._dirty = True
+
+    # --- persistence ---
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ex:
+            print(f"WARNING: Ignoring unreadable answer cache '{self.path}': {ex}", file=sys.stderr)
+            return
+        # Saved oldest first, so adding them in order restores the LRU order. A smaller max_size keeps the most recent ones.
+        for item in data.get("entries", []):
+            mode, model, index_version, chunk_ids = item["key"]
+            vec = _decode_vec(item["vec"]) if item.get("vec") else None
+            self._add(answer_key(mode, model, index_version, chunk_ids), item["query"], vec, item["answer"])
+
+    def save(self) -> None:
+        # Writes all entries to a temp file and renames it over the old one, so a crash never leaves a half-written cache.
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = [{"key": list(e["key"]), "query": e["query"], "answer": e["answer"],
+                        "vec": _encode_vec(self._vectors[e["row"]]) if e["row"] is not None else None}
+                       for e in self._entries.values()]
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"entries": entries}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except OSError as ex:
+            print(f"WARNING: Could not save the answer cache to '{self.path}': {ex}", file=sys.stderr)
+            with self._lock:
+                self._dirty = True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "min_sim": self.min_sim,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": 0,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+_default_cache: Optional[SemanticAnswerCache] = None
+_default_cache_lock = threading.Lock()
+
+def get_answer_cache() -> Optional[SemanticAnswerCache]:
+    """The process-wide answer cache shared by every engine (entries carry their index version), or None when RAG_ANSWER_CACHE=0."""
+    global _default_cache
+    if not ANSWER_CACHE:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = SemanticAnswerCache()
+            atexit.register(_default_cache.save)
+        return _default_cache
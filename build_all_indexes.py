@@ -1,58 +1,96 @@
-# This is the main indexing script for my project. Its job is to create the vector database (the FAISS index) that the Showcase 1 RAG agent needs to answer questions.
-# When this script is run, it processes the .md files in the 'docs' folder and builds the 'index_s1' directory, which the main application uses.
+# This is the main indexing script for my project. Its job is to create the vector databases (the FAISS indexes) that the RAG agent needs to answer questions.
+# When this script is run, it builds every corpus in the registry (or the ones named, e.g. python build_all_indexes.py s1) as a new index version.
 
 import os
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 
-# This dictionary holds the configuration for the RAG agent's index.
-SHOWCASE_1_CONFIG = {
-    "name": "Showcase 1 (RAG Corpus)",
-    "docs_dir": "docs",
-    "index_dir": "index_s1"
-}
+from index_registry import Corpus, load_corpora
+from index_versions import discard_version, publish_version, stage_version, unchanged
 
-def build_index(docs_dir: str, index_dir: str):
+# How many corpora are indexed at the same time. The CPU cores are split between them (see build_index).
+BUILD_WORKERS = int(os.environ.get("RAG_BUILD_WORKERS", "2"))
+
+def build_index(corpus: Corpus, index_workers: int) -> Tuple[bool, str]:
     """
-    This function calls the 'mini_rag_index.py' script
-    to perform the actual indexing of the documents.
+    This function calls the 'mini_rag_index.py' script to perform the actual indexing of one corpus.
+    The script's output is collected and returned with the result, so parallel builds don't interleave their logs.
     """
-    print(f"--- Building the vector index from '{docs_dir}'... ---")
-    
-    # First, I'm making sure the documents folder actually exists and has files.
-    if not os.path.isdir(docs_dir) or not os.listdir(docs_dir):
-        print(f"❌ FATAL ERROR: The document source '{docs_dir}' is missing or empty.")
-        print("   Please make sure the 'docs' folder is present and contains the .md files.")
-        sys.exit(1)
+    docs_dir, index_dir = corpus.docs_dir, corpus.index_dir
+    print(f"--- Building the vector index for '{corpus.name}' from '{docs_dir}'... ---")
+
+    # The build works on a staging copy of the live version (hard links, so it's instant), which is how it stays incremental.
+    version, staging_dir = stage_version(index_dir)
 
     # Setting up environment variables so the other script knows which folders to read from and write to.
     env = os.environ.copy()
     env["RAG_DOCS_DIR"] = docs_dir
-    env["RAG_INDEX_DIR"] = index_dir
-    
+    env["RAG_INDEX_DIR"] = staging_dir
+    # Each build gets its share of the cores unless the worker count was set explicitly.
+    env.setdefault("RAG_INDEX_WORKERS", str(index_workers))
+
     # This is the command that runs the main indexing logic.
     cmd = [sys.executable, "mini_rag_index.py"]
-    
+
     try:
         # Here is running the command and checking for any errors.
-        subprocess.run(cmd, env=env, check=True, text=True)
-        print(f"✅ Success! The index has been built in the '{index_dir}' directory.\n")
+        proc = subprocess.run(cmd, env=env, check=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     except FileNotFoundError:
-        print(f"❌ FATAL ERROR: 'mini_rag_index.py' was not found.")
-        print("   This build script depends on it, so please make sure it's in the same folder.")
-        sys.exit(1)
+        discard_version(staging_dir)
+        return False, "❌ FATAL ERROR: 'mini_rag_index.py' was not found.\n   This build script depends on it, so please make sure it's in the same folder.\n"
     except subprocess.CalledProcessError as e:
-        print(f"❌ FATAL ERROR: The indexing process failed.")
-        print(f"   The error was: {e}")
-        sys.exit(1)
+        # Nothing was published, the live version is untouched.
+        discard_version(staging_dir)
+        return False, (e.stdout or "") + f"❌ FATAL ERROR: The indexing process failed.\n   The error was: {e}\n"
 
-def main():
+    if unchanged(index_dir, staging_dir):
+        discard_version(staging_dir)
+        return True, proc.stdout + f"✅ Nothing changed, '{index_dir}' keeps its current version.\n"
+    # Publishing is two atomic renames: the staging folder becomes the version, then CURRENT points at it.
+    publish_version(index_dir, version, staging_dir)
+    return True, proc.stdout + f"✅ Success! The index has been built in the '{index_dir}' directory (version {version}).\n"
+
+def main(names: List[str]):
     """The main entry point of the script."""
-    print("Starting the build process for the Showcase 1 vector index.")
-    
-    # Calling the main function with the config for Showcase 1.
-    build_index(SHOWCASE_1_CONFIG["docs_dir"], SHOWCASE_1_CONFIG["index_dir"])
-    
+    corpora = load_corpora()
+    unknown = [n for n in names if n not in corpora]
+    if unknown:
+        print(f"❌ FATAL ERROR: Unknown corpus {', '.join(unknown)}. Configured corpora: {', '.join(corpora)}.")
+        sys.exit(1)
+    selected = [corpora[n] for n in names] if names else list(corpora.values())
+
+    # First, I'm making sure the documents folders actually exist and have files. Empty ones are skipped unless asked for by name.
+    todo = []
+    for corpus in selected:
+        if os.path.isdir(corpus.docs_dir) and os.listdir(corpus.docs_dir):
+            todo.append(corpus)
+        elif names:
+            print(f"❌ FATAL ERROR: The document source '{corpus.docs_dir}' is missing or empty.")
+            sys.exit(1)
+        else:
+            print(f"Skipping '{corpus.name}': the document source '{corpus.docs_dir}' is missing or empty.")
+    if not todo:
+        print("❌ FATAL ERROR: None of the configured document sources has any files.")
+        print("   Please make sure the 'docs' folder is present and contains the .md files.")
+        sys.exit(1)
+
+    workers = max(1, min(BUILD_WORKERS, len(todo)))
+    index_workers = max(1, (os.cpu_count() or 1) // workers)
+    print(f"Starting the build process for {len(todo)} index(es), {workers} at a time.")
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for corpus, (ok, log) in zip(todo, pool.map(lambda c: build_index(c, index_workers), todo)):
+            print(f"--- Output for '{corpus.name}' ---")
+            print(log)
+            if not ok:
+                failed.append(corpus.name)
+
+    if failed:
+        print(f"❌ Build failed for: {', '.join(failed)}")
+        sys.exit(1)
     print("Build process finished.")
 
 if __name__ == "__main__":
@@ -62,4 +100,4 @@ if __name__ == "__main__":
         print("Please ensure that file is in the project root directory.")
         sys.exit(1)
     
-    main()
\ No newline at end of file
+    main(sys.argv[1:])
\ No newline at end of file
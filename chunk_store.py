@@ -0,0 +1,238 @@
+# Compact on-disk chunk metadata replacing meta.json: fixed-width binary records plus one UTF-8 text blob, both memory-mapped at query time.
+import os
+import json
+import mmap
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+RECORDS_FILE = "chunks.bin"
+TEXT_FILE = "chunks.txt"
+SOURCES_FILE = "sources.json"
+LEGACY_META_FILE = "meta.json"
+# Filterable attributes of each document (see doc_filters.py), in the same order as SOURCES_FILE. Optional, older stores don't have it.
+ATTRS_FILE = "doc_attrs.json"
+
+# 32 bytes per chunk. Records are sorted by ID so a lookup is a binary search over the memory-mapped "id" column.
+RECORD_DTYPE = np.dtype([
+    ("id", "<i8"),
+    ("source", "<u4"),
+    ("chunk_index", "<u4"),
+    ("start_word", "<u4"),
+    ("text_len", "<u4"),
+    ("text_offset", "<u8"),
+])
+
+def store_files(index_dir: str) -> List[str]:
+    """The files that make up a store, e.g. for fingerprinting an index version."""
+    return [os.path.join(index_dir, name) for name in (RECORDS_FILE, TEXT_FILE, SOURCES_FILE)]
+
+def has_doc_attributes(index_dir: str) -> bool:
+    return os.path.exists(os.path.join(index_dir, ATTRS_FILE))
+
+class ChunkStoreWriter:
+    """
+    Appends chunk metadata dicts ({"id", "source", "chunk_index", "start_word", "text"}) to a new store.
+    Everything is written to temporary files and only moved into place by close(), so readers never see a half-written store.
+    """
+
+    FLUSH_EVERY = 4096
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        self.count = 0
+        self._sources: Dict[str, int] = {}
+        self._attrs: Dict[str, dict] = {}
+        self._pending: List[tuple] = []
+        self._offset = 0
+        self._records_tmp = os.path.join(index_dir, RECORDS_FILE + ".tmp")
+        self._text_tmp = os.path.join(index_dir, TEXT_FILE + ".tmp")
+        self._sources_tmp = os.path.join(index_dir, SOURCES_FILE + ".tmp")
+        self._attrs_tmp = os.path.join(index_dir, ATTRS_FILE + ".tmp")
+        self._records_f = open(self._records_tmp, "wb")
+        self._text_f = open(self._text_tmp, "wb")
+
+    def add(self, md: dict) -> None:
+        data = (md.get("text") or "").encode("utf-8")
+        self._text_f.write(data)
+        source = self._sources.setdefault(md.get("source", "unknown"), len(self._sources))
+        self._pending.append((int(md["id"]), source, int(md.get("chunk_index", 0)), int(md.get("start_word", 0)), len(data), self._offset))
+        self._offset += len(data)
+        self.count += 1
+        if len(self._pending) >= self.FLUSH_EVERY:
+            self._flush()
+
+    def set_doc_attributes(self, source: str, attrs: dict) -> None:
+        self._attrs[source] = attrs
+
+    def _flush(self) -> None:
+        if self._pending:
+            self._records_f.write(np.array(self._pending, dtype=RECORD_DTYPE).tobytes())
+            self._pending.clear()
+
+    def close(self) -> None:
+        self._flush()
+        self._records_f.close()
+        self._text_f.close()
+
+        records = np.fromfile(self._records_tmp, dtype=RECORD_DTYPE)
+        if len(records) > 1 and np.any(np.diff(records["id"]) < 0):
+            records[np.argsort(records["id"], kind="stable")].tofile(self._records_tmp)
+        del records
+
+        names = [None] * len(self._sources)
+        for name, i in self._sources.items():
+            names[i] = name
+        with open(self._sources_tmp, "w", encoding="utf-8") as f:
+            json.dump(names, f, ensure_ascii=False)
+        with open(self._attrs_tmp, "w", encoding="utf-8") as f:
+            json.dump([self._attrs.get(name, {}) for name in names], f, ensure_ascii=False)
+
+        os.replace(self._text_tmp, os.path.join(self.index_dir, TEXT_FILE))
+        os.replace(self._sources_tmp, os.path.join(self.index_dir, SOURCES_FILE))
+        os.replace(self._attrs_tmp, os.path.join(self.index_dir, ATTRS_FILE))
+        # The records file goes last, because its presence is what marks a store as complete.
+        os.replace(self._records_tmp, os.path.join(self.index_dir, RECORDS_FILE))
+
+    def abort(self) -> None:
+        self._records_f.close()
+        self._text_f.close()
+        for p in (self._records_tmp, self._text_tmp, self._sources_tmp, self._attrs_tmp):
+            if os.path.exists(p):
+                os.remove(p)
+
+class ChunkStore(Mapping):
+    """
+    Read-only, memory-mapped view of a store, usable as a mapping from chunk ID to the usual metadata dict.
+    Nothing is decoded until a chunk is asked for.
+    """
+
+    def __init__(self, index_dir: str):
+        records_path, text_path, sources_path = store_files(index_dir)
+        self.index_dir = index_dir
+        self.records = np.memmap(records_path, dtype=RECORD_DTYPE, mode="r") if os.path.getsize(records_path) else np.zeros(0, dtype=RECORD_DTYPE)
+        with open(sources_path, "r", encoding="utf-8") as f:
+            self.sources: List[str] = json.load(f)
+        self.doc_attrs: Optional[List[dict]] = None
+        if has_doc_attributes(index_dir):
+            with open(os.path.join(index_dir, ATTRS_FILE), "r", encoding="utf-8") as f:
+                self.doc_attrs = json.load(f)
+        self._text_f = open(text_path, "rb")
+        self._text = mmap.mmap(self._text_f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(text_path) else b""
+
+    def ids(self) -> np.ndarray:
+        return self.records["id"]
+
+    def doc_ids(self) -> np.ndarray:
+        # Document number of every chunk, in ID order, written at index time. doc_name() turns one back into its source file.
+        return self.records["source"]
+
+    def chunk_indexes(self) -> np.ndarray:
+        return self.records["chunk_index"]
+
+    def doc_name(self, doc_id: int) -> str:
+        return self.sources[int(doc_id)]
+
+    def _row(self, cid: int) -> Optional[int]:
+        ids = self.records["id"]
+        row = int(np.searchsorted(ids, cid))
+        if row < len(ids) and ids[row] == cid:
+            return row
+        return None
+
+    def text_at(self, row: int) -> str:
+        rec = self.records[row]
+        start = int(rec["text_offset"])
+        return self._text[start:start + int(rec["text_len"])].decode("utf-8")
+
+    def record(self, row: int) -> dict:
+        rec = self.records[row]
+        return {
+            "id": int(rec["id"]),
+            "source": self.sources[int(rec["source"])],
+            "chunk_index": int(rec["chunk_index"]),
+            "start_word": int(rec["start_word"]),
+            "text": self.text_at(row),
+        }
+
+    def __getitem__(self, cid) -> dict:
+        row = self._row(int(cid))
+        if row is None:
+            raise KeyError(cid)
+        return self.record(row)
+
+    def __contains__(self, cid) -> bool:
+        return self._row(int(cid)) is not None
+
+    def __iter__(self) -> Iterator[int]:
+        return (int(i) for i in self.records["id"])
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def close(self) -> None:
+        if isinstance(self._text, mmap.mmap):
+            self._text.close()
+        self._text_f.close()
+
+class JsonChunkStore(Mapping):
+    """Adapter that serves an index built before the binary store existed (meta.json) through the same interface."""
+
+    def __init__(self, meta: dict):
+        metadata = meta["metadata"]
+        # Incrementally built indexes store a stable "id" per chunk (the FAISS ID). Older ones use the list position.
+        ids = np.asarray([int(md.get("id", i)) for i, md in enumerate(metadata)], dtype="int64")
+        # meta.json isn't necessarily in ID order, rows are put in ID order here like ChunkStore's records.
+        order = np.argsort(ids, kind="stable")
+        metadata = [metadata[i] for i in order]
+        self._ids = ids[order]
+        self._by_id = dict(zip(self._ids.tolist(), metadata))
+        self._metadata = metadata
+        # The per-chunk columns ChunkStore reads from its records, built once here.
+        numbers: Dict[str, int] = {}
+        self._doc_ids = np.asarray([numbers.setdefault(md.get("source", "unknown"), len(numbers)) for md in metadata], dtype="uint32")
+        self.sources: List[str] = list(numbers)
+        self.doc_attrs: Optional[List[dict]] = None
+        self._chunk_indexes = np.asarray([int(md.get("chunk_id", md.get("chunk_index", 0))) for md in metadata], dtype="uint32")
+
+    def ids(self) -> np.ndarray:
+        return self._ids
+
+    def doc_ids(self) -> np.ndarray:
+        return self._doc_ids
+
+    def chunk_indexes(self) -> np.ndarray:
+        return self._chunk_indexes
+
+    def doc_name(self, doc_id: int) -> str:
+        return self.sources[int(doc_id)]
+
+    def text_at(self, row: int) -> str:
+        md = self._metadata[row]
+        return md.get("text", md.get("chunk_text", ""))
+
+    def __getitem__(self, cid) -> dict:
+        return self._by_id[int(cid)]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._by_id)
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def close(self) -> None:
+        pass
+
+def has_chunk_store(index_dir: str) -> bool:
+    return all(os.path.exists(p) for p in store_files(index_dir))
+
+def open_chunk_store(index_dir: str):
+    """Opens the binary store of an index, falling back to a legacy meta.json. Raises FileNotFoundError if neither exists."""
+    if has_chunk_store(index_dir):
+        return ChunkStore(index_dir)
+    legacy_path = os.path.join(index_dir, LEGACY_META_FILE)
+    if os.path.exists(legacy_path):
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            return JsonChunkStore(json.load(f))
+    raise FileNotFoundError(f"No chunk metadata found in '{index_dir}'.")
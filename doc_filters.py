@@ -0,0 +1,133 @@
+# Document attributes (source, prefix, date, tags) and filter expressions over them, e.g. "source:0?_tech_* tag:ai -tag:draft date>=2024-01".
+import os
+import re
+import fnmatch
+from typing import Any, Dict, List, NamedTuple, Optional
+
+FIELDS = ("source", "prefix", "date", "tag")
+FIELD_ALIASES = {"tags": "tag", "file": "source"}
+TERM_RE = re.compile(r"^(-?)([a-z]+)(>=|<=|!=|:|=|>|<)(.+)$")
+FRONT_MATTER_RE = re.compile(r"\A---\s*\n(.*?)\n---\s*(?:\n|\Z)", re.DOTALL)
+DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+def file_prefix(source: str) -> str:
+    words = [w for w in re.split(r"[_\-\s.]+", os.path.splitext(source)[0].lower()) if w]
+    for w in words:
+        if not w.isdigit():
+            return w
+    return words[0] if words else ""
+
+def _scalar(value: str) -> str:
+    return value.strip().strip("'\"").strip()
+
+def front_matter(raw: str) -> Dict[str, Any]:
+    # A small reader for YAML front matter ("key: value", "key: [a, b]" and "- item" lists), enough for dates and tags.
+    match = FRONT_MATTER_RE.match(raw)
+    if not match:
+        return {}
+    out: Dict[str, Any] = {}
+    key = None
+    for line in match.group(1).splitlines():
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        item = re.match(r"^\s+-\s*(.*)$", line) or re.match(r"^-\s*(.*)$", line)
+        if item and key is not None:
+            if not isinstance(out.get(key), list):
+                out[key] = []
+            out[key].append(_scalar(item.group(1)))
+            continue
+        pair = re.match(r"^([A-Za-z_][\w\-]*)\s*:\s*(.*)$", line)
+        if not pair:
+            continue
+        key, value = pair.group(1).lower(), pair.group(2).strip()
+        if value.startswith("[") and value.endswith("]"):
+            out[key] = [_scalar(v) for v in value[1:-1].split(",") if _scalar(v)]
+        else:
+            out[key] = _scalar(value)
+    return out
+
+def document_attributes(source: str, raw: str) -> Dict[str, Any]:
+    """The filterable attributes of one document, from its file name and (for markdown) its front matter."""
+    meta = front_matter(raw) if os.path.splitext(source)[1].lower() in {".md", ".markdown"} else {}
+    tags = meta.get("tags", meta.get("tag", meta.get("keywords", [])))
+    if isinstance(tags, str):
+        tags = [t for t in re.split(r"[,\s]+", tags) if t]
+    date = meta.get("date") if isinstance(meta.get("date"), str) else None
+    match = DATE_RE.search(date or "") or DATE_RE.search(source)
+    return {
+        "prefix": file_prefix(source),
+        "date": match.group(0) if match else (date or None),
+        "tags": sorted({t.strip().lower().lstrip("#") for t in tags if t.strip()}),
+    }
+
+class FilterTerm(NamedTuple):
+    negate: bool
+    field: str
+    op: str
+    values: tuple
+
+    def matches(self, source: str, attrs: Dict[str, Any]) -> bool:
+        if self.field == "source":
+            name = source.lower()
+            hit = any(fnmatch.fnmatchcase(name, v) for v in self.values)
+        elif self.field == "prefix":
+            hit = (attrs.get("prefix") or file_prefix(source)) in self.values
+        elif self.field == "tag":
+            tags = attrs.get("tags") or []
+            hit = any(v in tags for v in self.values)
+        else:
+            date = attrs.get("date")
+            if not date:
+                hit = False
+            elif self.op in (":", "=", "!="):
+                hit = any(date.startswith(v) for v in self.values)
+            else:
+                # A bound of any precision compares against the same number of characters, so date<=2024 includes all of 2024.
+                bound = self.values[0]
+                d = date[:len(bound)]
+                hit = {">=": d >= bound, "<=": d <= bound, ">": d > bound, "<": d < bound}[self.op]
+        if self.op == "!=":
+            hit = not hit
+        return hit != self.negate
+
+    def __str__(self) -> str:
+        return f"{'-' if self.negate else ''}{self.field}{self.op}{'|'.join(self.values)}"
+
+class DocFilter:
+    """A parsed filter expression. matches(source, attrs) is True for documents that satisfy every term."""
+
+    def __init__(self, terms: List[FilterTerm]):
+        self.terms = terms
+        # Canonical text of the filter, used in cache keys, so "tag:a prefix:b" and "prefix:b  tag:a" share entries.
+        self.key = " ".join(sorted(str(t) for t in terms))
+
+    @property
+    def needs_attributes(self) -> bool:
+        # source and prefix can be answered from the file name alone, dates and tags need the stored attributes.
+        return any(t.field in ("date", "tag") for t in self.terms)
+
+    def matches(self, source: str, attrs: Optional[Dict[str, Any]] = None) -> bool:
+        attrs = attrs or {}
+        return all(t.matches(source, attrs) for t in self.terms)
+
+    def __str__(self) -> str:
+        return self.key
+
+def parse_filter(expr: Optional[str]) -> Optional[DocFilter]:
+    """Parses a filter expression. Returns None for an empty one and raises ValueError for anything it can't read."""
+    terms = []
+    for raw_term in (expr or "").split():
+        match = TERM_RE.match(raw_term.lower())
+        if not match:
+            raise ValueError(f"Can't read filter term '{raw_term}'. Use field:value, e.g. prefix:tech, tag:ai or date>=2024-01.")
+        negate, field, op, value = match.groups()
+        field = FIELD_ALIASES.get(field, field)
+        if field not in FIELDS:
+            raise ValueError(f"Unknown filter field '{field}'. Use one of: {', '.join(FIELDS)}.")
+        if op in (">=", "<=", ">", "<") and field != "date":
+            raise ValueError(f"'{op}' only works with date, not with '{field}'.")
+        values = tuple(v for v in value.split("|") if v)
+        if op in (">=", "<=", ">", "<") and len(values) != 1:
+            raise ValueError(f"A date bound takes a single value, got '{value}'.")
+        terms.append(FilterTerm(negate == "-", field, op, values))
+    return DocFilter(terms) if terms else None
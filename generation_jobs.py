@@ -0,0 +1,162 @@
+# Background jobs for answer generation, kept in SQLite. Identical unfinished jobs are coalesced so they share one LLM call.
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+JOBS_DB = os.environ.get("RAG_JOBS_DB", os.path.join(ROOT_DIR, ".jobs", "jobs.db"))
+# Worker threads running jobs. Each one still takes an LLM slot from the request scheduler, so this only bounds how many wait for one.
+JOB_WORKERS = int(os.environ.get("RAG_JOB_WORKERS", "2"))
+# How long finished jobs (and their results) are kept.
+JOB_TTL_SEC = float(os.environ.get("RAG_JOB_TTL_SEC", "86400"))
+# Upper bound on how long a request may wait for a job to finish before it gets the job's current state instead.
+JOB_MAX_WAIT_SEC = float(os.environ.get("RAG_JOB_MAX_WAIT_SEC", "60"))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+FINISHED = (DONE, FAILED)
+
+class JobManager:
+    """
+    Runs `run(params) -> result dict` for submitted jobs on JOB_WORKERS threads. A result with an "error" key marks the job failed.
+    submit() coalesces jobs with the same key while one is queued or running, get() returns a job's current state and
+    wait() blocks until it is finished or the timeout passes. Workers start on first use, or with start(), which also
+    queues the jobs a previous process left unfinished.
+    """
+
+    def __init__(self, run: Callable[[Dict[str, Any]], Dict[str, Any]], path: str = JOBS_DB, workers: int = JOB_WORKERS,
+                 ttl_sec: float = JOB_TTL_SEC):
+        self._run = run
+        self.path = path
+        self.workers = max(1, workers)
+        self.ttl_sec = ttl_sec
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)
+        self._started = False
+        self._pruned_at = 0.0
+        self._stats = {"submitted": 0, "coalesced": 0, "resumed": 0, "done": 0, "failed": 0}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # One connection shared by all threads, every use is under self._lock.
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, key TEXT NOT NULL, params TEXT NOT NULL, status TEXT NOT NULL, result TEXT, error TEXT,
+            submitters INTEGER NOT NULL DEFAULT 1, created_at REAL NOT NULL, started_at REAL, finished_at REAL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_key_status ON jobs (key, status)")
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            # A job that was running when the last process stopped never finished, so it runs again from the start.
+            rows = self._db.execute("SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING)).fetchall()
+            self._db.execute("UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?", (QUEUED, RUNNING))
+            self._stats["resumed"] += len(rows)
+        if rows:
+            print(f"Resuming {len(rows)} unfinished generation job(s).")
+        for (job_id,) in rows:
+            self._queue.put(job_id)
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"generation-job-{i}", daemon=True).start()
+
+    def submit(self, key: str, params: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        """Returns (job, coalesced). coalesced is True when an identical unfinished job was found and returned instead."""
+        self.start()
+        self._prune()
+        now = time.time()
+        with self._lock:
+            self._stats["submitted"] += 1
+            row = self._db.execute("SELECT id FROM jobs WHERE key = ? AND status IN (?, ?) ORDER BY created_at LIMIT 1",
+                                   (key, QUEUED, RUNNING)).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE jobs SET submitters = submitters + 1 WHERE id = ?", (row[0],))
+                self._stats["coalesced"] += 1
+                return self._get(row[0]), True
+            job_id = uuid.uuid4().hex
+            self._db.execute("INSERT INTO jobs (id, key, params, status, created_at) VALUES (?, ?, ?, ?, ?)",
+                             (job_id, key, json.dumps(params, ensure_ascii=False), QUEUED, now))
+            job = self._get(job_id)
+        self._queue.put(job_id)
+        return job, False
+
+    def _get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._db.execute("SELECT id, params, status, result, error, submitters, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+                               (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {"job_id": row[0], "params": json.loads(row[1]), "status": row[2], "result": json.loads(row[3]) if row[3] else None,
+                "error": row[4], "submitters": row[5], "created_at": row[6], "started_at": row[7], "finished_at": row[8]}
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        self.start()
+        with self._lock:
+            return self._get(job_id)
+
+    def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        # Returns the job once it is finished, or its current state when the timeout passes first.
+        self.start()
+        deadline = time.monotonic() + max(0.0, min(timeout, JOB_MAX_WAIT_SEC))
+        with self._finished:
+            while True:
+                job = self._get(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job["status"] in FINISHED or remaining <= 0:
+                    return job
+                self._finished.wait(remaining)
+
+    def _worker(self) -> None:
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                job = self._get(job_id)
+                if job is None or job["status"] != QUEUED:
+                    continue
+                self._db.execute("UPDATE jobs SET status = ?, started_at = ? WHERE id = ?", (RUNNING, time.time(), job_id))
+            try:
+                result = self._run(job["params"])
+                error = result.get("error")
+            except Exception as ex:
+                print(f"Generation job {job_id} failed: {ex}", file=sys.stderr)
+                result, error = None, str(ex)
+            status = FAILED if error else DONE
+            with self._finished:
+                self._db.execute("UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                                 (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, time.time(), job_id))
+                self._stats[status] += 1
+                self._finished.notify_all()
+
+    def _prune(self) -> None:
+        # Drops finished jobs older than the TTL, at most once a minute.
+        now = time.time()
+        with self._lock:
+            if now - self._pruned_at < 60:
+                return
+            self._pruned_at = now
+            self._db.execute("DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?", (DONE, FAILED, now - self.ttl_sec))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = dict(self._stats)
+            out["jobs"] = {status: count for status, count in self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")}
+            out["queue_depth"] = self._queue.qsize()
+            out["workers"] = self.workers
+            return out
+
+    def collect(self):
+        # Metric families for rag_metrics.REGISTRY.add_collector.
+        st = self.stats()
+        return [
+            ("rag_jobs", "gauge", "Generation jobs by status.", [({"status": s}, st["jobs"].get(s, 0)) for s in (QUEUED, RUNNING, DONE, FAILED)]),
+            ("rag_jobs_submitted_total", "counter", "Generation jobs submitted, including coalesced ones.", [({}, st["submitted"])]),
+            ("rag_jobs_coalesced_total", "counter", "Submits that joined an identical unfinished job.", [({}, st["coalesced"])]),
+            ("rag_jobs_finished_total", "counter", "Generation jobs finished.", [({"status": DONE}, st["done"]), ({"status": FAILED}, st["failed"])]),
+        ]
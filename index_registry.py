@@ -0,0 +1,240 @@
+# Registry of the corpora this project serves (corpora.json or the defaults below) and the per-process cache of their loaded RAG engines.
+import os
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from index_versions import current_version
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# JSON object of {"name": {"docs_dir": ..., "index_dir": ..., "title": ...}}. Relative paths are taken from the project root.
+CORPORA_FILE = os.environ.get("RAG_CORPORA_FILE", os.path.join(ROOT_DIR, "corpora.json"))
+# Upper bound on the memory held by loaded indexes. The least recently used corpus is unloaded when a new one would exceed it.
+INDEX_MEMORY_BUDGET_MB = float(os.environ.get("RAG_INDEX_MEMORY_BUDGET_MB", "2048"))
+# The corpus used when a request doesn't name one.
+DEFAULT_CORPUS = os.environ.get("RAG_DEFAULT_CORPUS", "s1")
+# How often a loaded corpus checks for a newer index version, and how many recent queries warm up the new engine.
+INDEX_CHECK_SEC = float(os.environ.get("RAG_INDEX_CHECK_SEC", "2"))
+INDEX_WARMUP_QUERIES = int(os.environ.get("RAG_INDEX_WARMUP_QUERIES", "16"))
+
+# Used when there is no corpora.json, matching the folders this project has always used.
+DEFAULT_CORPORA = {
+    "s1": {"title": "Showcase 1 (RAG Corpus)", "docs_dir": "docs", "index_dir": "index_s1"},
+    "s2": {"title": "Database docs", "docs_dir": "docs_db", "index_dir": "index_s2"},
+}
+
+class Corpus(NamedTuple):
+    name: str
+    title: str
+    docs_dir: str
+    index_dir: str
+
+def _resolve(path: str) -> str:
+    return path if os.path.isabs(path) else os.path.join(ROOT_DIR, path)
+
+def load_corpora(path: str = CORPORA_FILE) -> Dict[str, Corpus]:
+    """Reads the configured corpora, in file order. Falls back to DEFAULT_CORPORA when the file doesn't exist."""
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    else:
+        config = DEFAULT_CORPORA
+    corpora = {}
+    for name, entry in config.items():
+        if "docs_dir" not in entry or "index_dir" not in entry:
+            raise ValueError(f"Corpus '{name}' in '{path}' needs both 'docs_dir' and 'index_dir'.")
+        corpora[name] = Corpus(name, entry.get("title", name), entry["docs_dir"], entry["index_dir"])
+    return corpora
+
+def corpus_for_docs_dir(docs_dir: str, corpora: Optional[Dict[str, Corpus]] = None) -> Optional[Corpus]:
+    corpora = load_corpora() if corpora is None else corpora
+    target = os.path.normpath(_resolve(docs_dir))
+    for corpus in corpora.values():
+        if os.path.normpath(_resolve(corpus.docs_dir)) == target:
+            return corpus
+    return None
+
+def index_dir_for(docs_dir: str) -> str:
+    # The index folder of a docs folder. Unknown folders get the Showcase 1 index, as before the registry existed.
+    corpus = corpus_for_docs_dir(docs_dir)
+    return corpus.index_dir if corpus else "index_s1"
+
+def _default_engine_factory(corpus: Corpus, registry: "IndexRegistry"):
+    from mini_rag_answer import EMBED_MODEL, RagEngine
+    return RagEngine(docs_dir=_resolve(corpus.docs_dir), index_dir=_resolve(corpus.index_dir), embedder=registry.embedder(EMBED_MODEL))
+
+def _default_embedder_factory(model_name: str):
+    from query_encoder import load_query_encoder
+    return load_query_encoder(model_name)
+
+class IndexRegistry:
+    """
+    Serves many named corpora from one process. get(name) returns the corpus's RagEngine, loading it on first use.
+    Loading one corpus doesn't block requests for the others, and concurrent first requests for the same corpus load it once.
+    The embedding model is shared by all engines that use the same model, so only index data counts against the budget.
+    An evicted engine is only dropped from the registry, requests still holding it finish normally.
+    The same goes for hot swaps: a newly published version is loaded and warmed up next to the old engine, which keeps serving
+    until the new one replaces it in a single assignment. Queries already running finish on the engine they started with.
+    """
+
+    def __init__(self, corpora: Optional[Dict[str, Corpus]] = None, memory_budget_mb: float = INDEX_MEMORY_BUDGET_MB,
+                 engine_factory: Callable[[Corpus, "IndexRegistry"], Any] = _default_engine_factory,
+                 embedder_factory: Callable[[str], Any] = _default_embedder_factory):
+        self.corpora = load_corpora() if corpora is None else corpora
+        self.memory_budget_bytes = int(memory_budget_mb * 1024 * 1024)
+        self._engine_factory = engine_factory
+        self._embedder_factory = embedder_factory
+        self._engines: "OrderedDict[str, Any]" = OrderedDict()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._embedders: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._embedder_lock = threading.Lock()
+        self._checked_at: Dict[str, float] = {}
+        self._swapping: Dict[str, str] = {}
+        self._failed_versions: Dict[str, str] = {}
+        self._stats = {"hits": 0, "loads": 0, "load_failures": 0, "evictions": 0, "load_sec_total": 0.0, "swaps": 0, "swap_failures": 0}
+
+    def names(self) -> List[str]:
+        return list(self.corpora)
+
+    def corpus(self, name: Optional[str] = None) -> Corpus:
+        name = name or DEFAULT_CORPUS
+        if name not in self.corpora:
+            raise KeyError(f"Unknown corpus '{name}'. Configured corpora: {', '.join(self.corpora) or 'none'}.")
+        return self.corpora[name]
+
+    def embedder(self, model_name: str):
+        with self._embedder_lock:
+            model = self._embedders.get(model_name)
+            if model is None:
+                model = self._embedder_factory(model_name)
+                self._embedders[model_name] = model
+            return model
+
+    def get(self, name: Optional[str] = None):
+        corpus = self.corpus(name)
+        with self._lock:
+            engine = self._engines.get(corpus.name)
+            if engine is not None:
+                self._engines.move_to_end(corpus.name)
+                self._stats["hits"] += 1
+        if engine is not None:
+            self._check_version(corpus, engine)
+            return engine
+        with self._lock:
+            load_lock = self._load_locks.setdefault(corpus.name, threading.Lock())
+        with load_lock:
+            # Another request may have finished loading it while this one waited.
+            with self._lock:
+                engine = self._engines.get(corpus.name)
+                if engine is not None:
+                    self._engines.move_to_end(corpus.name)
+                    self._stats["hits"] += 1
+                    return engine
+            print(f"Loading RAG engine for corpus '{corpus.name}' from '{corpus.index_dir}'")
+            t = time.perf_counter()
+            try:
+                engine = self._engine_factory(corpus, self)
+            except Exception:
+                with self._lock:
+                    self._stats["load_failures"] += 1
+                raise
+            with self._lock:
+                self._stats["loads"] += 1
+                self._stats["load_sec_total"] += time.perf_counter() - t
+                self._engines[corpus.name] = engine
+                self._evict_over_budget(keep=corpus.name)
+            return engine
+
+    def _check_version(self, corpus: Corpus, engine) -> None:
+        # At most every INDEX_CHECK_SEC per corpus, a single small file read. A swap runs on its own thread, so no request waits for it.
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at.get(corpus.name, 0.0) < INDEX_CHECK_SEC or corpus.name in self._swapping:
+                return
+            self._checked_at[corpus.name] = now
+        version = current_version(_resolve(corpus.index_dir))
+        if version is None or version == engine.build_version or version == self._failed_versions.get(corpus.name):
+            return
+        with self._lock:
+            if corpus.name in self._swapping:
+                return
+            self._swapping[corpus.name] = version
+        threading.Thread(target=self._swap, args=(corpus, engine, version), name=f"index-swap-{corpus.name}", daemon=True).start()
+
+    def _swap(self, corpus: Corpus, old_engine, version: str) -> None:
+        print(f"Index version '{version}' published for corpus '{corpus.name}', loading it next to the running one.")
+        t = time.perf_counter()
+        try:
+            engine = self._engine_factory(corpus, self)
+            warmup = [key[0] for key in old_engine.retrieval_cache.recent_keys(INDEX_WARMUP_QUERIES)]
+            engine.warm_up(warmup)
+        except Exception as ex:
+            # The old engine keeps serving, and this version isn't tried again until a newer one is published.
+            print(f"WARNING: Could not load index version '{version}' for corpus '{corpus.name}': {ex}", file=sys.stderr)
+            with self._lock:
+                self._failed_versions[corpus.name] = version
+                self._stats["swap_failures"] += 1
+                self._swapping.pop(corpus.name, None)
+            return
+        with self._lock:
+            self._swapping.pop(corpus.name, None)
+            # If the corpus was evicted meanwhile, it stays unloaded and the next request loads the new version anyway.
+            if self._engines.get(corpus.name) is old_engine:
+                self._engines[corpus.name] = engine
+                self._stats["swaps"] += 1
+                self._stats["load_sec_total"] += time.perf_counter() - t
+                self._evict_over_budget(keep=corpus.name)
+        print(f"Corpus '{corpus.name}' now serves index version '{engine.build_version}' (warmed up with {len(warmup)} queries).")
+
+    def _evict_over_budget(self, keep: str) -> None:
+        # Sizes are measured again each time, an engine grows when its numpy fallback maps the embeddings.
+        total = sum(e.memory_bytes() for e in self._engines.values())
+        for name in list(self._engines):
+            if total <= self.memory_budget_bytes:
+                break
+            if name == keep:
+                continue
+            total -= self._engines.pop(name).memory_bytes()
+            self._stats["evictions"] += 1
+            print(f"Unloaded RAG engine for corpus '{name}' to stay within the index memory budget.", file=sys.stderr)
+
+    def evict(self, name: str) -> bool:
+        with self._lock:
+            return self._engines.pop(name, None) is not None
+
+    def loaded(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._engines)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = dict(self._stats)
+            out["load_sec_total"] = round(out["load_sec_total"], 3)
+            out.update({
+                "corpora": list(self.corpora), "loaded": list(self._engines),
+                "memory_bytes": {name: e.memory_bytes() for name, e in self._engines.items()},
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "versions": {name: e.build_version for name, e in self._engines.items()},
+                "swapping": dict(self._swapping),
+                "embedders": list(self._embedders),
+            })
+            return out
+
+    def collect(self):
+        # Metric families for rag_metrics.REGISTRY.add_collector.
+        st = self.stats()
+        return [
+            ("rag_index_loaded", "gauge", "Corpora whose index is currently loaded.", [({}, len(st["loaded"]))]),
+            ("rag_index_memory_bytes", "gauge", "Estimated memory held by each loaded index.", [({"corpus": n}, b) for n, b in st["memory_bytes"].items()]),
+            ("rag_index_memory_budget_bytes", "gauge", "Memory budget for loaded indexes.", [({}, st["memory_budget_bytes"])]),
+            ("rag_index_loads_total", "counter", "Index loads, including reloads after eviction.", [({}, st["loads"])]),
+            ("rag_index_load_failures_total", "counter", "Index loads that failed.", [({}, st["load_failures"])]),
+            ("rag_index_evictions_total", "counter", "Indexes unloaded to stay within the memory budget.", [({}, st["evictions"])]),
+            ("rag_index_swaps_total", "counter", "Newly published index versions swapped in while serving.", [({}, st["swaps"])]),
+            ("rag_index_swap_failures_total", "counter", "Published index versions that failed to load.", [({}, st["swap_failures"])]),
+        ]
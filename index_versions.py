@@ -0,0 +1,96 @@
+# Versioned index folders (index_s1/CURRENT names the live one of index_s1/versions/<version>/), so an index can be rebuilt while served.
+import os
+import time
+import shutil
+from typing import Iterator, List, Optional, Tuple
+
+CURRENT_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+STAGING_PREFIX = ".staging-"
+# Published versions kept on disk. The previous one stays, so a server that hasn't swapped yet can still open its files.
+KEEP_VERSIONS = int(os.environ.get("RAG_INDEX_KEEP_VERSIONS", "2"))
+
+def is_versioned(index_root: str) -> bool:
+    return os.path.exists(os.path.join(index_root, CURRENT_FILE))
+
+def current_version(index_root: str) -> Optional[str]:
+    """The live version of a versioned index folder, or None for a plain (unversioned) one."""
+    try:
+        with open(os.path.join(index_root, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def resolve_index_dir(index_root: str) -> Tuple[Optional[str], str]:
+    # (live version, folder that holds its files). For a plain index folder that is (None, the folder itself).
+    version = current_version(index_root)
+    return version, (os.path.join(index_root, VERSIONS_DIR, version) if version else index_root)
+
+def active_index_dir(index_root: str) -> str:
+    return resolve_index_dir(index_root)[1]
+
+def list_versions(index_root: str) -> List[str]:
+    versions_dir = os.path.join(index_root, VERSIONS_DIR)
+    if not os.path.isdir(versions_dir):
+        return []
+    return sorted(n for n in os.listdir(versions_dir) if not n.startswith(".") and os.path.isdir(os.path.join(versions_dir, n)))
+
+def _index_files(folder: str) -> Iterator[str]:
+    # The regular files of a build, without the versioning bookkeeping and leftover temp files.
+    if not os.path.isdir(folder):
+        return
+    for name in sorted(os.listdir(folder)):
+        if name == CURRENT_FILE or name.endswith((".tmp", ".new")) or ".tmp." in name:
+            continue
+        if os.path.isfile(os.path.join(folder, name)):
+            yield name
+
+def stage_version(index_root: str) -> Tuple[str, str]:
+    """
+    Creates the staging folder for a new version and returns (version, staging folder).
+    The staging folder starts out with hard links to the live version's files, so an incremental build finds its previous state there.
+    This is safe because the indexer never modifies a file in place, it always writes a temp file and renames it over the old one,
+    which replaces the link and leaves the live version's file untouched. Where hard links aren't possible the files are copied.
+    """
+    version = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+    staging = os.path.join(index_root, VERSIONS_DIR, STAGING_PREFIX + version)
+    os.makedirs(staging)
+    source = active_index_dir(index_root)
+    for name in _index_files(source):
+        src, dst = os.path.join(source, name), os.path.join(staging, name)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+    return version, staging
+
+def unchanged(index_root: str, staging: str) -> bool:
+    # True when the build left every linked file alone, i.e. the staged version is the live one.
+    source = active_index_dir(index_root)
+    names = list(_index_files(staging))
+    if names != list(_index_files(source)):
+        return False
+    return all(os.path.samefile(os.path.join(source, n), os.path.join(staging, n)) for n in names)
+
+def publish_version(index_root: str, version: str, staging: str) -> str:
+    """Makes a staged build the live version. Both steps are atomic renames, so readers see either the old version or the new one."""
+    final = os.path.join(index_root, VERSIONS_DIR, version)
+    os.replace(staging, final)
+    tmp = os.path.join(index_root, CURRENT_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(index_root, CURRENT_FILE))
+    prune_versions(index_root)
+    return final
+
+def discard_version(staging: str) -> None:
+    shutil.rmtree(staging, ignore_errors=True)
+
+def prune_versions(index_root: str, keep: int = KEEP_VERSIONS) -> None:
+    # Deletes the oldest versions beyond `keep`, never the live one. Engines on a deleted version keep the files they opened at load.
+    live = current_version(index_root)
+    old = [v for v in list_versions(index_root) if v != live]
+    for version in old[:max(0, len(old) - max(0, keep - 1))]:
+        shutil.rmtree(os.path.join(index_root, VERSIONS_DIR, version), ignore_errors=True)
@@ -0,0 +1,175 @@
+# Inverted index with BM25 statistics, built next to the FAISS index, for the lexical check, hybrid fusion and exact-term queries.
+import os
+import re
+import json
+import zlib
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+LEXICON_FILE = "lexicon.json"
+POSTING_IDS_FILE = "postings_ids.npy"
+POSTING_TF_FILE = "postings_tf.npy"
+LENGTHS_FILE = "chunk_lengths.npy"
+
+BM25_K1 = float(os.environ.get("RAG_BM25_K1", "1.2"))
+BM25_B = float(os.environ.get("RAG_BM25_B", "0.75"))
+RRF_K = int(os.environ.get("RAG_RRF_K", "60"))
+
+# The same token rule the query side has always used for its lexical sanity check.
+_token_re = re.compile(r"[a-z0-9]{3,}")
+
+def tokenize(text: str) -> List[str]:
+    return _token_re.findall((text or "").lower())
+
+def lexical_files(index_dir: str) -> List[str]:
+    return [os.path.join(index_dir, name) for name in (LEXICON_FILE, POSTING_IDS_FILE, POSTING_TF_FILE, LENGTHS_FILE)]
+
+def ids_checksum(chunk_ids) -> int:
+    return zlib.crc32(np.ascontiguousarray(chunk_ids, dtype="int64").tobytes())
+
+def build_lexical_index(index_dir: str, store) -> int:
+    """
+    Builds the inverted index from a chunk store (anything with ids() and record(row)). Postings are collected as flat
+    (term, chunk, tf) arrays and sorted once, instead of as one Python list per term. The source file name is indexed
+    with every chunk, so a query naming a document matches it. Returns the vocabulary size.
+    """
+    ids = np.asarray(store.ids(), dtype="int64")
+    # The old lexicon goes before any array is replaced, so an interrupted build leaves no lexical index instead of a mixed one.
+    lexicon_path = os.path.join(index_dir, LEXICON_FILE)
+    if os.path.exists(lexicon_path):
+        os.remove(lexicon_path)
+    vocab: Dict[str, int] = {}
+    term_buf, chunk_buf, tf_buf = array("i"), array("q"), array("H")
+    lengths = np.zeros(len(ids), dtype="int32")
+    for row in range(len(ids)):
+        md = store.record(row) if hasattr(store, "record") else store[int(ids[row])]
+        tokens = tokenize(f"{md.get('source', '')} {md.get('text', '')}")
+        lengths[row] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            term_buf.append(vocab.setdefault(term, len(vocab)))
+            chunk_buf.append(int(ids[row]))
+            tf_buf.append(min(tf, 65535))
+
+    terms = np.frombuffer(term_buf, dtype="int32") if term_buf else np.zeros(0, dtype="int32")
+    # Stable sort: within a term, postings stay in chunk-ID order because rows were visited in ascending ID order.
+    order = np.argsort(terms, kind="stable")
+    df = np.bincount(terms, minlength=len(vocab))
+    offsets = np.concatenate([[0], np.cumsum(df)[:-1]]) if len(vocab) else np.zeros(0, dtype="int64")
+
+    _save_npy(os.path.join(index_dir, POSTING_IDS_FILE), np.frombuffer(chunk_buf, dtype="int64")[order] if chunk_buf else np.zeros(0, dtype="int64"))
+    _save_npy(os.path.join(index_dir, POSTING_TF_FILE), np.frombuffer(tf_buf, dtype="uint16")[order] if tf_buf else np.zeros(0, dtype="uint16"))
+    _save_npy(os.path.join(index_dir, LENGTHS_FILE), lengths)
+    # n_postings and ids_crc tie the lexicon to the arrays and the chunk store it was built with (see LexicalIndex).
+    lexicon = {
+        "n_chunks": int(len(ids)),
+        "n_postings": int(len(terms)),
+        "ids_crc": ids_checksum(ids),
+        "avgdl": float(lengths.mean()) if len(lengths) else 0.0,
+        "terms": {term: [int(offsets[tid]), int(df[tid])] for term, tid in vocab.items()},
+    }
+    tmp_path = lexicon_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(lexicon, f, ensure_ascii=False)
+    os.replace(tmp_path, lexicon_path)
+    return len(vocab)
+
+def _save_npy(path: str, arr: np.ndarray) -> None:
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, arr)
+    os.replace(tmp_path, path)
+
+def has_lexical_index(index_dir: str) -> bool:
+    return all(os.path.exists(p) for p in lexical_files(index_dir))
+
+class LexicalIndex:
+    """
+    Read side of the inverted index. The lexicon is a dict lookup and the posting arrays are memory-mapped,
+    so a term's postings are one slice. `chunk_ids` must be the chunk store's (sorted) IDs, which chunk_lengths.npy follows.
+    Raises ValueError if the files don't belong together or were built from a different store.
+    """
+
+    def __init__(self, index_dir: str, chunk_ids: np.ndarray):
+        lexicon_path, ids_path, tf_path, lengths_path = lexical_files(index_dir)
+        with open(lexicon_path, "r", encoding="utf-8") as f:
+            lexicon = json.load(f)
+        self.terms: Dict[str, List[int]] = lexicon["terms"]
+        self.n_chunks = int(lexicon["n_chunks"])
+        self.avgdl = float(lexicon["avgdl"]) or 1.0
+        self.posting_ids = np.load(ids_path, mmap_mode="r")
+        self.posting_tf = np.load(tf_path, mmap_mode="r")
+        self.lengths = np.load(lengths_path, mmap_mode="r")
+        self.chunk_ids = chunk_ids
+        # Lexicons written before n_postings/ids_crc existed only get the length checks.
+        n_postings = lexicon.get("n_postings", len(self.posting_ids))
+        if self.n_chunks != len(chunk_ids) or len(self.lengths) != self.n_chunks \
+                or len(self.posting_ids) != n_postings or len(self.posting_tf) != n_postings \
+                or lexicon.get("ids_crc", ids_checksum(chunk_ids)) != ids_checksum(chunk_ids):
+            raise ValueError(f"lexical index in '{index_dir}' doesn't match its chunk store")
+
+    def df(self, term: str) -> int:
+        entry = self.terms.get(term)
+        return entry[1] if entry else 0
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        entry = self.terms.get(term)
+        if not entry:
+            return np.zeros(0, dtype="int64"), np.zeros(0, dtype="uint16")
+        start, df = entry
+        return self.posting_ids[start:start + df], self.posting_tf[start:start + df]
+
+    def contains(self, term: str, chunk_id: int) -> bool:
+        ids, _ = self.postings(term)
+        pos = int(np.searchsorted(ids, chunk_id))
+        return pos < len(ids) and int(ids[pos]) == chunk_id
+
+    def has_any(self, tokens: Iterable[str], chunk_ids: Iterable[int]) -> bool:
+        """True if any of the chunks mentions any of the tokens (in its text or its source file name)."""
+        chunk_ids = list(chunk_ids)
+        return any(self.contains(t, int(cid)) for t in tokens for cid in chunk_ids)
+
+    def idf(self, term: str) -> float:
+        df = self.df(term)
+        return float(np.log(1.0 + (self.n_chunks - df + 0.5) / (df + 0.5)))
+
+    def bm25(self, tokens: Sequence[str], k: int, require_all: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k chunk IDs and BM25 scores for the query tokens. With require_all, only chunks containing every token qualify."""
+        tokens = [t for t in dict.fromkeys(tokens) if t in self.terms]
+        if not tokens or k <= 0:
+            return np.zeros(0, dtype="int64"), np.zeros(0, dtype="float32")
+        all_ids, all_scores = [], []
+        for t in tokens:
+            ids, tf = self.postings(t)
+            idf = self.idf(t)
+            dl = self.lengths[np.searchsorted(self.chunk_ids, ids)].astype("float32")
+            tf = tf.astype("float32")
+            all_ids.append(np.asarray(ids))
+            all_scores.append(idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / self.avgdl)))
+        ids = np.concatenate(all_ids)
+        uniq, inverse, counts = np.unique(ids, return_inverse=True, return_counts=True)
+        scores = np.zeros(len(uniq), dtype="float32")
+        np.add.at(scores, inverse, np.concatenate(all_scores))
+        if require_all:
+            mask = counts == len(tokens)
+            uniq, scores = uniq[mask], scores[mask]
+        if len(uniq) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            uniq, scores = uniq[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return uniq[order], scores[order]
+
+def rrf_fuse(rankings: Sequence[Sequence[int]], k: int = RRF_K) -> Dict[int, float]:
+    """Reciprocal rank fusion: each ranking contributes 1 / (k + rank) to every ID it contains."""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, cid in enumerate(ranking, 1):
+            fused[int(cid)] = fused.get(int(cid), 0.0) + 1.0 / (k + rank)
+    return fused
+
+def open_lexical_index(index_dir: str, chunk_ids: np.ndarray) -> Optional[LexicalIndex]:
+    """Returns the lexical index of an index directory, or None for indexes built without one."""
+    if not has_lexical_index(index_dir):
+        return None
+    return LexicalIndex(index_dir, chunk_ids)
@@ -1,52 +1,236 @@
 # This is the main file for my Showcase 2. It uses LangChain's modern agent toolkit to let the AI directly query the database to answer questions.
 
 # These are the key components from the LangChain library.
-from langchain_community.chat_models import ChatOllama 
+from langchain_community.chat_models import ChatOllama
 from langchain_community.utilities import SQLDatabase
 from langchain_community.agent_toolkits import create_sql_agent
+from langchain_core.callbacks import BaseCallbackHandler
+from sqlalchemy import create_engine, text
 import os
+import time
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from ollama_client import KEEP_ALIVE
+from rag_cache import LRUTTLCache, normalize_query
+from rag_metrics import REGISTRY, STAGE_SECONDS, timed_stage
 
 # --- Configuration ---
-DB_PATH = "analytics.db"
+DB_PATH = os.environ.get("RAG_SQL_DB_PATH", "analytics.db")
 # This gets the model name from an environment variable, with 'llama3.2' as a default.
 MODEL_NAME = os.environ.get("RAG_LLM_MODEL", "llama3.2")
+# Connections kept open by the SQLAlchemy pool, shared by all questions.
+SQL_POOL_SIZE = int(os.environ.get("RAG_SQL_POOL_SIZE", "4"))
+# The agent prints its thought process, which has helped debugging in some cases.
+SQL_AGENT_VERBOSE = os.environ.get("RAG_SQL_AGENT_VERBOSE", "1") == "1"
+# Answers (and their SQL) per normalized question, keyed by the database's data version so any write makes them unreachable.
+SQL_CACHE_SIZE = int(os.environ.get("RAG_SQL_CACHE_SIZE", "256"))
+SQL_CACHE_TTL_SEC = float(os.environ.get("RAG_SQL_CACHE_TTL_SEC", "86400"))
+
+SQL_QUESTIONS = REGISTRY.counter("rag_sql_questions_total", "Questions asked to the SQL agent.", ["cache"])
+SQL_ERRORS = REGISTRY.counter("rag_sql_errors_total", "SQL agent questions that ended in an error.")
+
+class ToolStepTimer(BaseCallbackHandler):
+    """Times every tool call the agent makes (listing tables, reading the schema, running SQL), per tool name."""
+
+    def __init__(self):
+        self.timing: Dict[str, float] = {}
+        self.steps = 0
+        self._started: Dict[Any, Tuple[str, float]] = {}
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._started[run_id] = ((serialized or {}).get("name", "tool"), time.perf_counter())
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def _finish(self, run_id) -> None:
+        name, started = self._started.pop(run_id, (None, 0.0))
+        if name is None:
+            return
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, component="sql_tool", stage=name)
+        self.timing[f"{name}_sec"] = round(self.timing.get(f"{name}_sec", 0.0) + elapsed, 4)
+        self.steps += 1
 
 # --- Agent Setup ---
-def query_live_database(user_query: str):
+class SqlAgentService:
     """
-    Takes a user's query, runs it through the modern SQL agent,
-    and returns the final answer.
+    Long-lived SQL agent. The LLM, the pooled database engine, the reflected schema and the agent are built once
+    and reused for every question, so a question only pays for the LLM and the SQL it runs.
+    The schema is rebuilt only when SQLite reports a schema change or the database file is replaced.
     """
-    print(f"\n--- Received Query for SQL Agent: '{user_query}' ---")
-    try:
-        # 1. Initialize the LLM as a CHAT model, and here chatollama is implemented 
-        llm = ChatOllama(model=MODEL_NAME, temperature=0)
-        # 2. Connecting to the database
-        db_uri = f"sqlite:///{DB_PATH}"
-        db = SQLDatabase.from_uri(db_uri)
-        
-        # 3. The 'create_sql_agent' function here bundles the LLM and the database connection into an intelligent agent that can write and execute its own SQL queries.
-        agent_executor = create_sql_agent(
-            llm=llm,
-            db=db,
-            verbose=True, # Through this I can see the agent's thought process in my terminal. This has helped debugging in some cases.
-            agent_type="openai-tools"
+
+    def __init__(self, db_path: str = DB_PATH, model: str = MODEL_NAME, pool_size: int = SQL_POOL_SIZE):
+        self.db_path = db_path
+        self.model = model
+        self.pool_size = pool_size
+        self.llm = None
+        self.engine = None
+        self.db: Optional[SQLDatabase] = None
+        self.agent_executor = None
+        self._schema_key: Optional[Tuple] = None
+        self._lock = threading.Lock()
+        self.schema_refreshes = 0
+        self.answer_cache = LRUTTLCache(SQL_CACHE_SIZE, SQL_CACHE_TTL_SEC)
+        # A dedicated connection for PRAGMA data_version, which only reflects other connections' commits when read on the same one.
+        self._version_conn: Optional[sqlite3.Connection] = None
+        self._version_identity: Optional[Tuple[int, int]] = None
+        self._version_lock = threading.Lock()
+
+    def _file_identity(self) -> Tuple[int, int]:
+        st = os.stat(self.db_path)
+        return st.st_dev, st.st_ino
+
+    def data_version(self) -> Tuple:
+        """
+        A key that changes whenever the database content does: the file's identity, mtime and size
+        (writes from anywhere, a replaced file) plus SQLite's data_version (commits that haven't reached the main file yet, e.g. in WAL mode).
+        """
+        st = os.stat(self.db_path)
+        identity = (st.st_dev, st.st_ino)
+        with self._version_lock:
+            if self._version_conn is None or self._version_identity != identity:
+                if self._version_conn is not None:
+                    self._version_conn.close()
+                self._version_conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+                self._version_identity = identity
+            data_version = self._version_conn.execute("PRAGMA data_version").fetchone()[0]
+        return identity, st.st_mtime_ns, st.st_size, data_version
+
+    def _schema_version(self) -> int:
+        # PRAGMA schema_version is bumped by SQLite on every CREATE/ALTER/DROP, and reading it costs next to nothing.
+        with self.engine.connect() as conn:
+            return int(conn.execute(text("PRAGMA schema_version")).scalar())
+
+    def _build_agent(self) -> None:
+        # The schema is reflected and rendered once per schema version and passed in as custom_table_info, so the agent doesn't query it again.
+        reflected = SQLDatabase(self.engine)
+        table_info = {t: reflected.get_table_info([t]) for t in reflected.get_usable_table_names()}
+        self.db = SQLDatabase(self.engine, custom_table_info=table_info)
+        # The 'create_sql_agent' function here bundles the LLM and the database connection into an intelligent agent that can write and execute its own SQL queries.
+        self.agent_executor = create_sql_agent(
+            llm=self.llm,
+            db=self.db,
+            verbose=SQL_AGENT_VERBOSE,
+            agent_type="openai-tools",
+            # The intermediate steps carry the SQL the agent ran, which is cached along with the answer.
+            agent_executor_kwargs={"return_intermediate_steps": True},
         )
+        self.schema_refreshes += 1
+
+    def ensure_ready(self):
+        """Initializes on first use and refreshes the schema if it changed. Returns the agent to invoke."""
+        with self._lock:
+            if not os.path.exists(self.db_path):
+                raise FileNotFoundError(f"Database file '{self.db_path}' not found.")
+            if self.llm is None:
+                # Initialize the LLM as a CHAT model, and here chatollama is implemented (keep_alive keeps it loaded between questions)
+                self.llm = ChatOllama(model=self.model, temperature=0, keep_alive=KEEP_ALIVE or None)
+            identity = self._file_identity()
+            if self.engine is not None and self._schema_key and self._schema_key[0] != identity:
+                # The file was replaced, so pooled connections still point at the old one.
+                self.engine.dispose()
+                self.engine = None
+            if self.engine is None:
+                # check_same_thread=False lets pooled SQLite connections be used from Flask's worker threads.
+                self.engine = create_engine(f"sqlite:///{self.db_path}", pool_size=self.pool_size, pool_pre_ping=True,
+                                            connect_args={"check_same_thread": False})
+            schema_key = (identity, self._schema_version())
+            if schema_key != self._schema_key or self.agent_executor is None:
+                if self._schema_key is not None:
+                    print(f"Database schema changed, refreshing the SQL agent's schema for '{self.db_path}'")
+                self._build_agent()
+                self._schema_key = schema_key
+            return self.agent_executor
+
+    def ask(self, user_query: str) -> Dict[str, Any]:
+        """
+        Runs a question through the agent and returns {"answer", "sql", "cache", "timing_stats"}, with errors reported as the answer.
+        A repeated question is answered from the cache as long as the database hasn't changed since.
+        """
+        print(f"\n--- Received Query for SQL Agent: '{user_query}' ---")
+        t0 = time.perf_counter()
+        timing: Dict[str, Any] = {}
+        try:
+            with timed_stage(timing, "sql_agent", "cache_lookup"):
+                cache_key = (normalize_query(user_query), self.data_version())
+                cached = self.answer_cache.get(cache_key)
+            if cached is not None:
+                SQL_QUESTIONS.inc(cache="hit")
+                print(f"--- Cached Answer: {cached['answer']} ---")
+                timing["total_sec"] = round(time.perf_counter() - t0, 4)
+                return dict(cached, cache="hit", timing_stats=timing)
+            SQL_QUESTIONS.inc(cache="miss")
+
+            with timed_stage(timing, "sql_agent", "schema"):
+                agent_executor = self.ensure_ready()
+            # Invoking the agent with the user query. The callback times each tool step; the rest of the agent's time is the LLM.
+            tools = ToolStepTimer()
+            with timed_stage(timing, "sql_agent", "agent"):
+                result = agent_executor.invoke({"input": user_query}, config={"callbacks": [tools]})
+            timing["tools"] = tools.timing
+            timing["tool_steps"] = tools.steps
+            timing["llm_sec"] = round(max(0.0, timing["agent_sec"] - sum(tools.timing.values())), 4)
+            timing["total_sec"] = round(time.perf_counter() - t0, 4)
+
+            # The answer is now in the 'output' key
+            final_answer = result.get("output")
+            if not final_answer:
+                return {"answer": "Sorry, I was unable to process that request.", "sql": [], "cache": "miss", "timing_stats": timing}
+
+            print(f"--- Final Answer: {final_answer} ---")
+            entry = {"answer": final_answer, "sql": generated_sql(result.get("intermediate_steps") or [])}
+            # The key is taken before the agent runs, so an answer computed while the data changed is never stored under the new version.
+            self.answer_cache.put(cache_key, entry)
+            return dict(entry, cache="miss", timing_stats=timing)
+
+        except Exception as e:
+            SQL_ERRORS.inc()
+            print(f"An error occurred in the SQL agent: {e}")
+            timing["total_sec"] = round(time.perf_counter() - t0, 4)
+            return {"answer": f"An error occurred: {e}", "sql": [], "cache": "miss", "timing_stats": timing}
+
+    def stats(self) -> Dict[str, Any]:
+        pool = self.engine.pool.status() if self.engine is not None else None
+        return {"db_path": self.db_path, "ready": self.agent_executor is not None,
+                "schema_refreshes": self.schema_refreshes, "pool": pool, "answer_cache": self.answer_cache.stats()}
 
-        # 4. Invoking the agent with the user query
-        result = agent_executor.invoke({"input": user_query})
-        
-        # The answer is now in the 'output' key
-        final_answer = result.get("output", "Sorry, I was unable to process that request.")
-        
-        print(f"--- Final Answer: {final_answer} ---")
-        return {"answer": final_answer}
+def generated_sql(steps: List[Tuple[Any, Any]]) -> List[str]:
+    # Picks the statements the agent actually executed out of its (action, observation) steps.
+    queries = []
+    for action, _ in steps:
+        if getattr(action, "tool", "") != "sql_db_query":
+            continue
+        tool_input = getattr(action, "tool_input", "")
+        query = tool_input.get("query", "") if isinstance(tool_input, dict) else str(tool_input)
+        if query:
+            queries.append(query)
+    return queries
 
-    except Exception as e:
-        print(f"An error occurred in the SQL agent: {e}")
-        return {"answer": f"An error occurred: {e}"}
+_service: Optional[SqlAgentService] = None
+_service_lock = threading.Lock()
+
+def get_sql_agent() -> SqlAgentService:
+    """Returns the process-wide agent service, so every request shares the same LLM, engine and schema."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = SqlAgentService()
+        return _service
+
+def query_live_database(user_query: str):
+    """
+    Takes a user's query, runs it through the modern SQL agent,
+    and returns the final answer.
+    """
+    return get_sql_agent().ask(user_query)
 
 # --- Example of how to run it directly ---
 if __name__ == "__main__":
     print("--- Live Database Information Assistant (Modern) ---")
-    query_live_database("How much is the total revenue from all orders?")
\ No newline at end of file
+    query_live_database("How much is the total revenue from all orders?")
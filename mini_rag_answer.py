@@ -9,21 +9,30 @@ os.environ.setdefault("MKL_NUM_THREADS", "1")
 os.environ.setdefault("VECLIB_MAXIMUM_THREADS", "1")
 os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
 
-# Determinig that which index to use.
+# Determinig that which index to use. The docs folder -> index folder mapping lives in the corpus registry.
+from index_registry import index_dir_for
+from index_versions import active_index_dir, resolve_index_dir
+
 DOCS_DIR = os.environ.get("RAG_DOCS_DIR", "docs")
-INDEX_DIR = "index_s2" if DOCS_DIR == "docs_db" else "index_s1"
+# A versioned index folder is read from its live version (see index_versions.py).
+INDEX_DIR = active_index_dir(index_dir_for(DOCS_DIR))
 
-import sys, re, json, time, traceback
-from typing import List, Dict, Any, Optional, Tuple
-from urllib.request import Request, urlopen
-from urllib.error import URLError, HTTPError
+import sys, re, json, time, threading, traceback
+from typing import List, Dict, Any, Generator, Iterator, Optional, Tuple
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
+
+from answer_cache import answer_key, get_answer_cache
+from chunk_store import ATTRS_FILE, LEGACY_META_FILE, has_chunk_store, has_doc_attributes, open_chunk_store, store_files
+from doc_filters import DocFilter, parse_filter
+from lexical_index import has_lexical_index, lexical_files, open_lexical_index, rrf_fuse, tokenize
+from ollama_client import get_ollama_client
+from query_encoder import load_query_encoder
+from rag_cache import LRUTTLCache, normalize_query
+from rag_metrics import REGISTRY, STAGE_SECONDS, timed_stage
 
 # Paths for the chosen index.
 INDEX_PATH = os.path.join(INDEX_DIR, "faiss.index")
-META_PATH = os.path.join(INDEX_DIR, "meta.json")
 EMB_PATH = os.path.join(INDEX_DIR, "embeddings.npy")
 
 # Here, embedding and LLM configuration.
@@ -37,92 +46,190 @@ ENABLE_ABSTAIN = os.environ.get("RAG_ENABLE_ABSTAIN", "1") == "1"
 MIN_TOP_SIM = float(os.environ.get("RAG_MIN_TOP_SIM", "0.30"))
 MIN_CAND_SIM = float(os.environ.get("RAG_MIN_CAND_SIM", "0.25"))
 REL_KEEP_FRACTION = float(os.environ.get("RAG_REL_KEEP_FRACTION", "0.75"))
+# Most retrieved chunks kept per document, best first. Only these are read from the chunk store.
+DOC_TOP_CHUNKS = int(os.environ.get("RAG_DOC_TOP_CHUNKS", "16"))
 
 # Ollama / LLM settings.
-OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434").rstrip("/")
 RERANK_MODEL = os.environ.get("RAG_LLM_MODEL", "llama3.2")
 SYNTH_MODEL = os.environ.get("RAG_SYNTH_MODEL", RERANK_MODEL)
 NUM_PREDICT_DETAILED = int(os.environ.get("RAG_SYNTH_NUM_PREDICT", "512"))
 NUM_PREDICT_BULLETS = int(os.environ.get("RAG_SYNTH_NUM_PREDICT_BULLETS", "256"))
+# Prompt context: at most this many documents, and retrieved chunks are added by score until the estimated token budget is used up.
+CONTEXT_TOKENS = int(os.environ.get("RAG_CONTEXT_TOKENS", "1200"))
+CONTEXT_MAX_DOCS = int(os.environ.get("RAG_CONTEXT_MAX_DOCS", "3"))
+# A chunk that doesn't fit is cut down to the remaining budget, unless less than this is left.
+CONTEXT_MIN_PIECE_TOKENS = int(os.environ.get("RAG_CONTEXT_MIN_PIECE_TOKENS", "48"))
+# How many queries the encoder processes per forward pass in batch mode.
+BATCH_ENCODE_SIZE = int(os.environ.get("RAG_BATCH_ENCODE_SIZE", "64"))
+# Batch mode: queries per engine call, and which JSONL field holds the query text.
+BATCH_SIZE = int(os.environ.get("RAG_BATCH_SIZE", "256"))
+BATCH_FIELD = os.environ.get("RAG_BATCH_FIELD", "query")
+# Rows per block when the numpy fallback scans the memory-mapped embeddings.
+SCAN_BLOCK_ROWS = int(os.environ.get("RAG_SCAN_BLOCK_ROWS", "65536"))
+# Hybrid retrieval: BM25 candidates from the inverted index are fused with the dense hits (reciprocal rank fusion).
+HYBRID = os.environ.get("RAG_HYBRID", "1") == "1"
+# Exact-term queries ("quoted phrase" or a single word rarer than the fraction below) are answered from the inverted index alone.
+LEXICAL_SHORTCUT = os.environ.get("RAG_LEXICAL_SHORTCUT", "1") == "1"
+LEXICAL_SHORTCUT_MAX_DF = float(os.environ.get("RAG_LEXICAL_SHORTCUT_MAX_DF", "0.5"))
+# The shortcut's own relevance floor: the best hit's BM25 over the terms' IDF (1.0 = each term once in a chunk of average length).
+# Weaker matches go through the dense search and its cosine thresholds.
+LEXICAL_MIN_STRENGTH = float(os.environ.get("RAG_LEXICAL_MIN_STRENGTH", "0.8"))
+# A quoted phrase is checked against the text of up to this many times TOP_K BM25 candidates, since the postings have no positions.
+PHRASE_CANDIDATES = int(os.environ.get("RAG_PHRASE_CANDIDATES", "4"))
+# Filtered search: subsets up to this fraction of all chunks are scored exactly from embeddings.npy, larger ones in FAISS.
+FILTER_EXACT_FRACTION = float(os.environ.get("RAG_FILTER_EXACT_FRACTION", "0.2"))
+# Filter for command-line queries, e.g. RAG_FILTER="prefix:tech date>=2024".
+DOC_FILTER = os.environ.get("RAG_FILTER", "")
 VERSION = "6.2.1-multi-index-final"
 
-def load_meta() -> dict:
-    if not os.path.exists(META_PATH):
-        # Provide a specific, helpful error message
-        sys.exit(json.dumps({"error": f"Index metadata not found at '{META_PATH}'. Please run the indexing script for the '{DOCS_DIR}' document source."}))
-    with open(META_PATH, "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    if "metadata" not in meta or not isinstance(meta["metadata"], list) or not meta["metadata"]:
-        sys.exit(json.dumps({"error": f"Malformed or empty meta file: {META_PATH}."}))
-    return meta
-
-def ensure_chunk_embeddings(embedder: SentenceTransformer, meta: dict) -> np.ndarray:
-    if os.path.exists(EMB_PATH):
-        try:
-            emb = np.load(EMB_PATH)
-            if emb.ndim == 2 and emb.shape[0] == len(meta["metadata"]):
-                return emb
-        except Exception:
-            pass # Fall through to re-generate if loading fails
-    print(f"Embeddings file '{EMB_PATH}' not found or invalid. Generating new embeddings...", file=sys.stderr)
-    chunks = [md.get("text", md.get("chunk_text", "")) for md in meta["metadata"]]
-    emb = embedder.encode(
-        chunks, batch_size=32, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=True
-    ).astype("float32")
-    os.makedirs(INDEX_DIR, exist_ok=True)
-    np.save(EMB_PATH, emb)
+# Counters for the /metrics endpoint. Stage durations go to the shared rag_stage_seconds histogram (see timed_stage).
+QUERIES = REGISTRY.counter("rag_queries_total", "Queries answered by the RAG engine.", ["mode"])
+RETRIEVAL_CACHE_LOOKUPS = REGISTRY.counter("rag_retrieval_cache_lookups_total", "Retrieval cache lookups.", ["result"])
+ANSWER_CACHE_LOOKUPS = REGISTRY.counter("rag_answer_cache_lookups_total", "Semantic answer cache lookups before an LLM call.", ["result"])
+NUMPY_FALLBACKS = REGISTRY.counter("rag_numpy_fallback_total", "Searches served by the numpy fallback because FAISS was unavailable.")
+ABSTENTIONS = REGISTRY.counter("rag_abstentions_total", "Queries answered with the abstain message.")
+LEXICAL_SHORTCUTS = REGISTRY.counter("rag_lexical_shortcut_total", "Exact-term queries answered from the inverted index alone.")
+EXTRACTIVE_FALLBACKS = REGISTRY.counter("rag_extractive_fallback_total", "Answers that fell back to the extractive snippet because the LLM gave nothing.")
+
+def load_chunk_store(index_dir: str = INDEX_DIR, docs_dir: str = DOCS_DIR):
+    # Opens the memory-mapped chunk store of an index (or its legacy meta.json). Only the record table is mapped, chunk text is read on demand.
+    try:
+        store = open_chunk_store(index_dir)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Index metadata not found in '{index_dir}'. Please run the indexing script for the '{docs_dir}' document source.")
+    if len(store) == 0:
+        raise ValueError(f"Malformed or empty chunk store in '{index_dir}'.")
+    return store
+
+def load_chunk_embeddings(store, emb_path: str = EMB_PATH) -> np.ndarray:
+    # Memory-maps the embeddings written at index time (rows in store.ids() order). Nothing is re-encoded, a missing file is an error.
+    if not os.path.exists(emb_path):
+        raise FileNotFoundError(f"Embeddings file '{emb_path}' not found. Rebuild the index to enable the numpy fallback.")
+    emb = np.load(emb_path, mmap_mode="r")
+    if emb.ndim != 2 or emb.shape[0] != len(store):
+        raise ValueError(f"Embeddings file '{emb_path}' doesn't match the chunk store. Rebuild the index.")
     return emb
 
-def faiss_search(q_vec: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
-    #Query FAISS index on disk. This is the preferred fast retrieval path.
+def load_faiss_index(index_path: str = INDEX_PATH):
+    import faiss
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"FAISS index file not found at '{index_path}'.")
+    index = faiss.read_index(index_path)
+    # Approximate indexes (IVF, HNSW) come with their tuned search parameters, e.g. nprobe or efSearch.
+    params_path = os.path.join(os.path.dirname(index_path), "index_params.json")
+    if os.path.exists(params_path):
+        with open(params_path, "r", encoding="utf-8") as f:
+            params = json.load(f)
+        space = faiss.ParameterSpace()
+        for name, value in params.get("search_params", {}).items():
+            space.set_index_parameter(index, name, value)
+    return index
+
+def faiss_search(q_vec: np.ndarray, k: int, index=None, ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    #Query FAISS index (the loaded one if passed, else from disk), limited to `ids` for a filtered search. This is the preferred fast retrieval path.
+    if index is None:
+        index = load_faiss_index(INDEX_PATH)
+    if ids is None:
+        return index.search(q_vec, k)
+    return index.search(q_vec, k, params=selector_params(index, ids))
+
+def selector_params(index, ids: np.ndarray):
+    # Search parameters restricted to the given IDs, carrying over the index's tuned nprobe / efSearch.
     import faiss
-    if not os.path.exists(INDEX_PATH):
-        raise FileNotFoundError(f"FAISS index file not found at '{INDEX_PATH}'.")
-    index = faiss.read_index(INDEX_PATH)
-    return index.search(q_vec, k)
-
-def cosine_search(q_vec: np.ndarray, chunk_emb: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
-    # A simple numpy-based cosine similarity fallback when FAISS is unavailable. This is slower but reliable and ensures the script works in constrained environments.
-    sims = (chunk_emb @ q_vec.T).reshape(-1)
-    idxs = np.argsort(-sims)[:k]
-    scores = sims[idxs]
-    return scores[None, :], idxs[None, :]
-
-def meta_fields(md: dict, default_chunk_id: int) -> Tuple[str, int, str]:
-    source = md.get("source", "unknown")
-    chunk_id = md.get("chunk_id", md.get("chunk_index", default_chunk_id))
-    text = md.get("text", md.get("chunk_text", ""))
-    return source, int(chunk_id), text
-
-def aggregate_by_document(indices: List[int], scores: List[float], meta_list: List[dict]) -> Dict[str, Dict[str, Any]]:
-    agg: Dict[str, Dict[str, Any]] = {}
-    for idx, sc in zip(indices, scores):
-        md = meta_list[idx]
-        src, cid, text = meta_fields(md, 0)
-        entry = agg.setdefault(src, {"best_score": sc, "chunks": []})
-        if sc > entry["best_score"]:
-            entry["best_score"] = sc
-        entry["chunks"].append({"chunk": cid, "score": sc, "text": text})
-    for src in agg:
-        agg[src]["chunks"].sort(key=lambda x: -x["score"])
-    return agg
-
-def simple_relevance_filter(agg_docs: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
-    if not agg_docs:
+    sel = faiss.IDSelectorBatch(np.ascontiguousarray(ids, dtype="int64"))
+    inner = faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexIDMap):
+        inner = faiss.downcast_index(inner.index)
+    if isinstance(inner, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(sel=sel, nprobe=inner.nprobe)
+    elif isinstance(inner, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=sel, efSearch=inner.hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=sel)
+    # The selector must outlive the search, the params object only holds a pointer to it.
+    params.sel_ref = sel
+    return params
+
+def cosine_search(q_vec: np.ndarray, chunk_emb: np.ndarray, k: int, block_rows: int = SCAN_BLOCK_ROWS) -> Tuple[np.ndarray, np.ndarray]:
+    # A numpy-based cosine similarity fallback when FAISS is unavailable. Scans the (memory-mapped) matrix block by block, keeping a running top-k.
+    q = np.asarray(q_vec, dtype="float32").reshape(-1)
+    best_scores = np.empty(0, dtype="float32")
+    best_rows = np.empty(0, dtype="int64")
+    for start in range(0, chunk_emb.shape[0], block_rows):
+        block = np.asarray(chunk_emb[start:start + block_rows], dtype="float32")
+        sims = block @ q
+        if len(sims) > k:
+            top = np.argpartition(-sims, k - 1)[:k]
+        else:
+            top = np.arange(len(sims))
+        cand_scores = np.concatenate([best_scores, sims[top]])
+        cand_rows = np.concatenate([best_rows, top.astype("int64") + start])
+        if len(cand_scores) > k:
+            keep = np.argpartition(-cand_scores, k - 1)[:k]
+            cand_scores, cand_rows = cand_scores[keep], cand_rows[keep]
+        best_scores, best_rows = cand_scores, cand_rows
+    order = np.argsort(-best_scores, kind="stable")
+    return best_scores[order][None, :], best_rows[order][None, :]
+
+def subset_search(q_vecs: np.ndarray, chunk_emb: np.ndarray, rows: np.ndarray, k: int, block_rows: int = SCAN_BLOCK_ROWS) -> Tuple[np.ndarray, np.ndarray]:
+    # Exact inner-product search over the given (sorted) rows only, block by block like cosine_search. Returns (scores, rows).
+    q = np.asarray(q_vecs, dtype="float32").reshape(len(q_vecs), -1)
+    k = min(k, len(rows))
+    best_scores = np.empty((len(q), 0), dtype="float32")
+    best_rows = np.empty((len(q), 0), dtype="int64")
+    for start in range(0, len(rows), block_rows):
+        part = rows[start:start + block_rows]
+        sims = q @ np.asarray(chunk_emb[part], dtype="float32").T
+        cand_scores = np.concatenate([best_scores, sims], axis=1)
+        cand_rows = np.concatenate([best_rows, np.broadcast_to(part.astype("int64"), sims.shape)], axis=1)
+        if cand_scores.shape[1] > k:
+            keep = np.argpartition(-cand_scores, k - 1, axis=1)[:, :k]
+            cand_scores = np.take_along_axis(cand_scores, keep, axis=1)
+            cand_rows = np.take_along_axis(cand_rows, keep, axis=1)
+        best_scores, best_rows = cand_scores, cand_rows
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+def rank_documents(indices, scores, store, top_chunks: int = DOC_TOP_CHUNKS, min_top_sim: float = MIN_TOP_SIM,
+                   min_cand_sim: float = MIN_CAND_SIM) -> List[Dict[str, Any]]:
+    """
+    Groups search hits (chunk IDs and scores) by document and keeps the relevant documents, best first. A document's score is
+    its best chunk's; the top one must reach min_top_sim, and the others min_cand_sim and REL_KEEP_FRACTION of the top score.
+    Returns kept_docs: [{"name", "score", "top_chunks": its best `top_chunks` chunks as {"id", "chunk", "score", "text"}}].
+    """
+    ids = np.asarray(indices, dtype="int64").reshape(-1)
+    sc = np.asarray(scores, dtype="float32").reshape(-1)
+    chunk_ids = store.ids()
+    if not len(ids) or not len(chunk_ids):
+        return []
+    rows = np.minimum(np.searchsorted(chunk_ids, ids), len(chunk_ids) - 1)
+    # FAISS pads missing results with -1, and IDs that aren't in the store are skipped like before.
+    valid = (ids >= 0) & (chunk_ids[rows] == ids)
+    ids, sc, rows = ids[valid], sc[valid], rows[valid]
+    if not len(ids):
         return []
-    top_score = max((v["best_score"] for v in agg_docs.values()), default=0)
-    if top_score < MIN_TOP_SIM:
+    docs = np.asarray(store.doc_ids()[rows], dtype="int64")
+    # Grouped by document, best chunk first within each group.
+    order = np.lexsort((-sc, docs))
+    sorted_docs = docs[order]
+    starts = np.flatnonzero(np.r_[True, sorted_docs[1:] != sorted_docs[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    best = sc[order[starts]]
+    top_score = float(best.max())
+    if top_score < min_top_sim:
         return []
-    keep_cut = max(MIN_CAND_SIM, top_score * REL_KEEP_FRACTION)
+    keep = np.flatnonzero(best >= max(min_cand_sim, top_score * REL_KEEP_FRACTION))
+    keep = keep[np.argsort(-best[keep], kind="stable")]
+    chunk_indexes = store.chunk_indexes()
     kept = []
-    for name, info in agg_docs.items():
-        if info["best_score"] >= keep_cut:
-            kept.append({
-                "name": name,
-                "score": float(info["best_score"]),
-                "top_chunks": info["chunks"]
-            })
-    kept.sort(key=lambda d: -d["score"])
+    for g in keep:
+        members = order[starts[g]:min(ends[g], starts[g] + top_chunks)]
+        kept.append({
+            "name": store.doc_name(sorted_docs[starts[g]]),
+            "score": float(best[g]),
+            "top_chunks": [{"id": int(ids[m]), "chunk": int(chunk_indexes[rows[m]]), "score": float(sc[m]), "text": store.text_at(int(rows[m]))}
+                           for m in members],
+        })
     return kept
 
 _token_re = re.compile(r"[a-z0-9]{3,}")
@@ -130,6 +237,11 @@ _token_re = re.compile(r"[a-z0-9]{3,}")
 def _query_tokens(q: str) -> List[str]:
     return list({t for t in _token_re.findall((q or "").lower())})
 
+def _has_phrase(text: str, phrase: List[str]) -> bool:
+    toks = tokenize(text)
+    n = len(phrase)
+    return any(toks[i:i + n] == phrase for i in range(len(toks) - n + 1) if toks[i] == phrase[0])
+
 def _passes_lexical_sanity(query: str, doc_name: str, doc_text: str) -> bool:
     toks = _query_tokens(query)
     if not toks:
@@ -137,7 +249,7 @@ def _passes_lexical_sanity(query: str, doc_name: str, doc_text: str) -> bool:
     hay = f"{doc_name} {doc_text[:600]}".lower()
     return any(t in hay for t in toks)
 
-def _ollama_generate(model: str, prompt: str, num_predict: int) -> Optional[str]:
+def _candidate_models(model: str) -> List[str]:
     candidates = [model]
     if ":" in model:
         base = model.split(":", 1)[0]
@@ -145,33 +257,31 @@ def _ollama_generate(model: str, prompt: str, num_predict: int) -> Optional[str]
             candidates.append(base)
     if "llama3.2" not in candidates:
         candidates.append("llama3.2")
-
-    for m in candidates:
-        payload = {"model": m, "prompt": prompt, "stream": False, "options": {"temperature": 0.2, "num_predict": num_predict}}
-        data = json.dumps(payload).encode("utf-8")
-        req = Request(OLLAMA_HOST + "/api/generate", data=data, headers={"Content-Type": "application/json"}, method="POST")
-        for attempt in range(1, 4):
-            try:
-                with urlopen(req, timeout=60) as resp:
-                    raw = resp.read().decode("utf-8")
-                    obj = json.loads(raw) if raw.strip().startswith("{") else {"response": raw}
-                    out = (obj.get("response") or "").strip()
-                    if out:
-                        return out
-            except Exception:
-                time.sleep(0.5 * attempt)
-    return None
-
-def build_prompt(query: str, contexts: List[Dict[str, Any]], mode: str) -> str:
-    # Construct the LLM prompt that instructs the model to answer ONLY using the provided context. This reduces hallucination and keeps answers grounded in the retrieved text.
-    lines = []
-    lines.append("You are a helpful assistant.")
-    lines.append("Answer ONLY using the CONTEXT below. If the context lacks the answer, reply exactly: Sorry, the provided documents do not contain information on this topic.")
+    return candidates
+
+def _ollama_generate(model: str, prompt: str, num_predict: int, system: Optional[str] = None) -> Optional[str]:
+    # Goes through the shared pooled client, which bounds concurrency, enforces a deadline and fails fast while Ollama is down.
+    return get_ollama_client().generate(_candidate_models(model), prompt, num_predict, extra={"system": system} if system else None)
+
+def _ollama_generate_stream(model: str, prompt: str, num_predict: int, system: Optional[str] = None) -> Generator[str, None, Optional[bool]]:
+    # Streaming variant of _ollama_generate. Ollama sends one JSON object per line, and each "response" piece is yielded as soon as it arrives.
+    return get_ollama_client().generate_stream(_candidate_models(model), prompt, num_predict, extra={"system": system} if system else None)
+
+def prompt_header(mode: str) -> str:
+    # The fixed instructions to answer ONLY from the context, sent as the system prompt so Ollama can reuse their cached evaluation.
+    lines = [
+        "You are a helpful assistant.",
+        f"Answer ONLY using the CONTEXT in the user's message. If the context lacks the answer, reply exactly: {ABSTAIN_MESSAGE}",
+    ]
     if mode == "bulleted":
         lines.append("Return 5-7 concise bullet points. No preamble, no concluding line.")
     else:
         lines.append("Return a single, well-structured paragraph. No preamble, no concluding line.")
-    lines.append("\nCONTEXT:")
+    return "\n".join(lines)
+
+def build_prompt(query: str, contexts: List[Dict[str, Any]]) -> str:
+    # The request-specific part of the prompt, sent after prompt_header(mode).
+    lines = ["CONTEXT:"]
     for i, d in enumerate(contexts, 1):
         lines.append(f"{i}) [{d['name']} | score={d['score']:.3f}] {d['snippet']}")
     lines.append(f"\nQUESTION: {query.strip()}")
@@ -189,9 +299,595 @@ def extractive_fallback(context_text: str, mode: str) -> str:
     else:
         return text[:700]
 
+ABSTAIN_MESSAGE = "Sorry, the provided documents do not contain information on this topic."
+
+def index_version(*paths: str) -> str:
+    # A cheap fingerprint of the on-disk index files, so cached results from an older build are never reused.
+    parts = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            parts.append(f"{st.st_mtime_ns}:{st.st_size}")
+        except OSError:
+            parts.append("missing")
+    return "|".join(parts)
+
+def approx_tokens(text: str) -> int:
+    # The LLM's tokenizer isn't available here. About 4 characters per token is close for English text with llama-style vocabularies.
+    return (len(text) + 3) // 4
+
+def merge_overlap(first: str, second: str, min_overlap_words: int = 3) -> str:
+    # Joins two neighbouring chunks of a document. The words the second one repeats from the end of the first (the chunk overlap) are dropped.
+    a, b = first.split(), second.split()
+    for start in range(max(0, len(a) - len(b)), len(a) - min_overlap_words + 1):
+        if a[start] == b[0] and a[start:] == b[:len(a) - start]:
+            return " ".join(a + b[len(a) - start:])
+    return " ".join(a + b)
+
+def _trim_to_tokens(text: str, max_tokens: int) -> str:
+    # Cuts text to about max_tokens, at a sentence boundary where possible.
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(". ", 0, max_chars)
+    if cut > 80:
+        return text[:cut + 1]
+    cut = text.rfind(" ", 0, max_chars)
+    return text[:cut if cut > 0 else max_chars]
+
+def _doc_passages(chunks: List[Dict[str, Any]]) -> List[str]:
+    # The selected chunks of one document in document order, with runs of neighbouring chunks merged into one passage.
+    passages: List[str] = []
+    prev = None
+    for c in sorted(chunks, key=lambda c: c["chunk"]):
+        if prev is not None and c["chunk"] == prev["chunk"] + 1 and not prev["trimmed"]:
+            passages[-1] = merge_overlap(passages[-1], c["text"])
+        else:
+            passages.append(c["text"])
+        prev = c
+    return passages
+
+def _doc_snippet(chunks: List[Dict[str, Any]]) -> str:
+    return " … ".join(_doc_passages(chunks))
+
+def build_contexts(kept_docs: List[Dict[str, Any]], max_docs: int = CONTEXT_MAX_DOCS, token_budget: int = CONTEXT_TOKENS) -> List[Dict[str, Any]]:
+    """
+    Packs the retrieved chunks of the top documents into prompt snippets within an estimated token budget.
+    Each document's best chunk goes first, then the remaining chunks by score. Neighbouring chunks of a document are merged
+    without their repeated overlap, and chunks whose text is already in the context (e.g. the same text in two documents) are skipped.
+    A chunk that doesn't fit anymore is cut to the space that is left, and packing stops there.
+    """
+    docs = kept_docs[:max_docs]
+    firsts = [(di, d["top_chunks"][0]) for di, d in enumerate(docs) if d["top_chunks"]]
+    rest = sorted(((di, c) for di, d in enumerate(docs) for c in d["top_chunks"][1:]), key=lambda x: -x[1]["score"])
+    selected: Dict[int, List[Dict[str, Any]]] = {}
+    doc_tokens: Dict[int, int] = {}
+    texts: List[str] = []
+    used = 0
+    for di, chunk in firsts + rest:
+        text = re.sub(r"\s+", " ", (chunk.get("text") or "").strip())
+        if not text or any(text in t for t in texts):
+            continue
+        piece = {"chunk": chunk["chunk"], "text": text, "trimmed": False}
+        tokens = approx_tokens(_doc_snippet(selected.get(di, []) + [piece]))
+        over = used + tokens - doc_tokens.get(di, 0) - token_budget
+        if over > 0:
+            # Shrinks the piece until the document's snippet, separators included, fits the rest of the budget.
+            room = token_budget - used
+            while over > 0 and (room >= CONTEXT_MIN_PIECE_TOKENS or not selected):
+                piece = {"chunk": chunk["chunk"], "text": _trim_to_tokens(text, max(1, room)), "trimmed": True}
+                tokens = approx_tokens(_doc_snippet(selected.get(di, []) + [piece]))
+                over = used + tokens - doc_tokens.get(di, 0) - token_budget
+                room -= max(1, over)
+            if over > 0 and selected:
+                break
+        selected.setdefault(di, []).append(piece)
+        texts.append(text)
+        used += tokens - doc_tokens.get(di, 0)
+        doc_tokens[di] = tokens
+        if piece["trimmed"]:
+            break
+    return [{"name": docs[di]["name"], "score": docs[di]["score"], "snippet": _doc_snippet(selected[di])} for di in sorted(selected)]
+
+def format_citations(contexts: List[Dict[str, Any]], score_kind: str = "cosine") -> str:
+    # Create a citation string from the top 3 sources used for the answer. Lexical-only scores are relative BM25, not similarities.
+    label = "bm25 " if score_kind == "bm25" else ""
+    return ", ".join([f"({s['name']}, {label}{s['score']:.3f})" for s in contexts[:3]])
+
+class RagEngine:
+    """
+    A long-lived RAG engine for one document source. The embedding model, FAISS index and metadata
+    are loaded once in the constructor, so every query afterwards only pays for encoding, search and the LLM call.
+    """
+
+    def __init__(self, docs_dir: str = DOCS_DIR, index_dir: Optional[str] = None, embed_model: str = EMBED_MODEL, embedder: Optional[Any] = None):
+        self.docs_dir = docs_dir
+        # CURRENT is read once, so the engine only ever sees one complete version even if a new one is published meanwhile.
+        self.build_version, self.index_dir = resolve_index_dir(index_dir or index_dir_for(docs_dir))
+        self.index_path = os.path.join(self.index_dir, "faiss.index")
+        self.emb_path = os.path.join(self.index_dir, "embeddings.npy")
+
+        meta_files = store_files(self.index_dir) if has_chunk_store(self.index_dir) else [os.path.join(self.index_dir, LEGACY_META_FILE)]
+        if has_lexical_index(self.index_dir):
+            meta_files += lexical_files(self.index_dir)
+        if has_doc_attributes(self.index_dir):
+            meta_files.append(os.path.join(self.index_dir, ATTRS_FILE))
+        self.index_version = index_version(self.index_path, *meta_files)
+        # On-disk size of everything loaded or mapped below, the basis of memory_bytes().
+        self.index_bytes = sum(os.path.getsize(p) for p in [self.index_path, *meta_files] if os.path.exists(p))
+        # How long each part of loading took, reported on /metrics as well.
+        self.load_timing: Dict[str, float] = {}
+        # Search results are chunk IDs, and the store maps them to metadata without loading every record into Python objects.
+        with timed_stage(self.load_timing, "engine_load", "chunk_store"):
+            self.store = load_chunk_store(self.index_dir, docs_dir)
+        self.chunk_ids = self.store.ids()
+        # Engines can share one query encoder (see index_registry). RAG_QUERY_ENCODER=int8 picks the ONNX one (see query_encoder.py).
+        with timed_stage(self.load_timing, "engine_load", "embed_model"):
+            self.embedder = embedder if embedder is not None else load_query_encoder(embed_model)
+        try:
+            with timed_stage(self.load_timing, "engine_load", "faiss_index"):
+                self.index = load_faiss_index(self.index_path)
+        except Exception as ex:
+            print(f"FAISS index unavailable ({ex}), numpy cosine search will be used.", file=sys.stderr)
+            self.index = None
+        # The inverted index is optional, indexes built before it existed keep the plain dense path and the old lexical check.
+        try:
+            with timed_stage(self.load_timing, "engine_load", "lexical_index"):
+                self.lexical = open_lexical_index(self.index_dir, self.chunk_ids)
+        except Exception as ex:
+            print(f"Lexical index unavailable ({ex}), using dense retrieval only.", file=sys.stderr)
+            self.lexical = None
+        # Mapped now so pruning this version can't take the file away, but only counted in memory_bytes() once used.
+        try:
+            self._emb_map: Optional[np.ndarray] = load_chunk_embeddings(self.store, self.emb_path)
+        except (OSError, ValueError):
+            self._emb_map = None
+        self._chunk_emb: Optional[np.ndarray] = None
+        self._chunk_emb_lock = threading.Lock()
+        # Retrieval results keyed by (normalized query, index version), shared by the search step and /generate.
+        self.retrieval_cache = LRUTTLCache()
+        # Generated answers, reused for paraphrases that retrieve the same chunks (see answer_cache.py). Shared by all engines of the process.
+        self.answer_cache = get_answer_cache()
+        # Store rows per filter key, and every document's rows they are collected from. Both are built on the first filtered query.
+        self.filter_cache = LRUTTLCache(max_size=64, ttl_sec=0)
+        self._doc_rows: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    def _fallback_embeddings(self) -> np.ndarray:
+        with self._chunk_emb_lock:
+            if self._chunk_emb is None:
+                self._chunk_emb = self._emb_map if self._emb_map is not None else load_chunk_embeddings(self.store, self.emb_path)
+            return self._chunk_emb
+
+    def memory_bytes(self) -> int:
+        # Upper bound of this engine's index memory for the registry's budget: all loaded or mapped files, embeddings once used.
+        emb = self._chunk_emb
+        return self.index_bytes + (int(emb.nbytes) if emb is not None else 0)
+
+    def warm_up(self, queries: List[str]) -> None:
+        # Runs queries through retrieval before the engine takes traffic, so the index files are paged in and its cache is warm.
+        if queries:
+            self.retrieve_many(queries)
+
+    def encode(self, query: str) -> np.ndarray:
+        return self.encode_many([query])
+
+    def encode_many(self, queries: List[str]) -> np.ndarray:
+        # One encoder call for any number of queries, which lets sentence-transformers batch them.
+        return self.embedder.encode(queries, batch_size=BATCH_ENCODE_SIZE, convert_to_numpy=True, normalize_embeddings=True)
+
+    def search(self, q_vecs: np.ndarray, k: int) -> Tuple[str, np.ndarray, np.ndarray]:
+        # Searches all rows of q_vecs at once and returns (retriever used, scores, chunk IDs), one row per query.
+        if self.index is not None:
+            try:
+                scores, idxs = faiss_search(q_vecs, k, self.index)
+                return "faiss", scores, idxs
+            except Exception:
+                pass
+        print("FAISS search failed, falling back to numpy cosine search.", file=sys.stderr)
+        NUMPY_FALLBACKS.inc()
+        chunk_emb = self._fallback_embeddings()
+        results = [cosine_search(q_vecs[i:i + 1], chunk_emb, k) for i in range(len(q_vecs))]
+        scores = np.vstack([r[0] for r in results])
+        rows = np.vstack([r[1] for r in results])
+        # The embeddings file is stored in metadata order, so rows map to chunk IDs through self.chunk_ids.
+        return "numpy", scores, self.chunk_ids[rows]
+
+    def filter_rows(self, doc_filter: DocFilter) -> np.ndarray:
+        # The sorted store rows (in chunk ID order, so chunk_ids[rows] is sorted too) of the chunks of matching documents.
+        rows = self.filter_cache.get(doc_filter.key)
+        if rows is not None:
+            return rows
+        attrs = getattr(self.store, "doc_attrs", None)
+        if attrs is None and doc_filter.needs_attributes:
+            raise ValueError("This index has no document attributes to filter dates and tags on. Rebuild it to enable them.")
+        if self._doc_rows is None:
+            doc_ids = np.asarray(self.store.doc_ids(), dtype="int64")
+            order = np.argsort(doc_ids, kind="stable")
+            bounds = np.searchsorted(doc_ids[order], np.arange(len(self.store.sources) + 1))
+            self._doc_rows = (order, bounds)
+        order, bounds = self._doc_rows
+        docs = [d for d, name in enumerate(self.store.sources) if doc_filter.matches(name, attrs[d] if attrs else None)]
+        rows = np.sort(np.concatenate([order[bounds[d]:bounds[d + 1]] for d in docs])) if docs else np.zeros(0, dtype="int64")
+        self.filter_cache.put(doc_filter.key, rows)
+        return rows
+
+    def search_subset(self, q_vecs: np.ndarray, k: int, rows: np.ndarray) -> Tuple[str, np.ndarray, np.ndarray]:
+        # search() restricted to the given store rows: exactly from embeddings.npy if small, else FAISS with an ID selector.
+        k = min(k, len(rows))
+        if k == 0:
+            return "filtered", np.zeros((len(q_vecs), 0), dtype="float32"), np.zeros((len(q_vecs), 0), dtype="int64")
+        exact = len(rows) <= FILTER_EXACT_FRACTION * len(self.store) and os.path.exists(self.emb_path)
+        if self.index is not None and not exact:
+            try:
+                scores, idxs = faiss_search(q_vecs, k, self.index, ids=self.chunk_ids[rows])
+                return "faiss", scores, idxs
+            except Exception as ex:
+                print(f"Filtered FAISS search failed ({ex}), scanning the subset with numpy.", file=sys.stderr)
+        scores, hit_rows = subset_search(q_vecs, self._fallback_embeddings(), rows, k)
+        return "subset", scores, self.chunk_ids[hit_rows]
+
+    def _dense_scores(self, q_vec: np.ndarray, chunk_ids: List[int]) -> Optional[List[float]]:
+        # Cosine similarities of BM25-only candidates, read from embeddings.npy. None (candidates dropped) without that file.
+        try:
+            chunk_emb = self._fallback_embeddings()
+        except (OSError, ValueError):
+            return None
+        rows = np.searchsorted(self.chunk_ids, np.asarray(chunk_ids, dtype="int64"))
+        vecs = np.asarray(chunk_emb[rows], dtype="float32")
+        return [float(s) for s in vecs @ np.asarray(q_vec, dtype="float32").reshape(-1)]
+
+    def _lexical_hits(self, tokens: List[str], k: int, allowed: Optional[np.ndarray] = None, require_all: bool = False):
+        # BM25 top-k, or with `allowed` (sorted chunk IDs of a filtered search) the top-k among those.
+        if allowed is None:
+            return self.lexical.bm25(tokens, k, require_all=require_all)
+        ids, scores = self.lexical.bm25(tokens, len(self.store), require_all=require_all)
+        pos = np.minimum(np.searchsorted(allowed, ids), max(len(allowed) - 1, 0))
+        keep = np.flatnonzero(allowed[pos] == ids)[:k] if len(allowed) else np.zeros(0, dtype="int64")
+        return ids[keep], scores[keep]
+
+    def _hybrid_hits(self, query: str, q_vec: np.ndarray, idxs_row: List[int], sims_row: List[float], k: int, allowed: Optional[np.ndarray] = None):
+        # Adds the query's BM25 top-k to the dense hits: (ids, cosine scores, RRF score per ID). RRF only orders the kept documents.
+        dense = [(cid, sc) for cid, sc in zip(idxs_row, sims_row) if cid >= 0]
+        lex_ids, _ = self._lexical_hits(_query_tokens(query), k, allowed)
+        lex_ids = [int(c) for c in lex_ids]
+        if not lex_ids:
+            return idxs_row, sims_row, None
+        seen = {cid for cid, _ in dense}
+        extra = [cid for cid in lex_ids if cid not in seen]
+        extra_scores = self._dense_scores(q_vec, extra) if extra else []
+        if extra_scores is None:
+            extra, extra_scores = [], []
+            lex_ids = [cid for cid in lex_ids if cid in seen]
+        fused = rrf_fuse([[cid for cid, _ in dense], lex_ids])
+        return [cid for cid, _ in dense] + extra, [sc for _, sc in dense] + extra_scores, fused
+
+    def _filter_hits(self, query: str, idxs_row: List[int], sims_row: List[float], fused: Optional[Dict[int, float]] = None) -> List[Dict[str, Any]]:
+        # Per-document aggregation, relevance filtering and the lexical sanity check for one query's hits.
+        kept_docs = rank_documents(idxs_row, sims_row, self.store)
+        if fused:
+            kept_docs.sort(key=lambda d: -max(fused.get(c["id"], 0.0) for c in d["top_chunks"]))
+
+        if kept_docs:
+            top_doc = kept_docs[0]
+            if self.lexical is not None:
+                # Postings lookups over all of the top document's retrieved chunks, instead of scanning 600 characters of one.
+                toks = _query_tokens(query)
+                passes = not toks or self.lexical.has_any(toks, [c["id"] for c in top_doc["top_chunks"]])
+            else:
+                top_text = top_doc["top_chunks"][0]["text"] if top_doc["top_chunks"] else ""
+                passes = _passes_lexical_sanity(query, top_doc["name"], top_text)
+            if not passes:
+                kept_docs = []
+        return kept_docs
+
+    def _lexical_shortcut(self, query: str, allowed: Optional[np.ndarray] = None) -> Optional[List[Dict[str, Any]]]:
+        # kept_docs of an exact-term query from the inverted index alone, or None to use the dense path (also for weak matches).
+        if self.lexical is None or not LEXICAL_SHORTCUT:
+            return None
+        quoted = len(query) > 2 and query[0] == query[-1] == '"'
+        toks = _query_tokens(query)
+        if not toks or (not quoted and len(toks) != 1):
+            return None
+        if not quoted and self.lexical.df(toks[0]) > LEXICAL_SHORTCUT_MAX_DF * self.lexical.n_chunks:
+            return None
+        k = min(TOP_K, len(self.store))
+        phrase = tokenize(query)
+        if quoted and len(phrase) > 1:
+            # BM25 only knows that every word occurs, so the candidates are checked for the words next to each other, in order.
+            ids, scores = self._lexical_hits(toks, k * PHRASE_CANDIDATES, allowed, require_all=True)
+            keep = [j for j, cid in enumerate(ids) if _has_phrase(self.store[int(cid)]["text"], phrase)][:k]
+            ids, scores = ids[keep], scores[keep]
+        else:
+            ids, scores = self._lexical_hits(toks, k, allowed, require_all=True)
+        if not len(ids) or float(scores[0]) < LEXICAL_MIN_STRENGTH * sum(self.lexical.idf(t) for t in dict.fromkeys(toks)):
+            return None
+        # Scaled to the best hit for display. The cosine thresholds don't apply to BM25, only the relative cut does.
+        scaled = [float(s) / float(scores[0]) for s in scores]
+        return rank_documents(ids, scaled, self.store, min_top_sim=0.0, min_cand_sim=0.0)
+
+    def _retrieve_uncached(self, queries: List[str], doc_filter: Optional[DocFilter] = None) -> List[Dict[str, Any]]:
+        # Exact-term queries use the inverted index, the rest share one encode and search call and are fused with BM25 per query.
+        retrievals: List[Optional[Dict[str, Any]]] = [None] * len(queries)
+        rows = allowed = None
+        filter_timing: Dict[str, float] = {}
+        if doc_filter is not None:
+            with timed_stage(filter_timing, "rag", "doc_filter"):
+                rows = self.filter_rows(doc_filter)
+                allowed = self.chunk_ids[rows]
+        dense_positions = []
+        for i, query in enumerate(queries):
+            timing: Dict[str, float] = dict(filter_timing)
+            with timed_stage(timing, "rag", "lexical_shortcut"):
+                kept_docs = self._lexical_shortcut(query, allowed)
+            if kept_docs is None:
+                dense_positions.append(i)
+                retrievals[i] = {"timing": timing}
+            else:
+                LEXICAL_SHORTCUTS.inc()
+                retrievals[i] = {"q_vec": None, "retriever": "lexical", "score_kind": "bm25", "kept_docs": kept_docs, "timing": timing}
+        if not dense_positions:
+            return retrievals
+
+        batch_timing: Dict[str, float] = {}
+        with timed_stage(batch_timing, "rag", "encode"):
+            q_vecs = self.encode_many([queries[i] for i in dense_positions])
+        k = min(TOP_K, len(self.store))
+        with timed_stage(batch_timing, "rag", "search"):
+            used, scores, idxs = self.search(q_vecs, k) if rows is None else self.search_subset(q_vecs, k, rows)
+        hybrid = HYBRID and self.lexical is not None
+
+        for row, i in enumerate(dense_positions):
+            timing = retrievals[i]["timing"]
+            timing.update(batch_timing)
+            idxs_row = list(map(int, idxs[row]))
+            sims_row = [float(s) for s in scores[row]]
+            fused = None
+            if hybrid:
+                with timed_stage(timing, "rag", "bm25_fusion"):
+                    idxs_row, sims_row, fused = self._hybrid_hits(queries[i], q_vecs[row:row + 1], idxs_row, sims_row, k, allowed)
+            with timed_stage(timing, "rag", "filter"):
+                kept_docs = self._filter_hits(queries[i], idxs_row, sims_row, fused)
+            retrievals[i] = {"q_vec": q_vecs[row:row + 1], "retriever": f"{used}+bm25" if fused else used, "score_kind": "cosine",
+                             "kept_docs": kept_docs, "timing": timing}
+        return retrievals
+
+    def retrieve(self, query: str, doc_filter: Optional[DocFilter] = None) -> Tuple[Dict[str, Any], bool]:
+        # (retrieval result, came from cache). The result is shared with later requests, so callers must not modify it.
+        return self.retrieve_many([query], doc_filter)[0]
+
+    def retrieve_many(self, queries: List[str], doc_filter: Optional[DocFilter] = None) -> List[Tuple[Dict[str, Any], bool]]:
+        # Batch version of retrieve() with one doc filter for all queries. Cache misses share one encode and one search call.
+        filter_key = doc_filter.key if doc_filter is not None else ""
+        keys = [(normalize_query(q), self.index_version, filter_key) for q in queries]
+        out: List[Optional[Tuple[Dict[str, Any], bool]]] = [None] * len(queries)
+        misses: Dict[Any, List[int]] = {}
+        for i, key in enumerate(keys):
+            cached = self.retrieval_cache.get(key)
+            RETRIEVAL_CACHE_LOOKUPS.inc(result="miss" if cached is None else "hit")
+            if cached is not None:
+                out[i] = (cached, True)
+            else:
+                misses.setdefault(key, []).append(i)
+        if misses:
+            positions = list(misses.values())
+            fresh = self._retrieve_uncached([queries[p[0]] for p in positions], doc_filter)
+            for key, p, retrieval in zip(misses, positions, fresh):
+                self.retrieval_cache.put(key, retrieval)
+                for i in p:
+                    out[i] = (retrieval, False)
+        return out
+
+    def _answer_key(self, mode: str, kept_docs: List[Dict[str, Any]]):
+        # Everything the LLM's answer depends on besides the query itself: the retrieved chunks build_contexts packs from, the mode, model and index.
+        return answer_key(mode, SYNTH_MODEL, self.index_version, [c["id"] for d in kept_docs[:CONTEXT_MAX_DOCS] for c in d["top_chunks"]])
+
+    def _cached_answer(self, query: str, mode: str, retrieval: Dict[str, Any], timing: Optional[Dict[str, float]] = None) -> Tuple[Optional[str], Optional[str]]:
+        # Returns (cached LLM answer or None, "hit"/"miss", or None while the answer cache is turned off).
+        if self.answer_cache is None:
+            return None, None
+        with timed_stage(timing, "rag", "answer_cache"):
+            cached = self.answer_cache.get(self._answer_key(mode, retrieval["kept_docs"]), query, retrieval["q_vec"])
+        ANSWER_CACHE_LOOKUPS.inc(result="miss" if cached is None else "hit")
+        return cached, "miss" if cached is None else "hit"
+
+    def _store_answer(self, query: str, mode: str, retrieval: Dict[str, Any], llm_answer: str) -> None:
+        # Only real LLM answers are stored, never the extractive fallback.
+        if self.answer_cache is not None and llm_answer:
+            self.answer_cache.put(self._answer_key(mode, retrieval["kept_docs"]), query, retrieval["q_vec"], llm_answer)
+
+    def _generate(self, query: str, mode: str, retrieval: Dict[str, Any], timing: Optional[Dict[str, float]] = None) -> Tuple[str, Optional[str]]:
+        # Prompt building and the (blocking) LLM call with answer cache, extractive fallback and citations. Returns (answer, cache result).
+        llm_answer, answer_cache = "", None
+        with timed_stage(timing, "rag", "build_prompt"):
+            contexts_used = build_contexts(retrieval["kept_docs"])
+            prompt = build_prompt(query, contexts_used) if contexts_used else ""
+        if contexts_used:
+            cached, answer_cache = self._cached_answer(query, mode, retrieval, timing)
+            if cached is not None:
+                llm_answer = cached
+            else:
+                with timed_stage(timing, "rag", "llm"):
+                    llm_answer = _ollama_generate(SYNTH_MODEL, prompt, num_predict=NUM_PREDICT_DETAILED if mode == "detailed" else NUM_PREDICT_BULLETS,
+                                                  system=prompt_header(mode)) or ""
+                self._store_answer(query, mode, retrieval, llm_answer.strip())
+
+            if not llm_answer.strip():
+                EXTRACTIVE_FALLBACKS.inc()
+                llm_answer = extractive_fallback(contexts_used[0]["snippet"], mode)
+
+            if llm_answer.strip():
+                llm_answer = f"{llm_answer}\n\nSources: {format_citations(contexts_used, retrieval.get('score_kind', 'cosine'))}"
+        return llm_answer, answer_cache
+
+    def answer(self, query: str, mode: str = OUTPUT_MODE, doc_filter: Optional[DocFilter] = None) -> Dict[str, Any]:
+        # Returns the same JSON-ready result dict that the CLI prints.
+        return self.answer_many([query], mode, doc_filter)[0]
+
+    def answer_many(self, queries: List[str], mode: str = OUTPUT_MODE, doc_filter: Optional[DocFilter] = None) -> List[Dict[str, Any]]:
+        """
+        Answers a batch of queries and returns one result per query, in order. Retrieval for the whole batch
+        is one encoder call and one multi-row index search; LLM generation (if requested) still runs per query.
+        With a doc_filter, only documents matching it are searched.
+        """
+        t0 = time.time()
+        mode = (mode or "none").lower()
+        queries = [(q or "").strip() for q in queries]
+        valid = [q for q in queries if q]
+        retrieved = iter(self.retrieve_many(valid, doc_filter) if valid else [])
+
+        results = []
+        for query in queries:
+            if not query:
+                results.append({"error": "No query provided."})
+                continue
+            retrieval, cache_hit = next(retrieved)
+            QUERIES.inc(mode=mode)
+            abstained = ENABLE_ABSTAIN and (len(retrieval["kept_docs"]) == 0)
+            if abstained:
+                ABSTENTIONS.inc()
+            # Retrieval stage timings only describe this request when it wasn't served from the cache.
+            timing: Dict[str, Any] = {} if cache_hit else dict(retrieval.get("timing") or {})
+            llm_answer, answer_cache = "", None
+            if not abstained and mode in ("bulleted", "detailed"):
+                llm_answer, answer_cache = self._generate(query, mode, retrieval, timing)
+            if len(queries) > 1:
+                timing["batch_size"] = len(queries)
+            results.append(self._build_result(query, mode, retrieval, cache_hit, abstained, llm_answer, t0, timing, answer_cache, doc_filter))
+        return results
+
+    def _build_result(self, query: str, mode: str, retrieval: Dict[str, Any], cache_hit: bool, abstained: bool, llm_answer: str, t0: float, timing: Optional[Dict[str, Any]] = None,
+                      answer_cache: Optional[str] = None, doc_filter: Optional[DocFilter] = None) -> Dict[str, Any]:
+        # Build the structured result object for downstream code
+        kept_docs = retrieval["kept_docs"]
+        sources = [{"name": d["name"], "score": d["score"]} for d in kept_docs[:3]]
+        timing_stats = {"total_sec": round(time.time() - t0, 3)}
+        timing_stats.update(timing or {})
+        return {
+            "version": VERSION, "query": query, "retriever": retrieval["retriever"], "abstained": abstained,
+            "abstain_message": ABSTAIN_MESSAGE,
+            "relevant_docs": [{"name": d["name"], "chunk": d["top_chunks"][0]["chunk"] if d["top_chunks"] else 0, "score": d["score"]} for d in kept_docs],
+            "llm_answer": llm_answer, "sources": sources, "score_kind": retrieval.get("score_kind", "cosine"), "output_mode": mode,
+            "retrieval_cache": "hit" if cache_hit else "miss",
+            "answer_cache": answer_cache,
+            "filter": doc_filter.key if doc_filter is not None else None,
+            "timing_stats": timing_stats
+        }
+
+    def stream_answer(self, query: str, mode: str = "detailed", doc_filter: Optional[DocFilter] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Streaming counterpart of answer(). Yields events as dicts: "sources" once retrieval is done,
+        "token" for each piece of the LLM answer, "citations" at the end, and a final "done" event
+        carrying the full result (the same shape answer() returns, with time_to_first_token_sec added).
+        """
+        t0 = time.time()
+        query = (query or "").strip()
+        mode = (mode or "detailed").lower()
+        if not query:
+            yield {"event": "error", "error": "No query provided."}
+            return
+
+        retrieval, cache_hit = self.retrieve(query, doc_filter)
+        QUERIES.inc(mode=mode)
+        kept_docs = retrieval["kept_docs"]
+        abstained = ENABLE_ABSTAIN and (len(kept_docs) == 0)
+        if abstained:
+            ABSTENTIONS.inc()
+        timing: Dict[str, Any] = {} if cache_hit else dict(retrieval.get("timing") or {})
+        with timed_stage(timing, "rag", "build_prompt"):
+            contexts_used = build_contexts(kept_docs) if not abstained and mode in ("bulleted", "detailed") else []
+            prompt = build_prompt(query, contexts_used) if contexts_used else ""
+        yield {"event": "sources", "abstained": abstained, "score_kind": retrieval.get("score_kind", "cosine"),
+               "sources": [{"name": d["name"], "score": d["score"]} for d in kept_docs[:3]]}
+
+        llm_answer, cached, answer_cache = "", None, None
+        if contexts_used:
+            cached, answer_cache = self._cached_answer(query, mode, retrieval, timing)
+        if cached is not None:
+            # A cached answer goes out as a single piece.
+            llm_answer = cached
+            timing["time_to_first_token_sec"] = round(time.time() - t0, 3)
+            yield {"event": "token", "text": llm_answer}
+        elif contexts_used:
+            pieces = []
+            # Only the time spent waiting on the LLM is counted, not the time the client takes to read each piece.
+            llm_sec = 0.0
+            complete = False
+            stream = _ollama_generate_stream(SYNTH_MODEL, prompt, num_predict=NUM_PREDICT_DETAILED if mode == "detailed" else NUM_PREDICT_BULLETS,
+                                             system=prompt_header(mode))
+            while True:
+                t_llm = time.perf_counter()
+                try:
+                    piece = next(stream)
+                except StopIteration as stop:
+                    complete = bool(stop.value)
+                    break
+                finally:
+                    llm_sec += time.perf_counter() - t_llm
+                if not pieces:
+                    timing["time_to_first_token_sec"] = round(time.time() - t0, 3)
+                pieces.append(piece)
+                yield {"event": "token", "text": piece}
+            timing["llm_sec"] = round(llm_sec, 4)
+            STAGE_SECONDS.observe(llm_sec, component="rag", stage="llm")
+            llm_answer = "".join(pieces).strip()
+            # An answer cut off by the deadline is shown but not cached.
+            if complete:
+                self._store_answer(query, mode, retrieval, llm_answer)
+
+            if not llm_answer:
+                EXTRACTIVE_FALLBACKS.inc()
+                llm_answer = extractive_fallback(contexts_used[0]["snippet"], mode)
+                if llm_answer:
+                    timing["time_to_first_token_sec"] = round(time.time() - t0, 3)
+                    yield {"event": "token", "text": llm_answer}
+
+        if contexts_used and llm_answer:
+            citations = format_citations(contexts_used, retrieval.get("score_kind", "cosine"))
+            yield {"event": "citations", "text": f"Sources: {citations}"}
+            llm_answer = f"{llm_answer}\n\nSources: {citations}"
+
+        yield {"event": "done", "result": self._build_result(query, mode, retrieval, cache_hit, abstained, llm_answer, t0, timing, answer_cache, doc_filter)}
+
+def read_batch_queries(path: str, field: str = BATCH_FIELD) -> Iterator[Tuple[Any, str]]:
+    # Yields (id, query) pairs from a JSONL file of JSON objects (query in `field`, "query" or "title") or plain lines. "-" reads stdin.
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                obj = line
+            if isinstance(obj, dict):
+                query = obj.get(field) or obj.get("query") or obj.get("title") or ""
+                yield obj.get("id", obj.get("request_id", line_no)), str(query)
+            else:
+                yield line_no, str(obj)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def run_batch(engine: "RagEngine", path: str, mode: str = OUTPUT_MODE, batch_size: int = BATCH_SIZE, doc_filter: Optional[DocFilter] = None) -> None:
+    # Answers every query of a JSONL file and prints one JSON result per line, `batch_size` queries per encode/search call.
+    def flush(items):
+        for (item_id, _), result in zip(items, engine.answer_many([q for _, q in items], mode, doc_filter)):
+            result["id"] = item_id
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+
+    items: List[Tuple[Any, str]] = []
+    for item in read_batch_queries(path):
+        items.append(item)
+        if len(items) >= batch_size:
+            flush(items)
+            items = []
+    if items:
+        flush(items)
+
 def main():
-    # This is the entry point for the script. This Parses the user's query, runs retrieval, relevance filtering, and (optionally) LLM synthesis, then prints a JSON result if AS_JSON is enabled.
-    t0 = time.time()
+    # This is the entry point for the script. It builds a RagEngine and answers the query from sys.argv, or every query of a "--batch <file.jsonl>".
+    batch_path = sys.argv[2] if len(sys.argv) >= 3 and sys.argv[1] == "--batch" else None
     query = " ".join(sys.argv[1:]).strip()
     if not query:
         if AS_JSON:
@@ -201,72 +897,13 @@ def main():
     # Helpful for reviewing index file    
     print(f"Querying with DOCS_DIR='{DOCS_DIR}', using INDEX_DIR='{INDEX_DIR}'", file=sys.stderr)
 
-    meta = load_meta()
-    meta_list = meta["metadata"]
-    embedder = SentenceTransformer(EMBED_MODEL)
-
-    q_vec = embedder.encode([query], convert_to_numpy=True, normalize_embeddings=True)
-    k = min(TOP_K, len(meta_list))
-    used = "faiss"
-    try:
-        scores, idxs = faiss_search(q_vec, k)
-    except Exception:
-        print("FAISS search failed, falling back to numpy cosine search.", file=sys.stderr)
-        used = "numpy"
-        chunk_emb = ensure_chunk_embeddings(embedder, meta)
-        scores, idxs = cosine_search(q_vec, chunk_emb, k)
-
-    idxs_row = list(map(int, idxs[0]))
-    sims_row = [float(s) for s in scores[0]]
-
-    agg = aggregate_by_document(idxs_row, sims_row, meta_list)
-    kept_docs = simple_relevance_filter(agg)
-
-    if kept_docs:
-        top_doc = kept_docs[0]
-        top_text = top_doc["top_chunks"][0]["text"] if top_doc["top_chunks"] else ""
-        if not _passes_lexical_sanity(query, top_doc["name"], top_text):
-            kept_docs = []
-
-    abstained = ENABLE_ABSTAIN and (len(kept_docs) == 0)
-    llm_answer = ""
-    contexts_used: List[Dict[str, Any]] = []
-
-    if not abstained and OUTPUT_MODE in ("bulleted", "detailed"):
-        contexts_used = []
-        max_docs_for_prompt = 3
-        max_snippet_chars = 600
-        for doc in kept_docs[:max_docs_for_prompt]:
-            top_chunk = doc["top_chunks"][0] if doc["top_chunks"] else {"text": ""}
-            snippet = re.sub(r"\s+", " ", (top_chunk.get("text") or "").strip())
-            if len(snippet) > max_snippet_chars:
-                cut = snippet.rfind(". ", 0, max_snippet_chars)
-                snippet = snippet[:cut + 1] if cut > 80 else snippet[:max_snippet_chars]
-            contexts_used.append({"name": doc["name"], "score": doc["score"], "snippet": snippet})
-
-        if contexts_used:
-            prompt = build_prompt(query, contexts_used, OUTPUT_MODE)
-            llm_answer = _ollama_generate(SYNTH_MODEL, prompt, num_predict=NUM_PREDICT_DETAILED if OUTPUT_MODE == "detailed" else NUM_PREDICT_BULLETS) or ""
+    doc_filter = parse_filter(DOC_FILTER)
+    engine = RagEngine(DOCS_DIR, INDEX_DIR)
+    if batch_path:
+        run_batch(engine, batch_path, OUTPUT_MODE, doc_filter=doc_filter)
+        return
 
-            if not llm_answer.strip():
-                top_text = contexts_used[0]["snippet"]
-                llm_answer = extractive_fallback(top_text, OUTPUT_MODE)
-
-            if llm_answer.strip() and contexts_used:
-                # Create a citation string from the top 3 sources used for the answer
-                top_sources_for_citation = contexts_used[:3]
-                citations = ", ".join([f"({s['name']}, {s['score']:.3f})" for s in top_sources_for_citation])
-                llm_answer = f"{llm_answer}\n\nSources: {citations}"
-
-    # Build the structured result object for downstream code
-    sources = [{"name": d["name"], "score": d["score"]} for d in kept_docs[:3]]
-    result = {
-        "version": VERSION, "query": query, "retriever": used, "abstained": abstained,
-        "abstain_message": "Sorry, the provided documents do not contain information on this topic.",
-        "relevant_docs": [{"name": d["name"], "chunk": d["top_chunks"][0]["chunk"] if d["top_chunks"] else 0, "score": d["score"]} for d in kept_docs],
-        "llm_answer": llm_answer, "sources": sources, "output_mode": OUTPUT_MODE,
-        "timing_stats": {"total_sec": round(time.time() - t0, 2)}
-    }
+    result = engine.answer(query, OUTPUT_MODE, doc_filter)
 
     if AS_JSON:
         print(json.dumps(result, ensure_ascii=False))
@@ -280,4 +917,4 @@ if __name__ == "__main__":
         else:
             print("Fatal error:", ex, file=sys.stderr)
             traceback.print_exc()
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -3,10 +3,18 @@
 import os
 import re
 import json
-from typing import List, Tuple
+import hashlib
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
+
+from chunk_store import ChunkStoreWriter, has_chunk_store, has_doc_attributes, open_chunk_store
+from doc_filters import document_attributes
+from index_versions import is_versioned
+from lexical_index import build_lexical_index, has_lexical_index
 
 try:
     import faiss
@@ -18,13 +26,46 @@ except ImportError:
 # The script reads its configuration from environment variables,allowing it to be controlled by the build_all_indexes.py script.
 DOCS_DIR = os.environ.get("RAG_DOCS_DIR", "docs")
 INDEX_DIR = os.environ.get("RAG_INDEX_DIR", "index")
+EMBED_MODEL = os.environ.get("RAG_EMBED_MODEL", "BAAI/bge-small-en-v1.5")
+# Chunking: "tokens" packs sentences into chunks within the model's token limit, "words" is the old CHUNK_SIZE-word window.
+CHUNKER = os.environ.get("RAG_CHUNKER", "tokens").lower()
+CHUNKERS = ("tokens", "words")
+# The model's limit including the special tokens it adds ([CLS], [SEP]). bge-small-en-v1.5 takes 512.
+CHUNK_TOKENS = int(os.environ.get("RAG_CHUNK_TOKENS", "512"))
+# A heading only closes the current chunk once it holds this many tokens, so very short sections are merged with the next one.
+CHUNK_MIN_TOKENS = int(os.environ.get("RAG_CHUNK_MIN_TOKENS", "64"))
+# Whole sentences repeated at the start of the next chunk. Chunks end at sentence boundaries, so none are needed by default.
+CHUNK_OVERLAP_SENTENCES = int(os.environ.get("RAG_CHUNK_OVERLAP_SENTENCES", "0"))
 CHUNK_SIZE = int(os.environ.get("RAG_CHUNK_SIZE", 300))
 CHUNK_OVERLAP = int(os.environ.get("RAG_CHUNK_OVERLAP", 60))
-EMBED_MODEL = os.environ.get("RAG_EMBED_MODEL", "BAAI/bge-small-en-v1.5")
+# Ingestion pipeline knobs: chunking worker processes, chunks embedded per step and the encoder's batch size.
+INDEX_WORKERS = int(os.environ.get("RAG_INDEX_WORKERS", str(os.cpu_count() or 1)))
+INGEST_BATCH = int(os.environ.get("RAG_INGEST_BATCH", "2048"))
+EMBED_BATCH = int(os.environ.get("RAG_EMBED_BATCH", "64"))
+# FAISS index type: "flat" (exact), "ivf", "hnsw" or "ivfpq" (compressed, for memory-constrained machines).
+INDEX_TYPE = os.environ.get("RAG_INDEX_TYPE", "flat").lower()
+IVF_NLIST = int(os.environ.get("RAG_IVF_NLIST", "256"))
+IVF_NPROBE = int(os.environ.get("RAG_IVF_NPROBE", "16"))
+HNSW_M = int(os.environ.get("RAG_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("RAG_HNSW_EF_CONSTRUCTION", "80"))
+HNSW_EF_SEARCH = int(os.environ.get("RAG_HNSW_EF_SEARCH", "64"))
+PQ_M = int(os.environ.get("RAG_PQ_M", "16"))
+PQ_NBITS = int(os.environ.get("RAG_PQ_NBITS", "8"))
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq")
 
 # Defining paths based on the dynamic INDEX_DIR
 INDEX_PATH = os.path.join(INDEX_DIR, "faiss.index")
+# Chunk metadata lives in a compact binary store (chunks.bin + chunks.txt + sources.json). meta.json is only read from older builds.
 META_PATH = os.path.join(INDEX_DIR, "meta.json")
+# The manifest remembers a content hash for every document and chunk, so a rebuild only embeds what actually changed.
+MANIFEST_PATH = os.path.join(INDEX_DIR, "manifest.json")
+# The index type and its search-time parameters (nprobe, efSearch) are stored next to the index and applied when it is loaded.
+INDEX_PARAMS_PATH = os.path.join(INDEX_DIR, "index_params.json")
+# All chunk vectors in chunk-ID order, for the numpy fallback at query time. float16 halves its size.
+EMB_PATH = os.path.join(INDEX_DIR, "embeddings.npy")
+EMB_DTYPE = os.environ.get("RAG_EMB_DTYPE", "float32")
+EMB_WRITE_BLOCK = 65536
+MANIFEST_VERSION = 1
 
 SUPPORTED_EXTS = {".txt", ".md", ".markdown"}
 
@@ -65,12 +106,17 @@ def clean_markdown(md_text: str) -> str:
     return text
 
 def load_and_clean(path: str) -> str:
+    return clean_text(path, read_text_file(path))
+
+def clean_text(path: str, raw: str) -> str:
     ext = os.path.splitext(path)[1].lower()
-    raw = read_text_file(path)
     if ext in {".md", ".markdown"}:
         return clean_markdown(raw)
     return raw
 
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
 def chunk_text(text: str, chunk_size_words: int, overlap_words: int) -> List[Tuple[str, int]]:
     words = text.split()
     chunks = []
@@ -87,18 +133,397 @@ def chunk_text(text: str, chunk_size_words: int, overlap_words: int) -> List[Tup
         start = max(0, end - overlap_words)
     return chunks
 
-def build_index(embeddings: np.ndarray):
-    """This function takes the numpy array of embeddings and builds the FAISS index."""
+_tokenizer = None
+
+def load_tokenizer(model_name: str = EMBED_MODEL):
+    """
+    The embedding model's fast tokenizer, loaded once per process. It comes from the `tokenizers` package,
+    so the worker processes that chunk documents still never import torch.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        from tokenizers import Tokenizer
+        tokenizer = Tokenizer.from_pretrained(model_name)
+        tokenizer.no_truncation()
+        tokenizer.no_padding()
+        _tokenizer = tokenizer
+    return _tokenizer
+
+def resolve_chunker(chunker: str = CHUNKER) -> str:
+    # The token chunker needs the tokenizer (downloaded with the model). Without it the build falls back to word windows.
+    if chunker == "tokens":
+        try:
+            load_tokenizer()
+        except Exception as ex:
+            print(f"Warning: could not load the tokenizer of '{EMBED_MODEL}' ({ex}), chunking by words instead.")
+            return "words"
+    return chunker
+
+HEADING_RE = re.compile(r"^\s{0,3}#{1,6}\s")
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+def document_blocks(raw: str, markdown: bool) -> Iterator[Tuple[bool, str]]:
+    """
+    Yields (is_heading, text) for every heading and paragraph of a document in one pass over its lines, before anything is flattened.
+    Front matter and fenced code are skipped, the same parts clean_markdown drops.
+    """
+    lines = raw.splitlines()
+    start = 0
+    if markdown and lines and lines[0].strip() == "---":
+        end = next((i for i in range(1, len(lines)) if lines[i].strip() == "---"), None)
+        start = end + 1 if end is not None else 0
+    paragraph: List[str] = []
+    in_fence = False
+    for line in lines[start:]:
+        if markdown and line.lstrip().startswith("```"):
+            in_fence = not in_fence
+            continue
+        if in_fence:
+            continue
+        if markdown and HEADING_RE.match(line):
+            if paragraph:
+                yield False, "\n".join(paragraph)
+                paragraph = []
+            yield True, line
+        elif not line.strip():
+            if paragraph:
+                yield False, "\n".join(paragraph)
+                paragraph = []
+        else:
+            paragraph.append(line)
+    if paragraph:
+        yield False, "\n".join(paragraph)
+
+def block_sentences(text: str, markdown: bool) -> List[str]:
+    # Lines stay apart (list items rarely end with a full stop), then each line is split at sentence ends.
+    cleaned = clean_markdown(text) if markdown else text
+    sentences = []
+    for line in cleaned.split("\n"):
+        for s in SENTENCE_RE.split(line):
+            s = " ".join(s.split())
+            if s:
+                sentences.append(s)
+    return sentences
+
+def chunk_by_tokens(raw: str, markdown: bool, max_tokens: int = CHUNK_TOKENS, min_tokens: int = CHUNK_MIN_TOKENS,
+                    overlap_sentences: int = CHUNK_OVERLAP_SENTENCES) -> List[Tuple[str, int]]:
+    """
+    Packs whole sentences into chunks of at most `max_tokens` model tokens (special tokens included), in a single pass.
+    A chunk ends where the next sentence wouldn't fit, or at a heading once it has `min_tokens`. A sentence longer than
+    the limit on its own is cut at token boundaries. Returns (chunk text, start word) pairs like chunk_text.
+    The tokenizer splits on whitespace before word pieces, so the tokens of the joined sentences are the sum of their own.
+    """
+    tokenizer = load_tokenizer()
+    budget = max_tokens - len(tokenizer.encode("", add_special_tokens=True).ids)
+    chunks: List[Tuple[str, int]] = []
+    current: List[Tuple[str, int, int]] = []   # (sentence, tokens, start word)
+    current_tokens = 0
+    carried = 0                                  # leading sentences that were repeated from the previous chunk
+    words = 0
+
+    def flush():
+        nonlocal current, current_tokens, carried
+        if len(current) > carried:
+            chunks.append((" ".join(s for s, _, _ in current), current[0][2]))
+            keep = current[len(current) - overlap_sentences:] if overlap_sentences > 0 else []
+            # Overlap only makes sense while it leaves most of the next chunk for new text.
+            if sum(n for _, n, _ in keep) > budget // 2:
+                keep = []
+            current, carried = keep, len(keep)
+            current_tokens = sum(n for _, n, _ in keep)
+
+    def add(sentence: str, n: int, start_word: int):
+        nonlocal current_tokens, carried, current
+        if current_tokens + n > budget:
+            if len(current) > carried:
+                flush()
+            if current_tokens + n > budget:
+                current, current_tokens, carried = [], 0, 0
+        current.append((sentence, n, start_word))
+        current_tokens += n
+
+    for is_heading, block in document_blocks(raw, markdown):
+        if is_heading and current_tokens >= min_tokens:
+            flush()
+        sentences = block_sentences(block, markdown)
+        if not sentences:
+            continue
+        for sentence, enc in zip(sentences, tokenizer.encode_batch(sentences, add_special_tokens=False)):
+            n = len(enc.ids)
+            if n <= budget:
+                add(sentence, n, words)
+            else:
+                # Cut at word starts along the token offsets, filling the current chunk first, so every piece fits and no text is lost.
+                a = 0
+                while a < n:
+                    room = budget - current_tokens
+                    cut = min(n, a + room)
+                    while a < cut < n and enc.word_ids[cut] == enc.word_ids[cut - 1]:
+                        cut -= 1
+                    if cut == a:
+                        if len(current) > carried:
+                            flush()
+                            continue
+                        # A single word longer than the whole limit is cut inside the word.
+                        current, current_tokens, carried = [], 0, 0
+                        cut = min(n, a + budget)
+                    lo, hi = enc.offsets[a][0], enc.offsets[cut - 1][1]
+                    add(sentence[lo:hi], cut - a, words + len(sentence[:lo].split()))
+                    a = cut
+            words += len(sentence.split())
+    flush()
+    return chunks
+
+def chunk_document(path: str, raw: str, chunker: str = CHUNKER) -> List[Tuple[str, int]]:
+    """Chunks a document's raw text with the configured chunker. Returns (chunk text, start word) pairs."""
+    if chunker == "words":
+        return chunk_text(clean_text(path, raw), chunk_size_words=CHUNK_SIZE, overlap_words=CHUNK_OVERLAP)
+    markdown = os.path.splitext(path)[1].lower() in {".md", ".markdown"}
+    return chunk_by_tokens(raw, markdown)
+
+def index_settings(chunker: str = CHUNKER) -> dict:
+    """Settings that change the vectors, the chunk boundaries or the index structure. If any of them differ from the manifest, everything is rebuilt."""
+    if chunker == "words":
+        chunking = {"chunker": "words", "chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP}
+    else:
+        chunking = {"chunker": "tokens", "chunk_tokens": CHUNK_TOKENS, "chunk_min_tokens": CHUNK_MIN_TOKENS,
+                    "chunk_overlap_sentences": CHUNK_OVERLAP_SENTENCES}
+    return {"embed_model": EMBED_MODEL, **chunking, "index_type": INDEX_TYPE}
+
+def training_size(index_type: str = INDEX_TYPE, nlist: int = IVF_NLIST, pq_nbits: int = PQ_NBITS) -> int:
+    """How many vectors an index type wants to see before its first add (FAISS recommends ~39 per centroid)."""
+    if index_type == "ivf":
+        return nlist * 39
+    if index_type == "ivfpq":
+        return max(nlist, 2 ** pq_nbits) * 39
+    return 0
+
+def new_index(d: int, train_vectors: np.ndarray, index_type: str = INDEX_TYPE, nlist: int = IVF_NLIST,
+              hnsw_m: int = HNSW_M, ef_construction: int = HNSW_EF_CONSTRUCTION, pq_m: int = PQ_M, pq_nbits: int = PQ_NBITS):
+    """
+    Creates an empty, trained index of the requested type that supports add_with_ids. All types use inner product,
+    which equals cosine similarity for our normalized vectors. When there are too few vectors to train the requested type
+    (e.g. a tiny corpus), it falls back to a flat index rather than failing.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}'. Choose one of: {', '.join(INDEX_TYPES)}.")
+    n = len(train_vectors)
+    if index_type in ("ivf", "ivfpq"):
+        nlist = max(1, min(nlist, n // 39))
+        if index_type == "ivfpq" and (n < 2 ** pq_nbits or d % pq_m != 0):
+            print(f"Warning: IVF-PQ needs at least {2 ** pq_nbits} training vectors and a dimension divisible by {pq_m}, building a flat index instead.")
+            index_type = "flat"
+        elif nlist < 2:
+            print(f"Warning: only {n} vectors, too few to train IVF, building a flat index instead.")
+            index_type = "flat"
+
+    if index_type == "flat":
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(d))
+    if index_type == "hnsw":
+        # HNSW keeps no IDs of its own and can't delete, so it is wrapped in an ID map and rebuilt when chunks are removed.
+        hnsw = faiss.IndexHNSWFlat(d, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = ef_construction
+        return faiss.IndexIDMap2(hnsw)
+    # IVF indexes store IDs in their inverted lists and support remove_ids natively.
+    quantizer = faiss.IndexFlatIP(d)
+    if index_type == "ivf":
+        index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.IndexIVFPQ(quantizer, d, nlist, pq_m, pq_nbits, faiss.METRIC_INNER_PRODUCT)
+    index.train(train_vectors)
+    return index
+
+def index_type_of(index) -> str:
+    """Names the structure of a built index, which may differ from INDEX_TYPE after a fallback to flat."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    if isinstance(index, faiss.IndexIDMap):
+        return "hnsw" if isinstance(faiss.downcast_index(index.index), faiss.IndexHNSW) else "flat"
+    return "flat"
+
+def search_params_for(index_type: str, nprobe: int = IVF_NPROBE, ef_search: int = HNSW_EF_SEARCH) -> dict:
+    """Search-time parameters, named as faiss.ParameterSpace expects them."""
+    if index_type in ("ivf", "ivfpq"):
+        return {"nprobe": nprobe}
+    if index_type == "hnsw":
+        return {"efSearch": ef_search}
+    return {}
+
+def build_index(embeddings: np.ndarray, ids: np.ndarray):
+    """
+    This function takes the numpy array of embeddings and builds an ID-mapped FAISS index of the configured type,
+    so single chunks can later be removed or added without touching the rest.
+    """
     if faiss is None:
         print("Error: faiss-cpu is not installed. Cannot build FAISS index.")
         raise RuntimeError("faiss-cpu not installed.")
     d = embeddings.shape[1]
-    index = faiss.IndexFlatIP(d)  # IP for Inner Product, equivalent to Cosine with normalized vectors
-    index.add(embeddings)
-    faiss.write_index(index, INDEX_PATH)
+    index = new_index(d, embeddings)
+    index.add_with_ids(embeddings, ids)
+    return index
+
+def remove_from_index(index, ids: np.ndarray):
+    """Removes vectors by ID and returns the index to keep using (HNSW can't delete, so it's rebuilt from its remaining vectors)."""
+    if index_type_of(index) != "hnsw":
+        index.remove_ids(ids)
+        return index
+    keep = np.setdiff1d(faiss.vector_to_array(index.id_map), ids)
+    vectors = np.vstack([index.reconstruct(int(i)) for i in keep]) if len(keep) else np.zeros((0, index.d), dtype="float32")
+    rebuilt = new_index(index.d, vectors, "hnsw")
+    if len(keep):
+        rebuilt.add_with_ids(vectors, keep.astype("int64"))
+    return rebuilt
+
+def write_index(index) -> None:
+    # Writing to a temporary file first, so a crash mid-write never leaves a truncated index behind.
+    tmp_path = INDEX_PATH + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, INDEX_PATH)
+    index_type = index_type_of(index)
+    params = {"type": index_type, "ntotal": int(index.ntotal), "search_params": search_params_for(index_type)}
+    if index_type in ("ivf", "ivfpq"):
+        params["nlist"] = int(faiss.extract_index_ivf(index).nlist)
+    write_json(INDEX_PARAMS_PATH, params, indent=2)
+
+def write_json(path: str, obj: dict, indent: Optional[int] = None) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_path, path)
+
+def load_old_embeddings(old_meta) -> Tuple[Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray]]:
+    """Memory-maps the previous embeddings.npy. Returns (vectors, sorted ids, row of each sorted id), or Nones if it doesn't match the old store."""
+    if not old_meta or not os.path.exists(EMB_PATH):
+        return None, None, None
+    try:
+        emb = np.load(EMB_PATH, mmap_mode="r")
+    except Exception:
+        return None, None, None
+    if emb.ndim != 2 or emb.shape[0] != len(old_meta):
+        return None, None, None
+    old_ids = np.asarray(old_meta.ids(), dtype="int64")
+    order = np.argsort(old_ids, kind="stable")
+    return emb, old_ids[order], order
+
+def reconstruct_vectors(index, ids: np.ndarray) -> np.ndarray:
+    """Reads stored vectors back out of the index by chunk ID. IVF indexes need a direct map (by ID, since IDs have gaps) for that."""
+    inner = faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexIVF) and inner.direct_map.type == faiss.DirectMap.NoMap:
+        inner.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return np.vstack([index.reconstruct(int(i)) for i in ids])
+
+def write_embeddings(chunk_ids: np.ndarray, new_ids: np.ndarray, new_vec_path: str, dim: int, old_meta, index, out_path: str = EMB_PATH) -> bool:
+    """
+    Writes embeddings.npy (to out_path) with one row per chunk ID (ascending, the same order as the chunk store), block by block.
+    Newly embedded vectors come from this run's spill file, unchanged ones from the previous embeddings.npy,
+    or from the FAISS index when there is no previous file. Returns False if some vectors couldn't be recovered.
+    """
+    new_order = np.argsort(new_ids, kind="stable")
+    sorted_new = new_ids[new_order]
+    new_vecs = np.memmap(new_vec_path, dtype="float32", mode="r", shape=(len(new_ids), dim)) if len(new_ids) else None
+    old_emb, old_sorted, old_rows = load_old_embeddings(old_meta)
+
+    tmp_path = out_path + ".tmp.npy"
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=EMB_DTYPE, shape=(len(chunk_ids), dim))
+    try:
+        for start in range(0, len(chunk_ids), EMB_WRITE_BLOCK):
+            ids = chunk_ids[start:start + EMB_WRITE_BLOCK]
+            block = np.empty((len(ids), dim), dtype="float32")
+            pos = np.minimum(np.searchsorted(sorted_new, ids), max(0, len(sorted_new) - 1))
+            is_new = (sorted_new[pos] == ids) if len(sorted_new) else np.zeros(len(ids), dtype=bool)
+            if is_new.any():
+                block[is_new] = new_vecs[new_order[pos[is_new]]]
+            old_ids = ids[~is_new]
+            if len(old_ids):
+                if old_emb is not None:
+                    block[~is_new] = old_emb[old_rows[np.searchsorted(old_sorted, old_ids)]]
+                elif index is not None:
+                    block[~is_new] = reconstruct_vectors(index, old_ids)
+                else:
+                    raise RuntimeError("no source for unchanged vectors")
+            out[start:start + len(ids)] = block
+        out.flush()
+    except Exception as ex:
+        del out
+        os.remove(tmp_path)
+        # The previous file is kept if its rows still are exactly this build's chunks, otherwise it would map vectors to the wrong chunks.
+        still_valid = old_emb is not None and not len(new_ids) and np.array_equal(np.asarray(old_meta.ids(), dtype="int64"), chunk_ids)
+        print(f"Warning: could not write '{EMB_PATH}' ({ex})." + ("" if still_valid else " The numpy fallback is off until the next successful build."))
+        del old_emb
+        if not still_valid and os.path.exists(EMB_PATH):
+            os.remove(EMB_PATH)
+        return False
+    del out
+    os.replace(tmp_path, out_path)
+    return True
+
+def load_previous_state(chunker: str = CHUNKER):
+    """
+    Loads the manifest, the ID-mapped index and the chunk store of the last build.
+    Returns (None, empty manifest, {}) whenever they are missing, built with other settings or don't agree with each other,
+    which turns the run into a full rebuild.
+    """
+    empty = {"version": MANIFEST_VERSION, "settings": index_settings(chunker), "next_id": 0, "documents": {}}
+    has_meta = has_chunk_store(INDEX_DIR) or os.path.exists(META_PATH)
+    if faiss is None or not has_meta or not all(os.path.exists(p) for p in (MANIFEST_PATH, INDEX_PATH)):
+        return None, empty, {}
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != MANIFEST_VERSION or manifest.get("settings") != index_settings(chunker):
+            print("Index settings changed since the last build, rebuilding everything.")
+            return None, empty, {}
+        old_meta = open_chunk_store(INDEX_DIR)
+        index = faiss.read_index(INDEX_PATH)
+    except Exception as ex:
+        print(f"Could not load the previous build ({ex}), rebuilding everything.")
+        return None, empty, {}
+
+    known_ids = np.asarray([c["id"] for doc in manifest["documents"].values() for c in doc["chunks"]], dtype="int64")
+    if index_type_of(index) not in (INDEX_TYPE, "flat") or index.ntotal != len(known_ids) or len(old_meta) != len(known_ids) \
+            or not np.isin(known_ids, old_meta.ids()).all():
+        print("Previous index doesn't match its manifest, rebuilding everything.")
+        return None, empty, {}
+    return index, manifest, old_meta
+
+def prepare_document(path: str, old_hash: Optional[str], chunker: str = CHUNKER) -> Tuple[str, str, Optional[List[Tuple[str, int, str]]], dict]:
+    """
+    Worker-process step of the pipeline: reads one file, and only if its content changed, cleans and chunks it.
+    Returns (source name, document hash, [(chunk text, start word, chunk hash), ...] or None when unchanged, document attributes).
+    The attributes (prefix, date, front matter tags) are cheap, so they are read for unchanged documents too.
+    """
+    src_name = os.path.basename(path)
+    raw = read_text_file(path)
+    doc_hash = content_hash(raw)
+    attrs = document_attributes(src_name, raw)
+    if doc_hash == old_hash:
+        return src_name, doc_hash, None, attrs
+    chunks = chunk_document(path, raw, chunker)
+    return src_name, doc_hash, [(c_text, start_word, content_hash(c_text)) for c_text, start_word in chunks], attrs
+
+def bounded_map(executor, fn: Callable, args: Iterable[tuple], max_in_flight: int) -> Iterator:
+    """Like executor.map, but never has more than `max_in_flight` tasks queued, so results can't pile up in memory."""
+    pending = deque()
+    for a in args:
+        pending.append(executor.submit(fn, *a))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 def main():
-    """Main execution function."""
+    """
+    Main execution function. The build runs as a pipeline: worker processes read, clean and chunk documents,
+    new chunks are embedded in batches of INGEST_BATCH, and each batch is added to the index right away,
+    so memory stays bounded by the batch size rather than the corpus size.
+    """
+    if is_versioned(INDEX_DIR):
+        # Writing into a published index folder would bypass the staging, build_all_indexes.py stages and publishes a new version instead.
+        print(f"Error: '{INDEX_DIR}' holds published index versions. Rebuild it with build_all_indexes.py.")
+        return
     ensure_dirs()
     files = list_documents()
     
@@ -110,52 +535,188 @@ def main():
         print(f"\nNo supported files (.txt, .md) found in '{DOCS_DIR}'. Add files and rerun.")
         return
 
-    print(f"\nFound {len(files)} documents to process.")
-    
-    all_chunks = []
-    metadata = []
-    for path in files:
-        src_name = os.path.basename(path)
-        text = load_and_clean(path)
-        chunks = chunk_text(text, chunk_size_words=CHUNK_SIZE, overlap_words=CHUNK_OVERLAP)
-        print(f"  - Chunking {src_name} -> {len(chunks)} chunk(s)")
-        for ci, (c_text, start_word) in enumerate(chunks):
-            all_chunks.append(c_text)
-            metadata.append({
-                "source": src_name,
-                "chunk_index": ci,
-                "start_word": start_word,
-                "text": c_text,
-            })
-
-    if not all_chunks:
+    print(f"\nFound {len(files)} documents to process with {INDEX_WORKERS} worker(s), index type '{INDEX_TYPE}'.")
+    if INDEX_TYPE not in INDEX_TYPES:
+        print(f"Error: unknown RAG_INDEX_TYPE '{INDEX_TYPE}'. Choose one of: {', '.join(INDEX_TYPES)}.")
+        return
+    if CHUNKER not in CHUNKERS:
+        print(f"Error: unknown RAG_CHUNKER '{CHUNKER}'. Choose one of: {', '.join(CHUNKERS)}.")
+        return
+    # Resolved once here and handed to the workers, so every document of a build is chunked the same way.
+    chunker = resolve_chunker(CHUNKER)
+    print(f"Chunking by {'model tokens (up to ' + str(CHUNK_TOKENS) + ' per chunk)' if chunker == 'tokens' else 'word windows'}.")
+
+    index, manifest, old_meta = load_previous_state(chunker)
+    old_docs = manifest["documents"]
+    next_id = int(manifest["next_id"])
+
+    documents: Dict[str, dict] = {}
+    stale_ids: List[int] = []
+    unchanged_docs = 0
+    embedded_total = 0
+    pending_texts: List[str] = []
+    pending_ids: List[int] = []
+    embedder = None
+    dim = index.d if index is not None else 0
+    meta_writer = ChunkStoreWriter(INDEX_DIR)
+    # New vectors are spilled to disk batch by batch, to be merged into embeddings.npy at the end.
+    new_vec_path = EMB_PATH + ".new"
+    new_vec_f = open(new_vec_path, "wb")
+    new_vec_ids = array("q")
+
+    def flush_batch(final: bool = False):
+        # Embeds the pending chunks and adds them to the index, then forgets them.
+        nonlocal index, embedder, embedded_total, dim
+        if not pending_texts:
+            return
+        # A new IVF index is trained on its first batch, so that batch waits until it is big enough.
+        if faiss and index is None and not final and len(pending_texts) < training_size():
+            return
+        if embedder is None:
+            # Imported here so the worker processes never pay for loading torch.
+            from sentence_transformers import SentenceTransformer
+            print(f"Loading embedding model: {EMBED_MODEL}")
+            embedder = SentenceTransformer(EMBED_MODEL)
+        embeddings = embedder.encode(
+            pending_texts,
+            batch_size=EMBED_BATCH,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+            normalize_embeddings=True,
+        ).astype("float32")
+        if faiss:
+            id_array = np.asarray(pending_ids, dtype="int64")
+            if index is None:
+                index = build_index(embeddings, id_array)
+            else:
+                index.add_with_ids(embeddings, id_array)
+        dim = embeddings.shape[1]
+        new_vec_f.write(embeddings.tobytes())
+        new_vec_ids.extend(pending_ids)
+        embedded_total += len(pending_texts)
+        print(f"  ... embedded {embedded_total} new chunk(s)")
+        pending_texts.clear()
+        pending_ids.clear()
+
+    args = ((path, old_docs.get(os.path.basename(path), {}).get("hash"), chunker) for path in files)
+    executor = ProcessPoolExecutor(max_workers=INDEX_WORKERS) if INDEX_WORKERS > 1 else None
+    try:
+        results = bounded_map(executor, prepare_document, args, max_in_flight=INDEX_WORKERS * 4) if executor \
+            else (prepare_document(*a) for a in args)
+        for src_name, doc_hash, chunks, attrs in results:
+            old_doc = old_docs.get(src_name)
+            meta_writer.set_doc_attributes(src_name, attrs)
+
+            # An untouched document keeps its chunks, vectors and metadata as they are.
+            if chunks is None:
+                documents[src_name] = old_doc
+                for c in old_doc["chunks"]:
+                    meta_writer.add(old_meta[c["id"]])
+                unchanged_docs += 1
+                continue
+
+            # Inside a changed document, chunks whose text is identical to an old chunk still reuse its vector.
+            reusable: Dict[str, List[int]] = {}
+            for c in (old_doc or {}).get("chunks", []):
+                reusable.setdefault(c["hash"], []).append(c["id"])
+
+            entries = []
+            embedded_here = 0
+            for ci, (c_text, start_word, c_hash) in enumerate(chunks):
+                if reusable.get(c_hash):
+                    cid = reusable[c_hash].pop(0)
+                else:
+                    cid = next_id
+                    next_id += 1
+                    pending_texts.append(c_text)
+                    pending_ids.append(cid)
+                    embedded_here += 1
+                entries.append({"id": cid, "hash": c_hash})
+                meta_writer.add({
+                    "id": cid,
+                    "source": src_name,
+                    "chunk_index": ci,
+                    "start_word": start_word,
+                    "text": c_text,
+                })
+            for ids in reusable.values():
+                stale_ids.extend(ids)
+            documents[src_name] = {"hash": doc_hash, "chunks": entries}
+            status = "new" if old_doc is None else "changed"
+            print(f"  - Chunking {src_name} ({status}) -> {len(chunks)} chunk(s), {embedded_here} to embed")
+
+            if len(pending_texts) >= INGEST_BATCH:
+                flush_batch()
+        flush_batch(final=True)
+    except BaseException:
+        meta_writer.abort()
+        new_vec_f.close()
+        os.remove(new_vec_path)
+        raise
+    finally:
+        if executor:
+            executor.shutdown()
+    new_vec_f.close()
+
+    # Documents that disappeared from the folder take their vectors with them.
+    for src_name, old_doc in old_docs.items():
+        if src_name not in documents:
+            print(f"  - Removing {src_name} -> {len(old_doc['chunks'])} chunk(s)")
+            stale_ids.extend(c["id"] for c in old_doc["chunks"])
+
+    if not meta_writer.count:
+        meta_writer.abort()
+        os.remove(new_vec_path)
         print("\nError: No chunks were created. Check document content.")
         return
 
-    print(f"\nTotal chunks created: {len(all_chunks)}")
+    print(f"\nTotal chunks: {meta_writer.count} ({unchanged_docs} unchanged document(s), {embedded_total} chunk(s) embedded, {len(stale_ids)} stale chunk(s) to delete)")
 
-    print(f"Loading embedding model: {EMBED_MODEL}")
-    embedder = SentenceTransformer(EMBED_MODEL)
-    print("Encoding chunks to embeddings (this may take a while)...")
-    embeddings = embedder.encode(
-        all_chunks,
-        batch_size=64,
-        convert_to_numpy=True,
-        show_progress_bar=True,
-        normalize_embeddings=True,
-    ).astype("float32")
+    if old_docs and not embedded_total and not stale_ids and set(documents) == set(old_docs) \
+            and os.path.exists(EMB_PATH) and has_lexical_index(INDEX_DIR) and has_doc_attributes(INDEX_DIR):
+        meta_writer.abort()
+        os.remove(new_vec_path)
+        print("\n✅ Index is already up to date.")
+        return
+
+    # The store goes first and the FAISS index last. Until the index is replaced, searches only return IDs of the old build,
+    # and the ones the new store no longer has are skipped. Old embeddings are never left next to a new store.
+    chunk_ids = np.sort(np.asarray([c["id"] for doc in documents.values() for c in doc["chunks"]], dtype="int64"))
+    # A temp-file name, so a leftover from an interrupted build is never linked into the next staged version (see index_versions).
+    staged_emb_path = EMB_PATH + ".next.tmp.npy"
+    print(f"Writing embeddings to '{EMB_PATH}' ({EMB_DTYPE})")
+    emb_ok = write_embeddings(chunk_ids, np.frombuffer(new_vec_ids, dtype="int64") if new_vec_ids else np.zeros(0, dtype="int64"),
+                              new_vec_path, dim, old_meta, index, out_path=staged_emb_path)
+    os.remove(new_vec_path)
+    if emb_ok and os.path.exists(EMB_PATH):
+        os.remove(EMB_PATH)
+
+    print(f"Writing chunk store to '{INDEX_DIR}'")
+    meta_writer.close()
+    if os.path.exists(META_PATH):
+        # The old JSON metadata is superseded by the store and would only go stale.
+        os.remove(META_PATH)
+    if emb_ok:
+        os.replace(staged_emb_path, EMB_PATH)
+
+    # The inverted index is rebuilt from the finished store, which is cheap next to the encoding above.
+    store = open_chunk_store(INDEX_DIR)
+    vocab_size = build_lexical_index(INDEX_DIR, store)
+    store.close()
+    print(f"Wrote lexical index to '{INDEX_DIR}' ({vocab_size} terms)")
 
     if faiss:
+        if stale_ids:
+            index = remove_from_index(index, np.asarray(stale_ids, dtype="int64"))
         print(f"Writing FAISS index to '{INDEX_PATH}'")
-        build_index(embeddings)
+        write_index(index)
     else:
         print("Skipping FAISS index creation as 'faiss' is not installed.")
-    
-    # All the chunk text and metadata is saved to a JSON file
-    meta = {"count": len(metadata), "metadata": metadata}
-    print(f"Writing metadata to '{META_PATH}'")
-    with open(META_PATH, "w", encoding="utf-8") as f:
-        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    # The manifest is written last, so an interrupted run is simply redone next time.
+    if faiss:
+        manifest = {"version": MANIFEST_VERSION, "settings": index_settings(chunker), "next_id": next_id, "documents": documents}
+        write_json(MANIFEST_PATH, manifest)
 
     print("\n✅ Indexing complete.")
 
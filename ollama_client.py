@@ -0,0 +1,355 @@
+# A small HTTP client for the local Ollama server: pooled keep-alive connections, a concurrency limit, hard deadlines and a circuit breaker.
+import os
+import json
+import time
+import queue
+import socket
+import threading
+import http.client
+from typing import Any, Dict, Generator, List, Optional
+from urllib.parse import urlparse
+
+from rag_metrics import REGISTRY
+
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434").rstrip("/")
+MAX_CONCURRENT = int(os.environ.get("RAG_OLLAMA_MAX_CONCURRENT", "2"))
+POOL_SIZE = int(os.environ.get("RAG_OLLAMA_POOL_SIZE", "4"))
+DEADLINE_SEC = float(os.environ.get("RAG_OLLAMA_DEADLINE_SEC", "90"))
+ATTEMPTS_PER_MODEL = int(os.environ.get("RAG_OLLAMA_ATTEMPTS", "2"))
+BREAKER_FAILURES = int(os.environ.get("RAG_OLLAMA_BREAKER_FAILURES", "3"))
+BREAKER_RESET_SEC = float(os.environ.get("RAG_OLLAMA_BREAKER_RESET_SEC", "30"))
+# How long Ollama keeps the model (and its prompt cache) loaded after a request. Empty leaves Ollama's default (5 minutes).
+KEEP_ALIVE = os.environ.get("RAG_OLLAMA_KEEP_ALIVE", "30m")
+
+# Ollama reports how many prompt tokens it had to evaluate and how long that took, which shows whether the prompt prefix is reused.
+PROMPT_EVAL_SECONDS = REGISTRY.histogram("rag_ollama_prompt_eval_seconds", "Time Ollama spent evaluating the prompt of a generation.")
+PROMPT_EVAL_TOKENS = REGISTRY.counter("rag_ollama_prompt_eval_tokens_total", "Prompt tokens Ollama evaluated (tokens served from its prompt cache are not counted).")
+
+class OllamaUnavailable(Exception):
+    """Raised internally when the backend can't be reached or answers with a server error."""
+
+class ModelNotFound(Exception):
+    """Raised internally when Ollama is healthy but doesn't have the requested model."""
+
+class CircuitBreaker:
+    """
+    Classic three-state breaker. After `failure_threshold` consecutive backend failures it opens and rejects calls
+    for `reset_timeout` seconds, then lets a single trial call through (half-open) to decide whether to close again.
+    """
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET_SEC):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def rejecting(self) -> bool:
+        # True while the breaker is open and still cooling down. Unlike allow(), this never claims the half-open trial.
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.state == "open"
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+class OllamaClient:
+    """
+    Thread-safe Ollama client shared by the whole process.
+    `generate` returns the answer text or None, and `generate_stream` yields answer pieces; both give up at the
+    deadline and return nothing while the circuit breaker is open, so callers can use their extractive fallback.
+    """
+
+    def __init__(self, host: str = OLLAMA_HOST, max_concurrent: int = MAX_CONCURRENT, pool_size: int = POOL_SIZE,
+                 deadline_sec: float = DEADLINE_SEC, attempts_per_model: int = ATTEMPTS_PER_MODEL,
+                 breaker: Optional[CircuitBreaker] = None, keep_alive: str = KEEP_ALIVE):
+        parsed = urlparse(host if "://" in host else f"http://{host}")
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        self.https = parsed.scheme == "https"
+        self.deadline_sec = deadline_sec
+        self.attempts_per_model = max(1, attempts_per_model)
+        self.keep_alive = keep_alive
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrent))
+        self._pool: "queue.LifoQueue[http.client.HTTPConnection]" = queue.LifoQueue(maxsize=max(1, pool_size))
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "retries": 0, "failures": 0, "short_circuited": 0, "timeouts": 0, "in_flight": 0}
+
+    # --- connection pool ---
+    def _new_connection(self, timeout: float) -> http.client.HTTPConnection:
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=timeout)
+
+    def _acquire_connection(self, timeout: float) -> http.client.HTTPConnection:
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            return self._new_connection(timeout)
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn
+
+    def _release_connection(self, conn: http.client.HTTPConnection) -> None:
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _count(self, key: str, delta: int = 1) -> None:
+        with self._stats_lock:
+            self._stats[key] += delta
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            out = dict(self._stats)
+        out["breaker_state"] = self.breaker.state
+        out["idle_connections"] = self._pool.qsize()
+        return out
+
+    # --- requests ---
+    def _post(self, path: str, payload: Dict[str, Any], timeout: float):
+        # Sends one request and returns (connection, response). Server errors and socket problems become OllamaUnavailable.
+        body = json.dumps(payload).encode("utf-8")
+        conn = self._acquire_connection(timeout)
+        try:
+            conn.request("POST", path, body=body, headers={"Content-Type": "application/json", "Connection": "keep-alive"})
+            resp = conn.getresponse()
+        except Exception as ex:
+            conn.close()
+            raise OllamaUnavailable(str(ex)) from ex
+        if resp.status == 404:
+            resp.read()
+            self._release_connection(conn)
+            raise ModelNotFound(payload.get("model", ""))
+        if resp.status >= 400:
+            resp.read()
+            self._release_connection(conn)
+            raise OllamaUnavailable(f"HTTP {resp.status}")
+        return conn, resp
+
+    def _payload(self, model: str, prompt: str, num_predict: int, stream: bool, extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        payload = {"model": model, "prompt": prompt, "stream": stream, "options": {"temperature": 0.2, "num_predict": num_predict}}
+        if self.keep_alive:
+            payload["keep_alive"] = self.keep_alive
+        payload.update(extra or {})
+        return payload
+
+    def _record_eval(self, obj: Dict[str, Any]) -> None:
+        # The final object of a generation carries its prompt evaluation counts (durations are in nanoseconds).
+        if "prompt_eval_duration" in obj:
+            PROMPT_EVAL_SECONDS.observe(obj["prompt_eval_duration"] / 1e9)
+        if "prompt_eval_count" in obj:
+            PROMPT_EVAL_TOKENS.inc(obj["prompt_eval_count"])
+
+    def _enter(self, deadline: float) -> bool:
+        # Checks the breaker, then waits for a generation slot until the deadline. The half-open trial is only claimed with a slot held.
+        if self.breaker.rejecting():
+            self._count("short_circuited")
+            return False
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            self._count("timeouts")
+            return False
+        if not self.breaker.allow():
+            self._slots.release()
+            self._count("short_circuited")
+            return False
+        self._count("in_flight")
+        return True
+
+    def _leave(self) -> None:
+        self._count("in_flight", -1)
+        self._slots.release()
+
+    def generate(self, models: List[str], prompt: str, num_predict: int, deadline_sec: Optional[float] = None,
+                 extra: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Tries each candidate model in order and returns the first non-empty answer, or None."""
+        deadline = time.monotonic() + (deadline_sec or self.deadline_sec)
+        if not self._enter(deadline):
+            return None
+        try:
+            for m in models:
+                for attempt in range(1, self.attempts_per_model + 1):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._count("timeouts")
+                        return None
+                    if self.breaker.is_open():
+                        self._count("short_circuited")
+                        return None
+                    if attempt > 1:
+                        self._count("retries")
+                    self._count("requests")
+                    try:
+                        conn, resp = self._post("/api/generate", self._payload(m, prompt, num_predict, False, extra), remaining)
+                        try:
+                            raw = resp.read().decode("utf-8")
+                        except Exception as ex:
+                            conn.close()
+                            raise OllamaUnavailable(str(ex)) from ex
+                        self._release_connection(conn)
+                    except ModelNotFound:
+                        self.breaker.record_success()
+                        break
+                    except OllamaUnavailable:
+                        self._count("failures")
+                        self.breaker.record_failure()
+                        time.sleep(min(0.25 * attempt, max(0.0, deadline - time.monotonic())))
+                        continue
+                    try:
+                        obj = json.loads(raw) if raw.strip().startswith("{") else {"response": raw}
+                    except ValueError:
+                        # A truncated or garbled body counts as a failed attempt.
+                        self._count("failures")
+                        self.breaker.record_failure()
+                        continue
+                    self.breaker.record_success()
+                    self._record_eval(obj)
+                    out = (obj.get("response") or "").strip()
+                    if out:
+                        return out
+            return None
+        finally:
+            self._leave()
+
+    def generate_stream(self, models: List[str], prompt: str, num_predict: int, deadline_sec: Optional[float] = None,
+                        extra: Optional[Dict[str, Any]] = None) -> Generator[str, None, Optional[bool]]:
+        """
+        Streams the answer pieces of the first candidate model that responds. A model is only abandoned if it
+        fails before its first piece, because a half-sent answer can't be restarted. The generation slot is held until the stream ends.
+        The generator returns True (StopIteration.value) only when a model finished its answer, not when it was cut off.
+        """
+        deadline = time.monotonic() + (deadline_sec or self.deadline_sec)
+        if not self._enter(deadline):
+            return
+        try:
+            for m in models:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._count("timeouts")
+                    return
+                if self.breaker.is_open():
+                    self._count("short_circuited")
+                    return
+                self._count("requests")
+                try:
+                    conn, resp = self._post("/api/generate", self._payload(m, prompt, num_predict, True, extra), remaining)
+                except ModelNotFound:
+                    self.breaker.record_success()
+                    continue
+                except OllamaUnavailable:
+                    self._count("failures")
+                    self.breaker.record_failure()
+                    continue
+
+                produced = False
+                finished = False
+                sock = conn.sock or getattr(getattr(resp.fp, "raw", None), "_sock", None)
+                try:
+                    while True:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._count("timeouts")
+                            break
+                        # Each read may only wait until the deadline, so one stalled read can't run past it.
+                        if sock is not None:
+                            sock.settimeout(max(0.001, remaining))
+                        try:
+                            raw_line = resp.readline()
+                        except socket.timeout:
+                            if time.monotonic() < deadline:
+                                raise
+                            self._count("timeouts")
+                            break
+                        if not raw_line:
+                            finished = True
+                            break
+                        line = raw_line.decode("utf-8").strip()
+                        if not line:
+                            continue
+                        try:
+                            obj = json.loads(line)
+                        except ValueError:
+                            continue
+                        piece = obj.get("response") or ""
+                        if piece:
+                            produced = True
+                            yield piece
+                        if obj.get("done"):
+                            self._record_eval(obj)
+                            resp.read()
+                            finished = True
+                            break
+                except Exception:
+                    self._count("failures")
+                    self.breaker.record_failure()
+                    conn.close()
+                    if produced:
+                        return
+                    continue
+                finally:
+                    # Connections abandoned mid-stream (deadline, client went away) can't be reused.
+                    if not finished:
+                        conn.close()
+                if finished:
+                    self._release_connection(conn)
+                    self.breaker.record_success()
+                if produced or not finished:
+                    return produced and finished
+        finally:
+            self._leave()
+
+_default_client: Optional[OllamaClient] = None
+_default_client_lock = threading.Lock()
+
+def get_ollama_client() -> OllamaClient:
+    """Returns the process-wide client, so every caller shares its connection pool, concurrency limit and breaker."""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = OllamaClient()
+        return _default_client
+
+def _collect_metrics():
+    # Exposes the shared client's own counters on /metrics. Nothing is reported before the first LLM call creates the client.
+    if _default_client is None:
+        return []
+    st = _default_client.stats()
+    families = [(f"rag_ollama_{key}_total", "counter", f"Ollama client {key.replace('_', ' ')}.", [({}, st[key])])
+                for key in ("requests", "retries", "failures", "short_circuited", "timeouts")]
+    families.append(("rag_ollama_in_flight", "gauge", "Generations currently holding an Ollama slot.", [({}, st["in_flight"])]))
+    families.append(("rag_ollama_idle_connections", "gauge", "Keep-alive connections waiting in the pool.", [({}, st["idle_connections"])]))
+    families.append(("rag_ollama_breaker_state", "gauge", "Circuit breaker state (1 for the current state).",
+                     [({"state": state}, 1 if st["breaker_state"] == state else 0) for state in ("closed", "open", "half_open")]))
+    return families
+
+REGISTRY.add_collector(_collect_metrics)
@@ -0,0 +1,177 @@
+# A tiny stand-in for the Ollama HTTP API (/api/generate and /api/tags), so the LLM path can be exercised offline. Example:
+#   python ollama_stub.py --port 11435 --delay 0.05
+#   OLLAMA_HOST=http://127.0.0.1:11435 python mini_rag_answer.py "What is blockchain?"
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Optional, Tuple
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive between requests, like the real server.
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, and with Nagle's algorithm on, every response would wait for a delayed ACK (~40 ms).
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, obj: dict) -> None:
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer_words(self) -> list:
+        words = self.server.answer.split()
+        return [w + " " for w in words[:-1]] + words[-1:]
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json(200, {"models": [{"name": m} for m in sorted(self.server.models or ["llama3.2"])]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b"{}"
+        self.server.record_request()
+        self.server.track_active(1)
+        try:
+            self._generate(raw)
+        finally:
+            self.server.track_active(-1)
+
+    def _generate(self, raw: bytes) -> None:
+        if self.path != "/api/generate":
+            self._send_json(404, {"error": "not found"})
+            return
+        if self.server.fail:
+            self._send_json(500, {"error": "stub configured to fail"})
+            return
+        try:
+            payload = json.loads(raw.decode("utf-8") or "{}")
+        except ValueError:
+            self._send_json(400, {"error": "invalid JSON"})
+            return
+        model = payload.get("model", "")
+        if self.server.models and model not in self.server.models:
+            self._send_json(404, {"error": f"model '{model}' not found"})
+            return
+
+        pieces = self._answer_words()
+        stats = self.server.prompt_eval(payload)
+        if payload.get("stream", True):
+            # Ollama streams newline-delimited JSON objects over a chunked response.
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for piece in pieces:
+                    time.sleep(self.server.delay)
+                    self._write_chunk({"model": model, "response": piece, "done": False})
+                self._write_chunk(dict({"model": model, "response": "", "done": True, "context": [1, 2, 3]}, **stats))
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up mid-stream (deadline or closed page), which is expected.
+                self.close_connection = True
+        else:
+            time.sleep(self.server.delay * len(pieces))
+            obj = dict({"model": model, "response": "".join(pieces), "done": True, "context": [1, 2, 3]}, **stats)
+            if self.server.garble:
+                # A 200 whose JSON body is cut off halfway.
+                body = json.dumps(obj).encode("utf-8")[:20]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self._send_json(200, obj)
+
+    def _write_chunk(self, obj: dict) -> None:
+        data = (json.dumps(obj) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+class StubOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], answer: str = "This is a stub answer from the local test server.",
+                 delay: float = 0.0, fail: bool = False, models: Optional[Iterable[str]] = None, verbose: bool = False,
+                 garble: bool = False):
+        super().__init__(address, StubOllamaHandler)
+        self.answer = answer
+        self.delay = delay
+        self.fail = fail
+        self.garble = garble
+        self.models = set(models or [])
+        self.verbose = verbose
+        self.request_count = 0
+        # Requests being answered right now, and the most there ever were at once.
+        self.active = 0
+        self.peak_active = 0
+        self._count_lock = threading.Lock()
+        # Words of the previous prompt, to report prompt evaluation the way Ollama's prompt cache does.
+        self._last_prompt: list = []
+
+    def record_request(self) -> None:
+        with self._count_lock:
+            self.request_count += 1
+
+    def track_active(self, delta: int) -> None:
+        with self._count_lock:
+            self.active += delta
+            self.peak_active = max(self.peak_active, self.active)
+
+    def prompt_eval(self, payload: dict) -> dict:
+        # One "token" per word of system + prompt, minus the prefix shared with the previous request (Ollama's prompt cache).
+        words = (payload.get("system") or "").split() + (payload.get("prompt") or "").split()
+        with self._count_lock:
+            shared = 0
+            for a, b in zip(words, self._last_prompt):
+                if a != b:
+                    break
+                shared += 1
+            self._last_prompt = words
+        count = max(1, len(words) - shared)
+        return {"prompt_eval_count": count, "prompt_eval_duration": count * 1_000_000}
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+def start_stub_server(port: int = 0, **kwargs) -> StubOllamaServer:
+    """Starts the stub on a background thread (port 0 picks a free port) and returns it. Call .shutdown() when done."""
+    server = StubOllamaServer(("127.0.0.1", port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local stub of the Ollama API for offline testing.")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--delay", type=float, default=0.02, help="Seconds to wait before each streamed token.")
+    parser.add_argument("--answer", default="This is a stub answer from the local test server.")
+    parser.add_argument("--fail", action="store_true", help="Answer every generate call with HTTP 500.")
+    parser.add_argument("--garble", action="store_true", help="Cut non-streaming generate responses off halfway.")
+    parser.add_argument("--model", action="append", dest="models", help="Only accept these model names (repeatable).")
+    args = parser.parse_args()
+
+    server = StubOllamaServer(("127.0.0.1", args.port), answer=args.answer, delay=args.delay,
+                              fail=args.fail, models=args.models, verbose=True, garble=args.garble)
+    print(f"Stub Ollama listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
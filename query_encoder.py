@@ -0,0 +1,263 @@
+# Query encoders: fp32 (the sentence-transformers model) or int8 (an ONNX export run with onnxruntime, without importing torch).
+#   python query_encoder.py export
+#   python query_encoder.py check --index-dir index_s1
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from chunk_store import open_chunk_store
+from index_versions import active_index_dir
+
+EMBED_MODEL = os.environ.get("RAG_EMBED_MODEL", "BAAI/bge-small-en-v1.5")
+# Which encoder the RAG engine uses for queries: "fp32" or "int8".
+QUERY_ENCODER = os.environ.get("RAG_QUERY_ENCODER", "fp32").lower()
+# Where exported encoders are kept, one folder per model.
+ENCODER_CACHE_DIR = os.environ.get("RAG_ENCODER_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".encoder_cache"))
+# onnxruntime threads per encode call. Like the OMP/MKL pinning in mini_rag_answer.py, concurrency comes from requests, not from one query.
+ENCODER_THREADS = int(os.environ.get("RAG_ENCODER_THREADS", "1"))
+# The lowest mean top-k overlap with the fp32 model that "check" accepts.
+MIN_TOPK_OVERLAP = float(os.environ.get("RAG_ENCODER_MIN_OVERLAP", "0.9"))
+ENCODER_KINDS = ("fp32", "int8")
+
+CONFIG_FILE = "encoder.json"
+MODEL_FILE = "model_int8.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+
+def cache_path(model_name: str, cache_dir: str = ENCODER_CACHE_DIR) -> str:
+    return os.path.join(cache_dir, model_name.replace("/", "__") + "-int8")
+
+def load_fp32_encoder(model_name: str = EMBED_MODEL):
+    # Imported here so the int8 path never loads torch.
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+def export_int8(model_name: str = EMBED_MODEL, cache_dir: str = ENCODER_CACHE_DIR) -> str:
+    """
+    Exports the transformer of a sentence-transformers model to ONNX, quantizes its weights to int8 and saves it with the
+    fast tokenizer and the pooling settings. Needs torch and onnxruntime once, at export time. Returns the cache folder.
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    st = load_fp32_encoder(model_name)
+    transformer, pooling = st[0], st[1]
+    tokenizer = transformer.tokenizer
+    if pooling.pooling_mode_cls_token:
+        pooling_mode = "cls"
+    elif pooling.pooling_mode_mean_tokens:
+        pooling_mode = "mean"
+    else:
+        raise ValueError(f"Unsupported pooling for '{model_name}', only CLS and mean pooling can be exported.")
+
+    class TokenEmbeddings(torch.nn.Module):
+        # The bare transformer, returning token embeddings. Pooling and normalization are done in numpy at query time.
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids=None):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+
+    sample = tokenizer(["an example query", "a second, somewhat longer example query"], padding=True, return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+    final = cache_path(model_name, cache_dir)
+    tmp = final + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    fp32_path = os.path.join(tmp, "model_fp32.onnx")
+    module = TokenEmbeddings(transformer.auto_model).eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            module, tuple(sample[n] for n in input_names), fp32_path,
+            input_names=input_names, output_names=["token_embeddings"],
+            dynamic_axes={**{n: {0: "batch", 1: "seq"} for n in input_names}, "token_embeddings": {0: "batch", 1: "seq"}},
+            opset_version=14,
+        )
+    quantize_dynamic(fp32_path, os.path.join(tmp, MODEL_FILE), weight_type=QuantType.QInt8)
+    os.remove(fp32_path)
+    tokenizer.backend_tokenizer.save(os.path.join(tmp, TOKENIZER_FILE))
+    with open(os.path.join(tmp, CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "model": model_name, "pooling": pooling_mode, "max_seq_length": int(st.max_seq_length),
+            "input_names": input_names, "pad_token": tokenizer.pad_token, "pad_token_id": int(tokenizer.pad_token_id),
+            "dim": int(st.get_sentence_embedding_dimension()),
+        }, f, indent=2)
+    # Swapped into place only when complete, so a half-written export is never loaded.
+    shutil.rmtree(final, ignore_errors=True)
+    os.replace(tmp, final)
+    return final
+
+class Int8QueryEncoder:
+    """
+    An exported int8 encoder. encode() takes the same arguments as SentenceTransformer.encode, so the RAG engine can use either.
+    Only onnxruntime and the `tokenizers` package are imported.
+    """
+
+    def __init__(self, path: str, threads: int = ENCODER_THREADS):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(path, CONFIG_FILE), "r", encoding="utf-8") as f:
+            self.config: Dict[str, Any] = json.load(f)
+        self.tokenizer = Tokenizer.from_file(os.path.join(path, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_token_id"], pad_token=self.config["pad_token"])
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = max(1, threads)
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(os.path.join(path, MODEL_FILE), options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return int(self.config["dim"])
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True, normalize_embeddings: bool = False, **kwargs) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts: List[str] = [sentences] if single else list(sentences)
+        out = np.zeros((len(texts), self.get_sentence_embedding_dimension()), dtype="float32")
+        for start in range(0, len(texts), max(1, batch_size)):
+            encodings = self.tokenizer.encode_batch(texts[start:start + batch_size])
+            mask = np.asarray([e.attention_mask for e in encodings], dtype="int64")
+            feeds = {"input_ids": np.asarray([e.ids for e in encodings], dtype="int64"), "attention_mask": mask,
+                     "token_type_ids": np.asarray([e.type_ids for e in encodings], dtype="int64")}
+            tokens = self.session.run(None, {n: feeds[n] for n in self.input_names})[0]
+            if self.config["pooling"] == "cls":
+                pooled = tokens[:, 0]
+            else:
+                weights = mask[:, :, None].astype("float32")
+                pooled = (tokens * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+            out[start:start + len(encodings)] = pooled
+        if normalize_embeddings:
+            out /= np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-12)
+        return out[0] if single else out
+
+def load_query_encoder(model_name: str = EMBED_MODEL, kind: str = QUERY_ENCODER, cache_dir: str = ENCODER_CACHE_DIR):
+    """
+    Returns the query encoder to use. The int8 one is exported on first use if it isn't cached yet.
+    Without onnxruntime (or if the export fails) the fp32 model is used, so the RAG agent always has an encoder.
+    """
+    if kind not in ENCODER_KINDS:
+        raise ValueError(f"Unknown RAG_QUERY_ENCODER '{kind}'. Choose one of: {', '.join(ENCODER_KINDS)}.")
+    if kind == "int8":
+        path = cache_path(model_name, cache_dir)
+        try:
+            if not os.path.exists(os.path.join(path, CONFIG_FILE)):
+                print(f"Exporting an int8 query encoder for '{model_name}' to '{path}' (one time).", file=sys.stderr)
+                export_int8(model_name, cache_dir)
+            return Int8QueryEncoder(path)
+        except Exception as ex:
+            print(f"int8 query encoder unavailable ({ex}), using the fp32 model.", file=sys.stderr)
+    return load_fp32_encoder(model_name)
+
+def sample_queries(index_dir: str, n: int, seed: int = 0) -> List[str]:
+    # Pseudo-queries from the index itself: the first sentence of randomly chosen chunks.
+    store = open_chunk_store(active_index_dir(index_dir))
+    ids = store.ids()
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(ids), size=min(n, len(ids)), replace=False) if len(ids) else []
+    queries = []
+    for row in picks:
+        text = re.sub(r"\s+", " ", store[int(ids[row])].get("text") or "").strip()
+        first = re.split(r"(?<=[.!?])\s+", text)[0]
+        queries.append(" ".join(first.split()[:24]))
+    store.close()
+    return [q for q in queries if q]
+
+def _timed_encodes(encoder, queries: Sequence[str]) -> np.ndarray:
+    # One query at a time, the way the web app encodes them. Returns the latencies in milliseconds.
+    times = []
+    for q in queries:
+        t = time.perf_counter()
+        encoder.encode([q], convert_to_numpy=True, normalize_embeddings=True)
+        times.append((time.perf_counter() - t) * 1000)
+    return np.asarray(times)
+
+def check_overlap(index_dir: str, queries: List[str], k: int, model_name: str = EMBED_MODEL, cache_dir: str = ENCODER_CACHE_DIR) -> Dict[str, Any]:
+    """
+    Searches the index with the fp32 and the int8 query vectors and compares the top-k chunk IDs per query.
+    Also reports load time and per-query encode latency of both encoders.
+    """
+    from mini_rag_answer import faiss_search, load_faiss_index
+    index_dir = active_index_dir(index_dir)
+    index = load_faiss_index(os.path.join(index_dir, "faiss.index"))
+
+    t = time.perf_counter()
+    fp32 = load_fp32_encoder(model_name)
+    fp32_load = time.perf_counter() - t
+    path = cache_path(model_name, cache_dir)
+    if not os.path.exists(os.path.join(path, CONFIG_FILE)):
+        export_int8(model_name, cache_dir)
+    t = time.perf_counter()
+    int8 = Int8QueryEncoder(path)
+    int8_load = time.perf_counter() - t
+
+    _, ids_fp32 = faiss_search(fp32.encode(queries, convert_to_numpy=True, normalize_embeddings=True).astype("float32"), k, index)
+    _, ids_int8 = faiss_search(int8.encode(queries, convert_to_numpy=True, normalize_embeddings=True), k, index)
+    overlaps = []
+    for a, b in zip(ids_fp32, ids_int8):
+        a, b = set(a[a >= 0].tolist()), set(b[b >= 0].tolist())
+        overlaps.append(len(a & b) / max(1, len(a)))
+    overlaps = np.asarray(overlaps)
+    top1 = float(np.mean(ids_fp32[:, 0] == ids_int8[:, 0])) if len(queries) else 0.0
+
+    lat_fp32, lat_int8 = _timed_encodes(fp32, queries), _timed_encodes(int8, queries)
+    return {
+        "index_dir": index_dir, "model": model_name, "k": k, "n_queries": len(queries),
+        "mean_overlap": round(float(overlaps.mean()), 4) if len(overlaps) else 0.0,
+        "min_overlap": round(float(overlaps.min()), 4) if len(overlaps) else 0.0,
+        "top1_agreement": round(top1, 4),
+        "fp32": {"load_sec": round(fp32_load, 3), "p50_ms": round(float(np.median(lat_fp32)), 3), "p95_ms": round(float(np.percentile(lat_fp32, 95)), 3)},
+        "int8": {"load_sec": round(int8_load, 3), "p50_ms": round(float(np.median(lat_int8)), 3), "p95_ms": round(float(np.percentile(lat_int8, 95)), 3)},
+    }
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Export the int8 query encoder and check it against the fp32 model.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="Build (or rebuild) the cached int8 encoder.")
+    export.add_argument("--model", default=EMBED_MODEL)
+    check = sub.add_parser("check", help="Compare top-k retrieval of the int8 and fp32 encoders on an index.")
+    check.add_argument("--index-dir", required=True)
+    check.add_argument("--model", default=EMBED_MODEL)
+    check.add_argument("--queries", help="Text file with one query per line. By default queries are sampled from the index.")
+    check.add_argument("--n", type=int, default=200, help="How many queries to sample from the index.")
+    check.add_argument("--k", type=int, default=12)
+    check.add_argument("--min-overlap", type=float, default=MIN_TOPK_OVERLAP)
+    check.add_argument("--out", help="Also write the report as JSON to this path.")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        path = export_int8(args.model)
+        print(f"int8 query encoder written to '{path}'. Enable it with RAG_QUERY_ENCODER=int8.")
+        return
+
+    if args.queries:
+        with open(args.queries, "r", encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = sample_queries(args.index_dir, args.n)
+    if not queries:
+        sys.exit("No queries to check with.")
+    report = check_overlap(args.index_dir, queries, args.k, args.model)
+    print(f"{report['n_queries']} queries, top-{report['k']} overlap with fp32: mean {report['mean_overlap']:.3f}, "
+          f"min {report['min_overlap']:.3f}, top-1 agreement {report['top1_agreement']:.3f}")
+    for kind in ENCODER_KINDS:
+        r = report[kind]
+        print(f"{kind:<5} load {r['load_sec']:>7.3f} s   encode p50 {r['p50_ms']:>8.3f} ms   p95 {r['p95_ms']:>8.3f} ms")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to '{args.out}'")
+    if report["mean_overlap"] < args.min_overlap:
+        print(f"FAIL: mean overlap {report['mean_overlap']:.3f} is below {args.min_overlap:.3f}, keep RAG_QUERY_ENCODER=fp32.")
+        sys.exit(1)
+    print(f"OK: mean overlap is at least {args.min_overlap:.3f}, RAG_QUERY_ENCODER=int8 is safe for this index.")
+
+if __name__ == "__main__":
+    main()
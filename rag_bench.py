@@ -0,0 +1,298 @@
+# Benchmark suite for the RAG agent: times every indexing and answering stage on a synthetic docs/-style corpus, as JSON. Examples:
+#   python rag_bench.py --chunks 10000
+#   python rag_bench.py --chunks 10000,100000,1000000 --encode-sample 2000 --out bench_output.json
+#   python rag_bench.py --chunks 10000 --compare bench_before.json
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import mini_rag_index as idx
+from chunk_store import ChunkStoreWriter
+from lexical_index import build_lexical_index, open_lexical_index, tokenize
+from ollama_client import OllamaClient
+from ollama_stub import start_stub_server
+import mini_rag_answer as rag
+
+CHUNKS_PER_DOC = 20
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "ta", "vi", "zo", "be", "da", "fe", "gu", "ho", "ji", "pe", "si"]
+
+def percentiles(latencies: List[float]) -> Dict[str, float]:
+    lat = np.asarray(latencies, dtype="float64") * 1000
+    return {"mean_ms": round(float(lat.mean()), 4), "p50_ms": round(float(np.percentile(lat, 50)), 4),
+            "p95_ms": round(float(np.percentile(lat, 95)), 4), "p99_ms": round(float(np.percentile(lat, 99)), 4)}
+
+def stage(total_sec: float, items: int, **extra) -> Dict[str, Any]:
+    out = {"total_sec": round(total_sec, 4), "items": int(items),
+           "per_item_ms": round(total_sec * 1000 / items, 5) if items else None}
+    out.update(extra)
+    return out
+
+class CorpusGenerator:
+    """
+    Writes markdown documents that look like the ones in docs/: front matter, a title, a summary line, paragraphs,
+    bullet lists with bold labels, a link and the odd code block. Words follow a Zipf distribution over a vocabulary made of
+    the words in docs/ plus generated pseudo-words, so term statistics resemble real text.
+    """
+
+    def __init__(self, seed: int = 0, vocab_size: int = 30000, source_dir: str = "docs"):
+        self.rng = np.random.default_rng(seed)
+        words = []
+        if os.path.isdir(source_dir):
+            for name in sorted(os.listdir(source_dir)):
+                if name.endswith((".md", ".txt")):
+                    words.extend(tokenize(idx.read_text_file(os.path.join(source_dir, name))))
+        vocab = list(dict.fromkeys(words))
+        while len(vocab) < vocab_size:
+            n = int(self.rng.integers(2, 5))
+            vocab.append("".join(SYLLABLES[i] for i in self.rng.integers(0, len(SYLLABLES), n)))
+        self.vocab = np.asarray(list(dict.fromkeys(vocab)))
+        weights = 1 / np.arange(1, len(self.vocab) + 1, dtype="float64")
+        # Sampling through the cumulative distribution once, rather than rng.choice(p=...), which rebuilds it on every call.
+        self.cdf = np.cumsum(weights) / weights.sum()
+
+    def words(self, n: int) -> List[str]:
+        picks = np.minimum(np.searchsorted(self.cdf, self.rng.random(n)), len(self.vocab) - 1)
+        return self.vocab[picks].tolist()
+
+    def sentences(self, n_words: int) -> str:
+        words = self.words(n_words)
+        out, i = [], 0
+        while i < len(words):
+            step = int(self.rng.integers(8, 21))
+            out.append(" ".join(words[i:i + step]).capitalize() + ".")
+            i += step
+        return " ".join(out)
+
+    def document(self, doc_id: int, n_words: int) -> str:
+        title = " ".join(w.capitalize() for w in self.words(3))
+        tags = ", ".join(self.words(3))
+        parts = [f"---\ntitle: {title}\ntags: [{tags}]\ndate: 2024-01-{1 + doc_id % 28:02d}\n---\n", f"# {title}\n",
+                 self.sentences(20) + "\n"]
+        written = 20
+        while written < n_words:
+            kind = self.rng.random()
+            if kind < 0.6:
+                parts.append(self.sentences(80) + "\n")
+                written += 80
+            elif kind < 0.9:
+                for _ in range(4):
+                    parts.append(f"- **{self.words(1)[0].capitalize()}:** {self.sentences(15)}")
+                parts.append("")
+                written += 64
+            else:
+                parts.append(f"See [{self.words(1)[0]}](https://example.com/{doc_id}) for details.\n\n```\ncode block {doc_id}\n```\n")
+                written += 4
+        return "\n".join(parts)
+
+    def write_corpus(self, docs_dir: str, n_chunks: int, words_per_chunk: int) -> int:
+        os.makedirs(docs_dir, exist_ok=True)
+        n_docs = max(1, n_chunks // CHUNKS_PER_DOC)
+        # Each chunk adds about words_per_chunk new words, so this many words yields about CHUNKS_PER_DOC chunks.
+        words_per_doc = words_per_chunk * CHUNKS_PER_DOC
+        for d in range(n_docs):
+            with open(os.path.join(docs_dir, f"doc_{d:07d}.md"), "w", encoding="utf-8") as f:
+                f.write(self.document(d, words_per_doc))
+        return n_docs
+
+def run_one(n_chunks: int, args, workdir: str) -> Dict[str, Any]:
+    stages: Dict[str, Any] = {}
+    docs_dir = os.path.join(workdir, f"docs_{n_chunks}")
+    index_dir = os.path.join(workdir, f"index_{n_chunks}")
+    os.makedirs(index_dir, exist_ok=True)
+
+    t = time.perf_counter()
+    # Word windows advance by (size - overlap) words. Token chunks hold roughly 0.75 words per token of English text.
+    words_per_chunk = idx.CHUNK_SIZE - idx.CHUNK_OVERLAP if args.chunker == "words" else int(idx.CHUNK_TOKENS * 0.75)
+    n_docs = CorpusGenerator(seed=args.seed).write_corpus(docs_dir, n_chunks, words_per_chunk)
+    stages["generate_corpus"] = stage(time.perf_counter() - t, n_docs)
+
+    # Documents are chunked one by one straight into a chunk store, only the first --encode-sample texts are kept for the encoder.
+    clean_sec = chunk_sec = read_sec = 0.0
+    writer = ChunkStoreWriter(index_dir)
+    sample_texts: List[str] = []
+    for name in sorted(os.listdir(docs_dir)):
+        path = os.path.join(docs_dir, name)
+        t = time.perf_counter()
+        raw = idx.read_text_file(path)
+        t1 = time.perf_counter()
+        text = idx.clean_markdown(raw)
+        t2 = time.perf_counter()
+        chunks = idx.chunk_text(text, idx.CHUNK_SIZE, idx.CHUNK_OVERLAP) if args.chunker == "words" else idx.chunk_document(path, raw, args.chunker)
+        t3 = time.perf_counter()
+        read_sec += t1 - t
+        clean_sec += t2 - t1
+        chunk_sec += t3 - t2
+        for ci, (c_text, start_word) in enumerate(chunks):
+            writer.add({"id": writer.count, "source": name, "chunk_index": ci, "start_word": start_word, "text": c_text})
+            if len(sample_texts) < args.encode_sample:
+                sample_texts.append(c_text)
+    n_real = writer.count
+    stages["read_file"] = stage(read_sec, n_docs)
+    stages["clean_markdown"] = stage(clean_sec, n_docs)
+    stages["chunk_text"] = stage(chunk_sec, n_real)
+    t = time.perf_counter()
+    writer.close()
+    stages["finalize_chunk_store"] = stage(time.perf_counter() - t, n_real)
+
+    # Only a sample is encoded to measure throughput, the index is built over synthetic vectors unless the sample covers the corpus.
+    vectors = None
+    dim = args.dim
+    if args.encode_sample > 0:
+        from sentence_transformers import SentenceTransformer
+        t = time.perf_counter()
+        model = SentenceTransformer(rag.EMBED_MODEL)
+        stages["model_load"] = stage(time.perf_counter() - t, 1)
+        t = time.perf_counter()
+        encoded = model.encode(sample_texts, batch_size=idx.EMBED_BATCH, convert_to_numpy=True, normalize_embeddings=True).astype("float32")
+        encode_sec = time.perf_counter() - t
+        stages["encode"] = stage(encode_sec, len(sample_texts), chunks_per_sec=round(len(sample_texts) / encode_sec, 2) if encode_sec else None,
+                                 estimated_full_corpus_sec=round(encode_sec * n_real / max(1, len(sample_texts)), 2))
+        dim = encoded.shape[1]
+        if len(encoded) == n_real:
+            vectors = encoded
+    if vectors is None:
+        from ann_report import synthetic_vectors
+        vectors = synthetic_vectors(n_real, dim, seed=args.seed)
+    ids = np.arange(n_real, dtype="int64")
+
+    t = time.perf_counter()
+    index = idx.build_index(vectors, ids)
+    stages["build_index"] = stage(time.perf_counter() - t, n_real, index_type=idx.index_type_of(index))
+    t = time.perf_counter()
+    store = rag.load_chunk_store(index_dir, docs_dir)
+    stages["load_chunk_store"] = stage(time.perf_counter() - t, len(store))
+    t = time.perf_counter()
+    build_lexical_index(index_dir, store)
+    stages["build_lexical_index"] = stage(time.perf_counter() - t, n_real)
+    lexical = open_lexical_index(index_dir, store.ids())
+
+    # Queries are corpus vectors with a little noise, so every search has real neighbours and the filters keep documents.
+    rng = np.random.default_rng(args.seed + 1)
+    rows = rng.choice(n_real, min(args.queries, n_real), replace=False)
+    queries = vectors[rows] + 0.05 * rng.standard_normal((len(rows), dim)).astype("float32")
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    k = min(rag.TOP_K, n_real)
+
+    search_lat, agg_lat, bm25_lat, prompt_lat, llm_lat = [], [], [], [], []
+    stub = start_stub_server(delay=0.0)
+    client = OllamaClient(host=stub.url)
+    try:
+        for qi in range(len(queries)):
+            t = time.perf_counter()
+            scores, hits = rag.faiss_search(queries[qi:qi + 1], k, index)
+            search_lat.append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            kept_docs = rag.rank_documents(hits[0], scores[0], store)
+            agg_lat.append(time.perf_counter() - t)
+
+            query_text = " ".join(tokenize(store[int(hits[0][0])]["text"])[:6])
+            t = time.perf_counter()
+            lexical.bm25(rag._query_tokens(query_text), k)
+            bm25_lat.append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            prompt = rag.build_prompt(query_text, rag.build_contexts(kept_docs))
+            prompt_lat.append(time.perf_counter() - t)
+
+            if qi < args.llm_calls:
+                t = time.perf_counter()
+                client.generate(["llama3.2"], prompt, rag.NUM_PREDICT_DETAILED, extra={"system": rag.prompt_header("detailed")})
+                llm_lat.append(time.perf_counter() - t)
+    finally:
+        stub.shutdown()
+        stub.server_close()
+        store.close()
+
+    stages["faiss_search"] = stage(sum(search_lat), len(search_lat), k=k, **percentiles(search_lat))
+    stages["aggregate_and_filter"] = stage(sum(agg_lat), len(agg_lat), **percentiles(agg_lat))
+    stages["bm25_search"] = stage(sum(bm25_lat), len(bm25_lat), **percentiles(bm25_lat))
+    stages["build_prompt"] = stage(sum(prompt_lat), len(prompt_lat), **percentiles(prompt_lat))
+    if llm_lat:
+        stages["llm_stub_roundtrip"] = stage(sum(llm_lat), len(llm_lat), **percentiles(llm_lat))
+
+    if not args.keep:
+        shutil.rmtree(docs_dir, ignore_errors=True)
+        shutil.rmtree(index_dir, ignore_errors=True)
+    return {"n_chunks_requested": n_chunks, "n_chunks": n_real, "n_docs": n_docs, "dim": int(dim), "stages": stages}
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Lines describing per-stage changes against a baseline report, matched by corpus size and stage name."""
+    lines = []
+    base_runs = {r["n_chunks_requested"]: r for r in baseline.get("runs", [])}
+    for run in report["runs"]:
+        base = base_runs.get(run["n_chunks_requested"])
+        if base is None:
+            continue
+        for name, st in run["stages"].items():
+            old = base["stages"].get(name)
+            metric = "p95_ms" if "p95_ms" in st else "per_item_ms"
+            if not old or not old.get(metric) or st.get(metric) is None:
+                continue
+            ratio = st[metric] / old[metric]
+            flag = "SLOWER" if ratio > 1 + threshold else "faster" if ratio < 1 - threshold else ""
+            lines.append(f"{run['n_chunks_requested']:>9} {name:<22} {metric:<12} {old[metric]:>12.4f} -> {st[metric]:>12.4f}  x{ratio:.2f} {flag}")
+    return lines
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Per-stage latency benchmark for the RAG agent over synthetic corpora.")
+    parser.add_argument("--chunks", default="10000", help="Comma-separated corpus sizes in chunks, e.g. 10000,100000,1000000.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--encode-sample", type=int, default=1000, help="Chunks encoded with the real model (0 skips the encoder).")
+    parser.add_argument("--dim", type=int, default=384, help="Vector dimension when the encoder is skipped.")
+    parser.add_argument("--llm-calls", type=int, default=20, help="Prompts sent to the local stub LLM per corpus.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="Where corpora and indexes are written (a temporary directory by default).")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated corpora and indexes.")
+    parser.add_argument("--out", default="bench_output.json")
+    parser.add_argument("--compare", help="An earlier report to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change reported as slower/faster.")
+    args = parser.parse_args(argv)
+    args.chunker = idx.resolve_chunker()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rag_bench_")
+    report = {
+        "version": rag.VERSION, "commit": git_commit(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(), "platform": platform.platform(),
+        "settings": {**{k: v for k, v in idx.index_settings(args.chunker).items() if k != "embed_model"}, "index_type": idx.INDEX_TYPE,
+                     "embed_model": rag.EMBED_MODEL, "top_k": rag.TOP_K, "queries": args.queries, "encode_sample": args.encode_sample},
+        "runs": [],
+    }
+    try:
+        for n in [int(x) for x in args.chunks.split(",") if x.strip()]:
+            print(f"--- Benchmarking {n} chunks ---", file=sys.stderr)
+            run = run_one(n, args, workdir)
+            report["runs"].append(run)
+            for name, st in run["stages"].items():
+                detail = f"p95 {st['p95_ms']:.3f} ms" if "p95_ms" in st else f"{st['per_item_ms']} ms/item"
+                print(f"  {name:<22} {st['total_sec']:>10.3f} s  ({detail})", file=sys.stderr)
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to '{args.out}'", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            lines = compare(report, json.load(f), args.threshold)
+        print("\n".join(lines) if lines else "Nothing to compare (no matching corpus sizes).")
+
+if __name__ == "__main__":
+    main()
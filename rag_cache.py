@@ -0,0 +1,79 @@
+# Small in-memory caches for the RAG engine, so /generate can reuse the retrieval the search step just did for the same query.
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RAG_RETRIEVAL_CACHE_SIZE", "256"))
+RETRIEVAL_CACHE_TTL_SEC = float(os.environ.get("RAG_RETRIEVAL_CACHE_TTL_SEC", "600"))
+
+def normalize_query(query: str) -> str:
+    """Lowercases and collapses whitespace so trivially different spellings of a query share a cache entry."""
+    return re.sub(r"\s+", " ", (query or "").strip().lower())
+
+class LRUTTLCache:
+    """
+    A thread-safe, bounded LRU cache where every entry also expires after a fixed time-to-live.
+    Hit/miss/eviction counters are kept so the size and TTL can be tuned from real traffic.
+    """
+
+    def __init__(self, max_size: int = RETRIEVAL_CACHE_SIZE, ttl_sec: float = RETRIEVAL_CACHE_TTL_SEC):
+        self.max_size = max(0, int(max_size))
+        self.ttl_sec = float(ttl_sec)
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            stored_at, value = item
+            if self.ttl_sec > 0 and time.monotonic() - stored_at > self.ttl_sec:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_size == 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def recent_keys(self, limit: int) -> List[Hashable]:
+        # The most recently used keys first, e.g. to replay popular queries against a freshly loaded index.
+        with self._lock:
+            return list(reversed(self._data))[:max(0, limit)]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl_sec": self.ttl_sec,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
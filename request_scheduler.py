@@ -0,0 +1,165 @@
+# Admission control for the web app: bounded slots, retrieval ahead of LLM work, and a quick 429/503 with Retry-After when overloaded.
+import os
+import math
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+
+# Requests running at once, of any kind.
+SCHED_WORKERS = int(os.environ.get("RAG_SCHED_WORKERS", "4"))
+# Of those, how many may be LLM work (generation, SQL agent). Ollama serves one model, so this is small.
+SCHED_LLM_SLOTS = int(os.environ.get("RAG_SCHED_LLM_SLOTS", "2"))
+# Requests allowed to wait for a slot. One more is rejected with 429.
+SCHED_MAX_QUEUE = int(os.environ.get("RAG_SCHED_MAX_QUEUE", "16"))
+# How long a request may wait for a slot before it is given up with 503.
+SCHED_MAX_WAIT_SEC = float(os.environ.get("RAG_SCHED_MAX_WAIT_SEC", "10"))
+
+RETRIEVAL = "retrieval"
+LLM = "llm"
+# Lower runs first.
+PRIORITY = {RETRIEVAL: 0, LLM: 1}
+# Starting guesses for how long each kind of request takes, refined from real traffic. Used for Retry-After.
+INITIAL_SERVICE_SEC = {RETRIEVAL: 0.2, LLM: 8.0}
+
+class Overloaded(Exception):
+    """Raised when a request isn't admitted. `status` is 429 (queue full) or 503 (waited too long)."""
+
+    def __init__(self, status: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+class Ticket:
+    __slots__ = ("kind", "priority", "seq", "enqueued_at", "started_at", "granted", "released")
+
+    def __init__(self, kind: str, seq: int):
+        self.kind = kind
+        self.priority = PRIORITY[kind]
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.started_at = 0.0
+        self.granted = False
+        self.released = False
+
+    def __lt__(self, other: "Ticket") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class RequestScheduler:
+    """
+    Priority scheduler with a bounded wait queue. acquire() blocks until the request may run and returns a ticket,
+    which must be passed to release() when the work is done (release is idempotent). Use slot() for the common case.
+    """
+
+    def __init__(self, workers: int = SCHED_WORKERS, llm_slots: int = SCHED_LLM_SLOTS,
+                 max_queue: int = SCHED_MAX_QUEUE, max_wait_sec: float = SCHED_MAX_WAIT_SEC):
+        self.workers = max(1, workers)
+        self.llm_slots = max(1, min(llm_slots, self.workers))
+        self.max_queue = max(0, max_queue)
+        self.max_wait_sec = max_wait_sec
+        self._cond = threading.Condition()
+        self._waiting: List[Ticket] = []
+        self._seq = itertools.count()
+        self._running = {RETRIEVAL: 0, LLM: 0}
+        self._service_sec = dict(INITIAL_SERVICE_SEC)
+        self._stats = {"admitted": 0, "completed": 0, "rejected_queue_full": 0, "rejected_timeout": 0, "wait_sec_total": 0.0}
+
+    def _can_run(self, kind: str) -> bool:
+        if sum(self._running.values()) >= self.workers:
+            return False
+        return kind != LLM or self._running[LLM] < self.llm_slots
+
+    def _dispatch(self) -> None:
+        # Grants slots in priority order. Only the head is checked, if it can't run nothing behind it can either.
+        granted = False
+        while self._waiting and self._can_run(self._waiting[0].kind):
+            ticket = heapq.heappop(self._waiting)
+            self._grant(ticket)
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _grant(self, ticket: Ticket) -> None:
+        ticket.granted = True
+        ticket.started_at = time.monotonic()
+        self._running[ticket.kind] += 1
+        self._stats["admitted"] += 1
+        self._stats["wait_sec_total"] += ticket.started_at - ticket.enqueued_at
+
+    def retry_after(self, kind: str) -> int:
+        # Rough seconds until a new request of this kind could start: the queue ahead of it drained by the available slots.
+        slots = self.llm_slots if kind == LLM else self.workers
+        estimate = (len(self._waiting) + 1) * self._service_sec[kind] / slots
+        return int(min(60, max(1, math.ceil(estimate))))
+
+    def acquire(self, kind: str) -> Ticket:
+        if kind not in PRIORITY:
+            raise ValueError(f"Unknown request kind '{kind}'.")
+        with self._cond:
+            ticket = Ticket(kind, next(self._seq))
+            if not self._waiting and self._can_run(kind):
+                self._grant(ticket)
+                return ticket
+            if len(self._waiting) >= self.max_queue:
+                self._stats["rejected_queue_full"] += 1
+                raise Overloaded(429, self.retry_after(kind), "Too many requests are waiting, please retry later.")
+            heapq.heappush(self._waiting, ticket)
+            self._dispatch()
+            deadline = ticket.enqueued_at + self.max_wait_sec
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._stats["rejected_timeout"] += 1
+                    # The head may have changed, so whoever is next gets a chance to run.
+                    self._dispatch()
+                    raise Overloaded(503, self.retry_after(kind), "The server is busy, please retry later.")
+                self._cond.wait(remaining)
+            return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        with self._cond:
+            if ticket.released or not ticket.granted:
+                return
+            ticket.released = True
+            self._running[ticket.kind] -= 1
+            self._stats["completed"] += 1
+            # Exponentially weighted service time per kind, for the Retry-After estimate.
+            elapsed = time.monotonic() - ticket.started_at
+            self._service_sec[ticket.kind] = 0.8 * self._service_sec[ticket.kind] + 0.2 * elapsed
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, kind: str) -> Iterator[Ticket]:
+        ticket = self.acquire(kind)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            out: Dict[str, Any] = dict(self._stats)
+            out["wait_sec_total"] = round(out["wait_sec_total"], 3)
+            out.update({
+                "workers": self.workers, "llm_slots": self.llm_slots, "max_queue": self.max_queue, "max_wait_sec": self.max_wait_sec,
+                "running": dict(self._running), "waiting": len(self._waiting),
+                "service_sec": {k: round(v, 3) for k, v in self._service_sec.items()},
+            })
+            return out
+
+    def collect(self):
+        # Metric families for rag_metrics.REGISTRY.add_collector.
+        st = self.stats()
+        return [
+            ("rag_scheduler_running", "gauge", "Requests currently holding a scheduler slot.", [({"kind": k}, v) for k, v in st["running"].items()]),
+            ("rag_scheduler_waiting", "gauge", "Requests waiting for a scheduler slot.", [({}, st["waiting"])]),
+            ("rag_scheduler_admitted_total", "counter", "Requests admitted by the scheduler.", [({}, st["admitted"])]),
+            ("rag_scheduler_rejected_total", "counter", "Requests turned away by the scheduler.",
+             [({"reason": "queue_full"}, st["rejected_queue_full"]), ({"reason": "timeout"}, st["rejected_timeout"])]),
+            ("rag_scheduler_wait_seconds_total", "counter", "Total time admitted requests spent waiting for a slot.", [({}, st["wait_sec_total"])]),
+        ]
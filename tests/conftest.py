@@ -0,0 +1,68 @@
+# The modules live in the project root, so the tests import them from there.
+import importlib
+import os
+import sys
+import types
+import tempfile
+import zlib
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Engines built in tests must not read or write the answer cache in the project folder.
+os.environ["RAG_ANSWER_CACHE"] = "0"
+# Nor the job database. generation_jobs reads this when it is first imported, so it is set before any test module loads.
+os.environ["RAG_JOBS_DB"] = os.path.join(tempfile.mkdtemp(prefix="rag-jobs-"), "jobs.db")
+
+DIM = 32
+
+class HashEncoder:
+    # Deterministic bag-of-words vectors, so indexes can be built and queried without downloading the embedding model.
+    encoded = []
+
+    def __init__(self, name=None):
+        pass
+
+    def encode(self, texts, **kwargs):
+        HashEncoder.encoded.extend(texts)
+        out = np.zeros((len(texts), DIM), dtype="float32")
+        for i, text in enumerate(texts):
+            for w in text.lower().split():
+                out[i, zlib.crc32(w.encode()) % DIM] += 1.0
+        out /= np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-6)
+        return out
+
+@pytest.fixture
+def build(tmp_path, monkeypatch):
+    """Runs mini_rag_index.main() on tmp_path/docs into tmp_path/index. Keyword arguments override the RAG_* settings."""
+    pytest.importorskip("faiss")
+    docs = tmp_path / "docs"
+    docs.mkdir()
+    monkeypatch.setitem(sys.modules, "sentence_transformers", types.SimpleNamespace(SentenceTransformer=HashEncoder))
+
+    def run(**env):
+        settings = {"RAG_DOCS_DIR": str(docs), "RAG_INDEX_DIR": str(tmp_path / "index"), "RAG_CHUNKER": "words",
+                    "RAG_CHUNK_SIZE": "20", "RAG_CHUNK_OVERLAP": "5", "RAG_INDEX_WORKERS": "1", "RAG_INDEX_TYPE": "flat"}
+        settings.update(env)
+        for key, value in settings.items():
+            monkeypatch.setenv(key, value)
+        import mini_rag_index
+        module = importlib.reload(mini_rag_index)
+        HashEncoder.encoded = []
+        module.main()
+        return module
+
+    run.docs = docs
+    run.index_dir = tmp_path / "index"
+    return run
+
+@pytest.fixture(scope="session")
+def web_app():
+    """The Flask app module (web/app.py), imported once per test session."""
+    pytest.importorskip("flask")
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "web"))
+    try:
+        return importlib.import_module("app")
+    finally:
+        sys.path.pop(0)
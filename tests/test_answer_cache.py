@@ -0,0 +1,43 @@
+import numpy as np
+
+from answer_cache import SemanticAnswerCache, answer_key
+
+def unit(*values):
+    vec = np.asarray(values, dtype="float32")
+    return vec / np.linalg.norm(vec)
+
+KEY = answer_key("concise", "llama3.2", "v1", [3, 1, 2])
+
+def test_paraphrase_with_same_chunks_hits():
+    cache = SemanticAnswerCache(path=None, min_sim=0.9)
+    cache.put(KEY, "What is a blockchain?", unit(1, 0.1, 0), "A ledger.")
+    assert cache.get(answer_key("concise", "llama3.2", "v1", [1, 2, 3]), "explain blockchains", unit(1, 0.12, 0)) == "A ledger."
+    assert cache.get(KEY, "something else", unit(0, 1, 0)) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+def test_key_must_match_exactly():
+    cache = SemanticAnswerCache(path=None, min_sim=0.9)
+    cache.put(KEY, "What is a blockchain?", unit(1, 0, 0), "A ledger.")
+    for key in [answer_key("detailed", "llama3.2", "v1", [1, 2, 3]), answer_key("concise", "llama3.2", "v2", [1, 2, 3]),
+                answer_key("concise", "llama3.2", "v1", [1, 2])]:
+        assert cache.get(key, "What is a blockchain?", unit(1, 0, 0)) is None
+
+def test_text_only_entries_and_lru_eviction():
+    cache = SemanticAnswerCache(path=None, max_size=2)
+    cache.put(KEY, "a", None, "A")
+    cache.put(KEY, "b", unit(0, 1, 0), "B")
+    assert cache.get(KEY, "  A ", None) == "A"
+    cache.put(KEY, "c", unit(0, 0, 1), "C")
+    assert cache.get(KEY, "b", unit(0, 1, 0)) is None
+    assert cache.get(KEY, "a", None) == "A" and cache.get(KEY, "c", unit(0, 0, 1)) == "C"
+    assert cache.stats()["evictions"] == 1
+
+def test_saved_entries_survive_a_restart(tmp_path):
+    path = str(tmp_path / "answers.json")
+    cache = SemanticAnswerCache(path=path, save_interval_sec=3600)
+    cache.put(KEY, "What is a blockchain?", unit(1, 0, 0), "A ledger.")
+    cache.put(KEY, "exact", None, "Exact.")
+    cache.save()
+    reloaded = SemanticAnswerCache(path=path)
+    assert reloaded.get(KEY, "blockchain?", unit(1, 0.05, 0)) == "A ledger."
+    assert reloaded.get(KEY, "exact", None) == "Exact."
@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+from chunk_store import ChunkStore, ChunkStoreWriter, has_chunk_store, open_chunk_store, store_files
+
+CHUNKS = [
+    {"id": 7, "source": "b.md", "chunk_index": 0, "start_word": 0, "text": "Grüße aus Köln — naïve café."},
+    {"id": 2, "source": "a.md", "chunk_index": 0, "start_word": 0, "text": "First chunk of a."},
+    {"id": 5, "source": "a.md", "chunk_index": 1, "start_word": 3, "text": ""},
+    {"id": 3, "source": "c.md", "chunk_index": 0, "start_word": 0, "text": "日本語のテキスト"},
+]
+
+def test_round_trip(tmp_path, monkeypatch):
+    # A small flush size, so records are written in several pieces.
+    monkeypatch.setattr(ChunkStoreWriter, "FLUSH_EVERY", 2)
+    writer = ChunkStoreWriter(str(tmp_path))
+    for md in CHUNKS:
+        writer.add(md)
+    writer.set_doc_attributes("a.md", {"tags": ["x"]})
+    writer.close()
+
+    store = open_chunk_store(str(tmp_path))
+    assert isinstance(store, ChunkStore)
+    # Records come back in ID order, whatever order they were added in.
+    assert list(store.ids()) == [2, 3, 5, 7] and len(store) == 4
+    for md in CHUNKS:
+        assert store[md["id"]] == md
+    assert 5 in store and 4 not in store
+    with pytest.raises(KeyError):
+        store[4]
+    assert [store.doc_name(d) for d in store.doc_ids()] == ["a.md", "c.md", "a.md", "b.md"]
+    assert list(store.chunk_indexes()) == [0, 0, 1, 0]
+    assert store.doc_attrs[store.sources.index("a.md")] == {"tags": ["x"]}
+    store.close()
+
+def test_nothing_is_visible_before_close(tmp_path):
+    writer = ChunkStoreWriter(str(tmp_path))
+    writer.add(CHUNKS[0])
+    assert not has_chunk_store(str(tmp_path))
+    writer.abort()
+    assert os.listdir(tmp_path) == []
+    with pytest.raises(FileNotFoundError):
+        open_chunk_store(str(tmp_path))
+
+def test_empty_store(tmp_path):
+    ChunkStoreWriter(str(tmp_path)).close()
+    assert all(os.path.exists(p) for p in store_files(str(tmp_path)))
+    store = open_chunk_store(str(tmp_path))
+    assert len(store) == 0 and list(store) == []
+    store.close()
@@ -0,0 +1,51 @@
+import json
+import string
+import sys
+
+import pytest
+
+def char_tokenizer():
+    # A WordPiece tokenizer with one piece per character, so even short sentences take many tokens. Built locally, nothing is downloaded.
+    tokenizers = pytest.importorskip("tokenizers")
+    specials = ["[UNK]", "[CLS]", "[SEP]"]
+    chars = string.ascii_lowercase + string.digits + string.punctuation
+    vocab = {tok: i for i, tok in enumerate(specials + list(chars) + ["##" + c for c in chars])}
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.WordPiece(vocab, unk_token="[UNK]"))
+    tokenizer.normalizer = tokenizers.normalizers.Lowercase()
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.BertPreTokenizer()
+    tokenizer.post_processor = tokenizers.processors.TemplateProcessing(
+        single="[CLS] $A [SEP]", special_tokens=[("[CLS]", vocab["[CLS]"]), ("[SEP]", vocab["[SEP]"])])
+    return tokenizer
+
+def test_token_chunks_stay_under_the_limit(monkeypatch):
+    import mini_rag_index
+    tokenizer = char_tokenizer()
+    monkeypatch.setattr(mini_rag_index, "_tokenizer", tokenizer)
+    raw = "\n".join([
+        "# Setup",
+        "Install the package. Then run the indexer once. It writes everything next to the documents.",
+        "",
+        "## Details",
+        "A very long sentence without any full stop that keeps going on and on about chunk limits and tokens " * 3,
+        "",
+        "Supercalifragilisticexpialidocious" * 3 + ".",
+        "- a list item",
+        "- another list item",
+    ])
+    limit = 32
+    chunks = mini_rag_index.chunk_by_tokens(raw, markdown=True, max_tokens=limit, min_tokens=8, overlap_sentences=0)
+    assert len(chunks) > 3
+    for text, _ in chunks:
+        assert len(tokenizer.encode(text, add_special_tokens=True).ids) <= limit
+    # Nothing is lost or repeated: without overlap the chunks hold every word of the text in order.
+    expected = " ".join(mini_rag_index.clean_markdown(raw).split())
+    assert "".join("".join(text.split()) for text, _ in chunks) == "".join(expected.split())
+
+def test_fallback_chunker_is_recorded(build, monkeypatch):
+    (build.docs / "a.md").write_text("The tokenizer is missing, so this is chunked by words.", encoding="utf-8")
+    # No tokenizers package: the token chunker falls back to word windows, and the manifest has to say so.
+    monkeypatch.setitem(sys.modules, "tokenizers", None)
+    module = build(RAG_CHUNKER="tokens")
+    with open(build.index_dir / "manifest.json", encoding="utf-8") as f:
+        settings = json.load(f)["settings"]
+    assert settings == module.index_settings("words") and settings["chunker"] == "words"
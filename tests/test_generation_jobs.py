@@ -0,0 +1,60 @@
+import os
+import threading
+import time
+
+from generation_jobs import DONE, FAILED, ROOT_DIR, JobManager
+from request_scheduler import LLM, RequestScheduler
+
+JOBS_DB_IN_REPO = os.path.join(ROOT_DIR, ".jobs", "jobs.db")
+
+def test_identical_jobs_are_coalesced(tmp_path):
+    release = threading.Event()
+    calls = []
+    def run(params):
+        calls.append(params)
+        release.wait(2)
+        return {"answer": params["query"].upper()}
+    jobs = JobManager(run, path=str(tmp_path / "jobs.db"), workers=1)
+    first, coalesced = jobs.submit("q|detailed|v1", {"query": "q"})
+    assert not coalesced
+    second, coalesced = jobs.submit("q|detailed|v1", {"query": "q"})
+    assert coalesced and second["job_id"] == first["job_id"]
+    assert jobs.wait(first["job_id"], 0.05)["status"] not in (DONE, FAILED)
+    release.set()
+    job = jobs.wait(first["job_id"], 2)
+    assert job["status"] == DONE and job["result"] == {"answer": "Q"} and job["submitters"] == 2
+    assert len(calls) == 1
+    # Once finished, the same key starts a new job.
+    assert jobs.submit("q|detailed|v1", {"query": "q"})[1] is False
+
+def test_error_result_and_exception_fail_the_job(tmp_path):
+    def run(params):
+        if params["query"] == "boom":
+            raise RuntimeError("boom")
+        return {"error": "bad filter"}
+    jobs = JobManager(run, path=str(tmp_path / "jobs.db"), workers=1)
+    job = jobs.wait(jobs.submit("a", {"query": "a"})[0]["job_id"], 2)
+    assert job["status"] == FAILED and job["error"] == "bad filter"
+    job = jobs.wait(jobs.submit("b", {"query": "boom"})[0]["job_id"], 2)
+    assert job["status"] == FAILED and job["error"] == "boom" and job["result"] is None
+
+def test_unfinished_jobs_resume_after_restart(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    stalled = JobManager(lambda params: time.sleep(60), path=path, workers=1)
+    job_id = stalled.submit("k", {"query": "q"})[0]["job_id"]
+    time.sleep(0.05)
+    restarted = JobManager(lambda params: {"answer": "again"}, path=path, workers=1)
+    job = restarted.wait(job_id, 2)
+    assert job["status"] == DONE and job["result"] == {"answer": "again"}
+    assert restarted.stats()["resumed"] == 1
+
+def test_job_fails_when_never_admitted(web_app, monkeypatch):
+    assert web_app.jobs.path != JOBS_DB_IN_REPO
+    sched = RequestScheduler(workers=1, llm_slots=1, max_queue=4, max_wait_sec=0.05)
+    held = sched.acquire(LLM)
+    monkeypatch.setattr(web_app, "scheduler", sched)
+    monkeypatch.setattr(web_app, "JOB_ADMIT_TIMEOUT_SEC", 0.3)
+    t = time.monotonic()
+    result = web_app.run_generation_job({"query": "q", "mode": "detailed", "corpus": None})
+    assert "error" in result and time.monotonic() - t < 1.0
+    sched.release(held)
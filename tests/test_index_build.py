@@ -0,0 +1,121 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from conftest import HashEncoder
+
+faiss = pytest.importorskip("faiss")
+
+def doc_text(topic, n=60):
+    return " ".join(f"{topic}{i % 17} word{i}" for i in range(n))
+
+def read_state(index_dir):
+    from chunk_store import open_chunk_store
+    store = open_chunk_store(str(index_dir))
+    ids = np.asarray(store.ids()).copy()
+    rows = {int(i): (store[int(i)]["source"], store[int(i)]["text"]) for i in ids}
+    store.close()
+    emb = np.load(index_dir / "embeddings.npy")
+    index = faiss.read_index(str(index_dir / "faiss.index"))
+    with open(index_dir / "manifest.json", encoding="utf-8") as f:
+        manifest = json.load(f)
+    return ids, rows, emb, index, manifest
+
+def test_incremental_rebuild(build):
+    for name, topic in (("a.md", "alpha"), ("b.md", "beta"), ("c.txt", "gamma")):
+        (build.docs / name).write_text(doc_text(topic), encoding="utf-8")
+    build()
+    first = len(HashEncoder.encoded)
+    ids, rows, emb, index, manifest = read_state(build.index_dir)
+    assert first == len(ids) == index.ntotal == emb.shape[0]
+    assert set(manifest["documents"]) == {"a.md", "b.md", "c.txt"}
+
+    # Nothing changed: nothing is embedded.
+    build()
+    assert HashEncoder.encoded == []
+
+    # One changed document only re-embeds its changed chunks, a removed one takes its chunks along.
+    (build.docs / "a.md").write_text(doc_text("alpha") + " and a new ending", encoding="utf-8")
+    (build.docs / "c.txt").unlink()
+    build()
+    assert 0 < len(HashEncoder.encoded) <= 2
+    ids2, rows2, emb2, index2, manifest2 = read_state(build.index_dir)
+    assert set(manifest2["documents"]) == {"a.md", "b.md"}
+    assert {src for src, _ in rows2.values()} == {"a.md", "b.md"}
+    assert index2.ntotal == len(ids2) == emb2.shape[0]
+    # Unchanged chunks keep their IDs and vectors.
+    kept = [i for i in ids2 if i in rows and rows[i] == rows2[i]]
+    assert len(kept) >= len(ids2) - 2
+    for i in kept:
+        assert np.allclose(emb2[np.searchsorted(ids2, i)], emb[np.searchsorted(ids, i)])
+
+def test_parallel_build_matches_serial(build, tmp_path):
+    for i in range(8):
+        (build.docs / f"{i:02d}_doc.md").write_text(doc_text(f"topic{i}", 40 + 7 * i), encoding="utf-8")
+    build(RAG_INDEX_WORKERS="1")
+    serial = read_state(build.index_dir)
+    build(RAG_INDEX_WORKERS="3", RAG_INDEX_DIR=str(tmp_path / "index_parallel"))
+    parallel = read_state(tmp_path / "index_parallel")
+    assert np.array_equal(serial[0], parallel[0])
+    assert serial[1] == parallel[1]
+    assert np.allclose(serial[2], parallel[2])
+
+def test_embeddings_recovered_from_ivf_index(build):
+    for i in range(12):
+        (build.docs / f"doc{i}.md").write_text(doc_text(f"t{i}"), encoding="utf-8")
+    env = {"RAG_INDEX_TYPE": "ivf", "RAG_IVF_NLIST": "2", "RAG_IVF_NPROBE": "2"}
+    module = build(**env)
+    ids, _, emb, index, _ = read_state(build.index_dir)
+    assert module.index_type_of(index) == "ivf"
+
+    # Without a previous embeddings.npy, the unchanged vectors are read back from the IVF index.
+    os.remove(build.index_dir / "embeddings.npy")
+    (build.docs / "doc0.md").write_text(doc_text("t0") + " changed", encoding="utf-8")
+    build(**env)
+    ids2, _, emb2, _, _ = read_state(build.index_dir)
+    assert emb2.shape[0] == len(ids2)
+    for i in set(ids) & set(ids2):
+        assert np.allclose(emb2[np.searchsorted(ids2, i)], emb[np.searchsorted(ids, i)], atol=1e-6)
+
+@pytest.mark.parametrize("index_type, env, search_params", [
+    ("ivf", {"RAG_IVF_NLIST": "2", "RAG_IVF_NPROBE": "2"}, {"nprobe": 2}),
+    ("hnsw", {"RAG_HNSW_M": "8", "RAG_HNSW_EF_SEARCH": "40"}, {"efSearch": 40}),
+])
+def test_ann_search_params_are_applied_on_load(build, index_type, env, search_params):
+    for i in range(12):
+        (build.docs / f"doc{i}.md").write_text(doc_text(f"t{i}"), encoding="utf-8")
+    build(RAG_INDEX_TYPE=index_type, **env)
+    with open(build.index_dir / "index_params.json", encoding="utf-8") as f:
+        params = json.load(f)
+    assert params["type"] == index_type and params["search_params"] == search_params
+    import mini_rag_answer
+    index = mini_rag_answer.load_faiss_index(str(build.index_dir / "faiss.index"))
+    if index_type == "ivf":
+        assert faiss.extract_index_ivf(index).nprobe == 2
+    else:
+        assert faiss.downcast_index(faiss.downcast_index(index).index).hnsw.efSearch == 40
+
+    # HNSW can't delete, so removing a document rebuilds it without the document's vectors.
+    (build.docs / "doc0.md").unlink()
+    module = build(RAG_INDEX_TYPE=index_type, **env)
+    ids, rows, _, index, _ = read_state(build.index_dir)
+    assert module.index_type_of(index) == index_type and index.ntotal == len(ids)
+    assert "doc0.md" not in {src for src, _ in rows.values()}
+
+def test_small_corpus_falls_back_to_flat(build):
+    (build.docs / "a.md").write_text(doc_text("a"), encoding="utf-8")
+    module = build(RAG_INDEX_TYPE="ivf")
+    with open(build.index_dir / "index_params.json", encoding="utf-8") as f:
+        assert json.load(f) == {"type": "flat", "ntotal": read_state(build.index_dir)[3].ntotal, "search_params": {}}
+    assert module.index_type_of(faiss.read_index(str(build.index_dir / "faiss.index"))) == "flat"
+
+def test_ann_report_recall():
+    from ann_report import run_report, synthetic_vectors
+    report = run_report(synthetic_vectors(2000, 16), n_queries=20, k=5, types=["flat", "ivf"], nlist=8, hnsw_m=8, pq_m=4, pq_nbits=4)
+    flat = [r for r in report["results"] if r["index_type"] == "flat"]
+    ivf = {r["search_params"]["nprobe"]: r["recall_at_k"] for r in report["results"] if r["index_type"] == "ivf"}
+    assert [r["recall_at_k"] for r in flat] == [1.0]
+    # nprobe values above nlist are skipped, and probing every list is exact again.
+    assert sorted(ivf) == [1, 2, 4, 8] and ivf[8] == 1.0 and ivf[1] <= ivf[8]
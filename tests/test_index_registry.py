@@ -0,0 +1,149 @@
+import threading
+import time
+
+import pytest
+
+import index_registry
+from index_registry import Corpus, IndexRegistry, load_corpora
+from index_versions import CURRENT_FILE, current_version
+from rag_cache import LRUTTLCache
+
+MB = 1024 * 1024
+
+class FakeEngine:
+    # Stands in for a RagEngine: a size for the memory budget and the embedder it was given.
+    def __init__(self, corpus, registry, size_mb=1.0):
+        self.corpus = corpus.name
+        self.embedder = registry.embedder("model")
+        self.size = int(size_mb * MB)
+        self.build_version = None
+
+    def memory_bytes(self):
+        return self.size
+
+def corpora(*names, root="/nonexistent"):
+    return {n: Corpus(n, n.upper(), f"{root}/docs_{n}", f"{root}/index_{n}") for n in names}
+
+def test_engines_load_on_first_use_and_share_the_embedder():
+    loads, embedders = [], []
+    def factory(corpus, registry):
+        loads.append(corpus.name)
+        return FakeEngine(corpus, registry)
+    registry = IndexRegistry(corpora("a", "b"), engine_factory=factory, embedder_factory=lambda name: embedders.append(name) or object())
+    assert registry.loaded() == {} and loads == []
+    a = registry.get("a")
+    assert registry.get("a") is a and loads == ["a"]
+    b = registry.get("b")
+    assert b.embedder is a.embedder and embedders == ["model"]
+    assert registry.stats()["loads"] == 2 and registry.stats()["hits"] == 1
+    with pytest.raises(KeyError):
+        registry.get("nope")
+
+def test_least_recently_used_engine_is_evicted_over_budget():
+    registry = IndexRegistry(corpora("a", "b", "c"), memory_budget_mb=2.5, engine_factory=FakeEngine, embedder_factory=lambda name: object())
+    registry.get("a")
+    b = registry.get("b")
+    registry.get("a")
+    registry.get("c")
+    # "b" was used least recently, so it goes to make room for "c". Requests still holding it keep a working engine.
+    assert list(registry.loaded()) == ["a", "c"] and b.corpus == "b"
+    assert registry.stats()["evictions"] == 1
+    registry.get("b")
+    assert list(registry.loaded()) == ["c", "b"] and registry.stats()["loads"] == 4
+
+def test_engine_bigger_than_the_budget_still_loads():
+    registry = IndexRegistry(corpora("a", "b"), memory_budget_mb=1.0,
+                             engine_factory=lambda c, r: FakeEngine(c, r, size_mb=3.0), embedder_factory=lambda name: object())
+    registry.get("a")
+    registry.get("b")
+    assert list(registry.loaded()) == ["b"]
+
+def test_concurrent_first_requests_load_once():
+    started, release = threading.Event(), threading.Event()
+    loads = []
+    def factory(corpus, registry):
+        loads.append(corpus.name)
+        if corpus.name == "a":
+            started.set()
+            release.wait(2)
+        return FakeEngine(corpus, registry)
+    registry = IndexRegistry(corpora("a", "b"), engine_factory=factory, embedder_factory=lambda name: object())
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get("a"))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    assert started.wait(2)
+    # Loading "a" doesn't hold up requests for other corpora.
+    assert registry.get("b").corpus == "b" and not release.is_set()
+    release.set()
+    for t in threads:
+        t.join()
+    assert loads == ["a", "b"] and len(results) == 4 and all(e is results[0] for e in results)
+
+def test_failed_load_is_counted_and_retried():
+    attempts = []
+    def factory(corpus, registry):
+        attempts.append(corpus.name)
+        if len(attempts) == 1:
+            raise FileNotFoundError("no index yet")
+        return FakeEngine(corpus, registry)
+    registry = IndexRegistry(corpora("a"), engine_factory=factory, embedder_factory=lambda name: object())
+    with pytest.raises(FileNotFoundError):
+        registry.get("a")
+    assert registry.get("a").corpus == "a"
+    assert registry.stats()["load_failures"] == 1 and attempts == ["a", "a"]
+
+def test_corpora_file(tmp_path):
+    path = tmp_path / "corpora.json"
+    path.write_text('{"x": {"docs_dir": "docs_x", "index_dir": "index_x", "title": "X"}, "y": {"docs_dir": "d", "index_dir": "i"}}', encoding="utf-8")
+    loaded = load_corpora(str(path))
+    assert list(loaded) == ["x", "y"] and loaded["x"].title == "X" and loaded["y"].title == "y"
+    path.write_text('{"x": {"docs_dir": "docs_x"}}', encoding="utf-8")
+    with pytest.raises(ValueError):
+        load_corpora(str(path))
+    assert set(load_corpora(str(tmp_path / "missing.json"))) == {"s1", "s2"}
+
+class VersionedEngine(FakeEngine):
+    # Loads whatever version CURRENT names, like RagEngine does, and records the queries it was warmed up with.
+    def __init__(self, corpus, registry):
+        super().__init__(corpus, registry)
+        self.build_version = current_version(corpus.index_dir)
+        if self.build_version == "broken":
+            raise ValueError("unreadable index")
+        self.retrieval_cache = LRUTTLCache()
+        self.warmed = None
+
+    def warm_up(self, queries):
+        self.warmed = list(queries)
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+def test_published_version_is_swapped_in(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_registry, "INDEX_CHECK_SEC", 0.0)
+    root = tmp_path / "index_a"
+    root.mkdir()
+    (root / CURRENT_FILE).write_text("v1\n", encoding="utf-8")
+    registry = IndexRegistry({"a": Corpus("a", "A", str(tmp_path / "docs_a"), str(root))},
+                             engine_factory=VersionedEngine, embedder_factory=lambda name: object())
+    old = registry.get("a")
+    old.retrieval_cache.put(("invoice tax", "index version", ""), {})
+    assert old.build_version == "v1"
+
+    # The new version loads in the background while the old engine keeps answering.
+    (root / CURRENT_FILE).write_text("v2\n", encoding="utf-8")
+    assert registry.get("a") is old
+    wait_for(lambda: registry.loaded()["a"].build_version == "v2")
+    new = registry.get("a")
+    assert new.warmed == ["invoice tax"] and new.embedder is old.embedder
+    assert registry.stats()["swaps"] == 1 and registry.stats()["versions"] == {"a": "v2"}
+
+    # A version that fails to load leaves the running engine in place and isn't tried again.
+    (root / CURRENT_FILE).write_text("broken\n", encoding="utf-8")
+    registry.get("a")
+    wait_for(lambda: registry.stats()["swap_failures"] == 1 and not registry.stats()["swapping"])
+    assert registry.get("a") is new and registry.get("a") is new
+    assert registry.stats()["swap_failures"] == 1
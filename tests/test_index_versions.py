@@ -0,0 +1,63 @@
+import os
+import shutil
+
+from conftest import HashEncoder
+from doc_filters import parse_filter
+from index_versions import CURRENT_FILE, VERSIONS_DIR, prune_versions
+
+def publish(root, version, source=None):
+    folder = root / VERSIONS_DIR / version
+    if source is not None:
+        shutil.copytree(source, folder)
+    else:
+        folder.mkdir(parents=True)
+    (root / CURRENT_FILE).write_text(version + "\n", encoding="utf-8")
+
+def test_engine_keeps_working_after_its_version_is_pruned(build, tmp_path):
+    for i in range(4):
+        (build.docs / f"{i:02d}_doc.md").write_text(f"Document {i} is about topic{i} and nothing else.", encoding="utf-8")
+    build()
+    import mini_rag_answer
+    root = tmp_path / "versioned"
+    publish(root, "v1", build.index_dir)
+    engine = mini_rag_answer.RagEngine(str(build.docs), str(root), embedder=HashEncoder())
+    assert engine.build_version == "v1" and engine.memory_bytes() == engine.index_bytes
+
+    publish(root, "v2")
+    prune_versions(str(root), keep=1)
+    assert not os.path.exists(root / VERSIONS_DIR / "v1")
+    # The numpy fallback and filtered searches read embeddings.npy, which was mapped when the engine loaded.
+    assert engine._fallback_embeddings().shape[0] == len(engine.store)
+    result = engine.answer("topic2", "none", doc_filter=parse_filter("source:02_*"))
+    assert [d["name"] for d in result["relevant_docs"]] == ["02_doc.md"]
+
+def test_staged_builds_leave_the_live_version_alone(build, tmp_path):
+    from index_versions import discard_version, publish_version, stage_version, unchanged
+    root = tmp_path / "versioned"
+    root.mkdir()
+    for i in range(3):
+        (build.docs / f"{i:02d}_doc.md").write_text(f"Document {i} is about topic{i} and nothing else.", encoding="utf-8")
+    _, staging = stage_version(str(root))
+    build(RAG_INDEX_DIR=staging)
+    publish_version(str(root), "v1", staging)
+    live = root / VERSIONS_DIR / "v1"
+    before = {p.name: p.read_bytes() for p in live.iterdir()}
+
+    # Nothing changed: the staged build is the live one and isn't published.
+    _, staging = stage_version(str(root))
+    build(RAG_INDEX_DIR=staging)
+    assert unchanged(str(root), staging)
+    discard_version(staging)
+
+    # An incremental build starts from the live files (hard links) but never writes into them.
+    (build.docs / "01_doc.md").write_text("Document 1 is now about volcanoes.", encoding="utf-8")
+    _, staging = stage_version(str(root))
+    build(RAG_INDEX_DIR=staging)
+    assert not unchanged(str(root), staging)
+    assert {p.name: p.read_bytes() for p in live.iterdir()} == before
+    publish_version(str(root), "v2", staging)
+
+    import mini_rag_answer
+    engine = mini_rag_answer.RagEngine(str(build.docs), str(root), embedder=HashEncoder())
+    assert engine.build_version == "v2" and (root / CURRENT_FILE).read_text(encoding="utf-8").strip() == "v2"
+    assert [d["name"] for d in engine.answer("volcanoes", "none")["relevant_docs"]] == ["01_doc.md"]
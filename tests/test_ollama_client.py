@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+
+from ollama_client import CircuitBreaker, OllamaClient
+from ollama_stub import start_stub_server
+
+@pytest.fixture
+def stub():
+    servers = []
+    def start(**kwargs):
+        server = start_stub_server(**kwargs)
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def test_generate(stub):
+    server = stub(answer="hello there")
+    client = OllamaClient(server.url, keep_alive="")
+    assert client.generate(["llama3.2"], "hi", 16) == "hello there"
+    assert "".join(client.generate_stream(["llama3.2"], "hi", 16)) == "hello there"
+
+def test_stream_reports_completion(stub):
+    server = stub(answer="a b c")
+    client = OllamaClient(server.url)
+    stream = client.generate_stream(["llama3.2"], "hi", 16)
+    pieces = []
+    with pytest.raises(StopIteration) as stop:
+        while True:
+            pieces.append(next(stream))
+    assert "".join(pieces) == "a b c" and stop.value.value is True
+
+def test_model_fallthrough_on_404(stub):
+    server = stub(answer="from b", models=["b"])
+    client = OllamaClient(server.url)
+    assert client.generate(["a", "b"], "hi", 16) == "from b"
+    assert "".join(client.generate_stream(["a", "b"], "hi", 16)) == "from b"
+    # A missing model is not a backend failure.
+    assert client.breaker.state == "closed"
+    assert client.generate(["a"], "hi", 16) is None
+
+def test_garbled_body_is_a_failed_attempt(stub):
+    server = stub(garble=True)
+    client = OllamaClient(server.url, attempts_per_model=2, breaker=CircuitBreaker(failure_threshold=5))
+    assert client.generate(["llama3.2"], "hi", 16) is None
+    assert client.stats()["failures"] == 2
+    assert server.request_count == 2
+
+def test_breaker_opens_and_goes_half_open(stub):
+    server = stub(fail=True)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=1.0)
+    client = OllamaClient(server.url, attempts_per_model=1, breaker=breaker)
+    assert client.generate(["llama3.2"], "hi", 16) is None
+    assert client.generate(["llama3.2"], "hi", 16) is None
+    assert breaker.state == "open"
+    # While open, calls fail fast without reaching the server.
+    sent = server.request_count
+    assert client.generate(["llama3.2"], "hi", 16) is None
+    assert server.request_count == sent and client.stats()["short_circuited"] >= 1
+    # After the reset timeout one trial goes through; its success closes the breaker.
+    time.sleep(1.05)
+    server.fail = False
+    assert client.generate(["llama3.2"], "hi", 16)
+    assert breaker.state == "closed"
+
+def test_failed_half_open_trial_reopens():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow() and breaker.state == "half_open"
+    # Only one trial at a time.
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+def test_stream_deadline_is_a_hard_bound(stub):
+    server = stub(answer="one two three four five", delay=0.5)
+    client = OllamaClient(server.url)
+    t0 = time.monotonic()
+    stream = client.generate_stream(["llama3.2"], "hi", 16, deadline_sec=1.2)
+    pieces = []
+    with pytest.raises(StopIteration) as stop:
+        while True:
+            pieces.append(next(stream))
+    elapsed = time.monotonic() - t0
+    assert elapsed < 1.35
+    assert 1 <= len(pieces) < 5 and not stop.value.value
+    assert client.stats()["timeouts"] == 1
+    assert client.breaker.state == "closed"
+
+def test_generate_deadline(stub):
+    server = stub(delay=0.5)
+    client = OllamaClient(server.url, attempts_per_model=1)
+    t0 = time.monotonic()
+    assert client.generate(["llama3.2"], "hi", 16, deadline_sec=0.3) is None
+    assert time.monotonic() - t0 < 0.6
+
+def test_concurrency_limit(stub):
+    server = stub(answer="a b c d", delay=0.05)
+    client = OllamaClient(server.url, max_concurrent=2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(client.generate(["llama3.2"], "hi", 16))) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ["a b c d"] * 6
+    assert server.peak_active == 2
+    assert client.stats()["in_flight"] == 0
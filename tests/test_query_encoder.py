@@ -0,0 +1,64 @@
+import sys
+
+import numpy as np
+import pytest
+
+import query_encoder
+from conftest import DIM, HashEncoder
+
+DOCS = {
+    "invoices.md": "Invoices are due within thirty days. Late invoices get a reminder and then a fee.",
+    "travel.md": "Travel costs are refunded after the trip. Keep every receipt and hand them in with the form.",
+    "holidays.md": "Holidays are booked in the planner. Ask your manager first and book at least two weeks ahead.",
+    "laptops.md": "Laptops are replaced every four years. Broken laptops go back to the service desk.",
+}
+
+class ShuffledEncoder(HashEncoder):
+    # An "int8" encoder that got it badly wrong: the vector dimensions come out permuted.
+    def __init__(self, path=None):
+        self.order = np.random.default_rng(0).permutation(DIM)
+
+    def encode(self, texts, **kwargs):
+        return super().encode(texts, **kwargs)[:, self.order]
+
+@pytest.fixture
+def index_dir(build, monkeypatch):
+    for name, text in DOCS.items():
+        (build.docs / name).write_text(text, encoding="utf-8")
+    build(RAG_CHUNK_SIZE="8", RAG_CHUNK_OVERLAP="2")
+    # No model download and no export: the fp32 model is the hash encoder and the export is already "cached".
+    monkeypatch.setattr(query_encoder, "load_fp32_encoder", lambda model_name=None: HashEncoder())
+    monkeypatch.setattr(query_encoder, "export_int8", lambda *args, **kwargs: None)
+    return str(build.index_dir)
+
+def test_same_vectors_give_full_overlap(index_dir, monkeypatch):
+    monkeypatch.setattr(query_encoder, "Int8QueryEncoder", HashEncoder)
+    queries = query_encoder.sample_queries(index_dir, 5)
+    assert len(queries) == 5 and all(len(q.split()) <= 24 for q in queries)
+    report = query_encoder.check_overlap(index_dir, queries, k=3)
+    assert report["n_queries"] == 5 and report["k"] == 3
+    assert report["mean_overlap"] == report["min_overlap"] == report["top1_agreement"] == 1.0
+    for kind in query_encoder.ENCODER_KINDS:
+        assert report[kind]["p95_ms"] >= report[kind]["p50_ms"] >= 0
+
+def test_check_fails_below_the_minimum_overlap(index_dir, monkeypatch, capsys):
+    monkeypatch.setattr(query_encoder, "Int8QueryEncoder", ShuffledEncoder)
+    queries = [text.split(".")[0] for text in DOCS.values()]
+    report = query_encoder.check_overlap(index_dir, queries, k=2)
+    assert report["mean_overlap"] < 1.0 and report["min_overlap"] <= report["mean_overlap"]
+    with pytest.raises(SystemExit) as exit_info:
+        query_encoder.main(["check", "--index-dir", index_dir, "--n", "4", "--k", "2", "--min-overlap", "1.0"])
+    assert exit_info.value.code == 1
+    assert "FAIL" in capsys.readouterr().out
+
+def test_int8_falls_back_to_fp32(monkeypatch, tmp_path, capsys):
+    fp32 = object()
+    monkeypatch.setattr(query_encoder, "load_fp32_encoder", lambda model_name=None: fp32)
+    # Without onnxruntime the export can't run, and the engine still gets an encoder.
+    monkeypatch.setitem(sys.modules, "onnxruntime", None)
+    monkeypatch.setitem(sys.modules, "onnxruntime.quantization", None)
+    monkeypatch.setitem(sys.modules, "torch", None)
+    assert query_encoder.load_query_encoder("some/model", kind="int8", cache_dir=str(tmp_path)) is fp32
+    assert "using the fp32 model" in capsys.readouterr().err
+    with pytest.raises(ValueError):
+        query_encoder.load_query_encoder("some/model", kind="fp16")
@@ -0,0 +1,43 @@
+import json
+import sys
+
+import pytest
+
+pytest.importorskip("faiss")
+
+import rag_bench
+
+def test_corpus_generator_is_deterministic(tmp_path):
+    first, second = rag_bench.CorpusGenerator(seed=3), rag_bench.CorpusGenerator(seed=3)
+    assert first.document(0, 200) == second.document(0, 200)
+    assert rag_bench.CorpusGenerator(seed=4).document(0, 200) != first.document(0, 200)
+    assert first.write_corpus(str(tmp_path), n_chunks=60, words_per_chunk=10) == 60 // rag_bench.CHUNKS_PER_DOC
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["doc_0000000.md", "doc_0000001.md", "doc_0000002.md"]
+
+def test_small_run_reports_every_stage(tmp_path, monkeypatch):
+    # Without the tokenizers package the token chunker falls back to word windows, so nothing is downloaded.
+    monkeypatch.setitem(sys.modules, "tokenizers", None)
+    out = tmp_path / "bench.json"
+    rag_bench.main(["--chunks", "200", "--queries", "10", "--encode-sample", "0", "--dim", "16", "--llm-calls", "2",
+                    "--workdir", str(tmp_path / "work"), "--out", str(out)])
+    with open(out, encoding="utf-8") as f:
+        report = json.load(f)
+    assert report["settings"]["chunker"] == "words"
+    run, = report["runs"]
+    assert run["n_docs"] == 200 // rag_bench.CHUNKS_PER_DOC and run["n_chunks"] > 0 and run["dim"] == 16
+    for name in ("generate_corpus", "chunk_text", "build_index", "build_lexical_index", "faiss_search", "bm25_search", "build_prompt"):
+        assert run["stages"][name]["total_sec"] >= 0
+    assert run["stages"]["faiss_search"]["items"] == 10 and "p95_ms" in run["stages"]["faiss_search"]
+    assert run["stages"]["llm_stub_roundtrip"]["items"] == 2
+    # The corpus and index are removed afterwards unless --keep is given.
+    assert list((tmp_path / "work").iterdir()) == []
+
+def test_compare_flags_changes_beyond_the_threshold():
+    def report(search_p95, chunk_ms):
+        return {"runs": [{"n_chunks_requested": 1000, "stages": {
+            "faiss_search": {"p95_ms": search_p95, "per_item_ms": 0.1}, "chunk_text": {"per_item_ms": chunk_ms}}}]}
+    lines = rag_bench.compare(report(2.0, 0.5), report(1.0, 1.0), threshold=0.1)
+    assert len(lines) == 2
+    assert "faiss_search" in lines[0] and "p95_ms" in lines[0] and lines[0].endswith("SLOWER")
+    assert "chunk_text" in lines[1] and lines[1].endswith("faster")
+    assert rag_bench.compare(report(1.0, 1.0), {"runs": []}, threshold=0.1) == []
@@ -0,0 +1,31 @@
+import time
+
+from rag_cache import LRUTTLCache, normalize_query
+
+def test_normalize_query():
+    assert normalize_query("  What IS\n a   Blockchain ") == "what is a blockchain"
+    assert normalize_query(None) == ""
+
+def test_lru_eviction():
+    cache = LRUTTLCache(max_size=2, ttl_sec=0)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+def test_ttl_expiry():
+    cache = LRUTTLCache(max_size=4, ttl_sec=0.05)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.08)
+    assert cache.get("a") is None
+    st = cache.stats()
+    assert st["expirations"] == 1 and st["hits"] == 1 and st["misses"] == 1
+
+def test_size_zero_disables():
+    cache = LRUTTLCache(max_size=0)
+    cache.put("a", 1)
+    assert cache.get("a") is None
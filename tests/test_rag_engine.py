@@ -0,0 +1,190 @@
+import os
+
+import pytest
+
+from conftest import HashEncoder
+
+DOCS = {
+    "a.md": "The order total is the sum of all line items in the shopping cart before shipping.",
+    "b.md": "Each order lists its line items, and the invoice shows a total that includes tax.",
+    "c.md": "The total order volume grew steadily over the last quarter of the year.",
+}
+
+@pytest.fixture
+def engine(build):
+    for name, text in DOCS.items():
+        (build.docs / name).write_text(text, encoding="utf-8")
+    build()
+    import mini_rag_answer
+    return mini_rag_answer.RagEngine(str(build.docs), str(build.index_dir), embedder=HashEncoder())
+
+def test_quoted_phrase_needs_adjacent_words(engine):
+    result = engine.answer('"order total"', "none")
+    assert result["retriever"] == "lexical" and result["score_kind"] == "bm25"
+    assert [d["name"] for d in result["relevant_docs"]] == ["a.md"]
+    result = engine.answer('"total order"', "none")
+    assert [d["name"] for d in result["relevant_docs"]] == ["c.md"]
+
+def test_phrase_without_match_uses_dense_search(engine):
+    result = engine.answer('"total invoice order"', "none")
+    assert result["retriever"] != "lexical" and result["score_kind"] == "cosine"
+
+def test_citations_label_bm25_scores():
+    from mini_rag_answer import format_citations
+    contexts = [{"name": "a.md", "score": 1.0}]
+    assert format_citations(contexts) == "(a.md, 1.000)"
+    assert format_citations(contexts, "bm25") == "(a.md, bm25 1.000)"
+
+def test_rank_documents_with_unsorted_meta_json():
+    from chunk_store import JsonChunkStore
+    from mini_rag_answer import rank_documents
+    store = JsonChunkStore({"metadata": [{"id": cid, "source": name, "chunk_id": 0, "text": name}
+                                         for cid, name in [(5, "a.md"), (1, "b.md"), (9, "c.md")]]})
+    kept = rank_documents([1, 5, 9], [0.9, 0.8, 0.7], store)
+    assert [(d["name"], d["top_chunks"][0]["id"]) for d in kept] == [("b.md", 1), ("a.md", 5), ("c.md", 9)]
+
+def test_filtered_search_on_unsorted_meta_json(build):
+    for name, text in DOCS.items():
+        (build.docs / name).write_text(text, encoding="utf-8")
+    build()
+    import json
+    from chunk_store import open_chunk_store, store_files
+    import mini_rag_answer
+    from doc_filters import parse_filter
+    # A legacy meta.json whose chunks aren't in ID order (embeddings.npy stays in ID order).
+    store = open_chunk_store(str(build.index_dir))
+    metadata = [store[int(cid)] for cid in store.ids()[::-1]]
+    store.close()
+    for path in store_files(str(build.index_dir)):
+        os.remove(path)
+    (build.index_dir / "meta.json").write_text(json.dumps({"metadata": metadata}), encoding="utf-8")
+    engine = mini_rag_answer.RagEngine(str(build.docs), str(build.index_dir), embedder=HashEncoder())
+    assert list(engine.chunk_ids) == sorted(engine.chunk_ids)
+    result = engine.answer("invoice tax line items", "none", parse_filter("source:b.md"))
+    assert [d["name"] for d in result["relevant_docs"]] == ["b.md"]
+    result = engine.answer("total order volume quarter", "none", parse_filter("-source:b.md"))
+    assert result["relevant_docs"][0]["name"] == "c.md"
+
+def test_weak_single_term_match_still_abstains(build):
+    docs = {
+        "a.md": "Knead the dough, volcano aside, fold in butter and flour, rest it overnight, then bake the loaf until golden brown.",
+        "b.md": "Sourdough starter: feed sourdough daily.",
+        "c.md": "Crust colour needs steam.",
+        "d.md": "Baskets shape proofing dough.",
+    }
+    for name, text in docs.items():
+        (build.docs / name).write_text(text, encoding="utf-8")
+    build()
+    import mini_rag_answer
+    engine = mini_rag_answer.RagEngine(str(build.docs), str(build.index_dir), embedder=HashEncoder())
+    # "volcano" is rare but only mentioned in passing, so BM25 alone doesn't count as relevant and the cosine check abstains.
+    result = engine.answer("volcano", "none")
+    assert result["retriever"] != "lexical" and result["abstained"]
+    result = engine.answer("sourdough", "none")
+    assert result["retriever"] == "lexical" and [d["name"] for d in result["relevant_docs"]] == ["b.md"]
+
+def test_stale_lexicon_is_rejected(build):
+    for name, text in DOCS.items():
+        (build.docs / name).write_text(text, encoding="utf-8")
+    build()
+    from lexical_index import LEXICON_FILE
+    lexicon = (build.index_dir / LEXICON_FILE).read_text(encoding="utf-8")
+    (build.docs / "d.md").write_text("Shipping is free for every order above a minimum total.", encoding="utf-8")
+    build()
+    # An old lexicon next to the new store and postings, as an interrupted copy or rebuild could leave it.
+    (build.index_dir / LEXICON_FILE).write_text(lexicon, encoding="utf-8")
+    import mini_rag_answer
+    from lexical_index import LexicalIndex
+    engine = mini_rag_answer.RagEngine(str(build.docs), str(build.index_dir), embedder=HashEncoder())
+    with pytest.raises(ValueError):
+        LexicalIndex(str(build.index_dir), engine.chunk_ids)
+    assert engine.lexical is None
+    assert engine.answer("shipping minimum", "none")["retriever"] != "lexical"
+
+def test_engine_loads_once_and_serves_many_queries(engine, monkeypatch):
+    import mini_rag_answer
+    # Everything is loaded by the constructor. Answering must not open the model or the index files again.
+    def reload(*args, **kwargs):
+        raise AssertionError("loaded again while answering")
+    for name in ("load_faiss_index", "load_chunk_store", "load_chunk_embeddings", "load_query_encoder"):
+        monkeypatch.setattr(mini_rag_answer, name, reload)
+    for query in ("order total line items", "invoice tax", "quarter volume", '"order total"'):
+        result = engine.answer(query, "none")
+        assert "error" not in result and result["retrieval_cache"] == "miss"
+    assert engine.answer("invoice tax", "none")["retrieval_cache"] == "hit"
+
+def test_answer_many_shares_one_encode_call(engine, monkeypatch):
+    calls = []
+    encode = engine.embedder.encode
+    monkeypatch.setattr(engine.embedder, "encode", lambda texts, **kw: calls.append(list(texts)) or encode(texts, **kw))
+    queries = ["invoice tax", "", '"order total"', "quarter volume", "  INVOICE tax "]
+    results = engine.answer_many(queries, "none")
+    assert [r.get("query") for r in results] == ["invoice tax", None, '"order total"', "quarter volume", "INVOICE tax"]
+    assert results[1] == {"error": "No query provided."}
+    assert results[2]["retriever"] == "lexical"
+    # The phrase query skips the encoder, and the repeated query shares its retrieval with the first one.
+    assert calls == [["invoice tax", "quarter volume"]]
+    assert results[4]["relevant_docs"] == results[0]["relevant_docs"]
+    assert all(r["timing_stats"]["batch_size"] == 5 for r in results if "error" not in r)
+
+def test_run_batch_prints_one_result_per_line(engine, tmp_path, capsys):
+    import json
+    from mini_rag_answer import run_batch
+    path = tmp_path / "queries.jsonl"
+    path.write_text('{"id": "q1", "query": "invoice tax"}\n\n"quarter volume"\nplain order total\n', encoding="utf-8")
+    run_batch(engine, str(path), "none", batch_size=2)
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(r["id"], r["query"]) for r in lines] == [("q1", "invoice tax"), (3, "quarter volume"), (4, "plain order total")]
+
+def chunk(index, text, score):
+    return {"chunk": index, "text": text, "score": score}
+
+def test_neighbouring_chunks_are_merged_without_the_overlap():
+    from mini_rag_answer import merge_overlap
+    assert merge_overlap("one two three four five", "three four five six seven") == "one two three four five six seven"
+    # Less than min_overlap_words in common isn't taken for chunk overlap.
+    assert merge_overlap("one two three four five", "four five six") == "one two three four five four five six"
+    assert merge_overlap("a b c", "d e f") == "a b c d e f"
+
+def test_contexts_fit_the_token_budget():
+    from mini_rag_answer import approx_tokens, build_contexts
+    sentence = "Invoices are paid within thirty days of the invoice date. "
+    docs = [
+        {"name": "a.md", "score": 0.9, "top_chunks": [chunk(0, sentence * 4, 0.9), chunk(1, sentence * 4, 0.5), chunk(5, "Late fees apply after that. " * 6, 0.4)]},
+        {"name": "b.md", "score": 0.8, "top_chunks": [chunk(2, "Travel is refunded after the trip. " * 8, 0.8)]},
+        {"name": "c.md", "score": 0.7, "top_chunks": [chunk(0, "Invoices can also be paid by card. " + sentence, 0.7)]},
+        {"name": "d.md", "score": 0.6, "top_chunks": [chunk(0, "Past max_docs, never used.", 0.6)]},
+    ]
+    for budget in (60, 120, 400):
+        contexts = build_contexts(docs, max_docs=3, token_budget=budget)
+        assert sum(approx_tokens(c["snippet"]) for c in contexts) <= budget
+        assert [c["name"] for c in contexts][:1] == ["a.md"] and "d.md" not in [c["name"] for c in contexts]
+    # With room for everything, every document's best chunk is there and the duplicate chunk of a.md is left out.
+    contexts = build_contexts(docs, max_docs=3, token_budget=2000)
+    assert [c["name"] for c in contexts] == ["a.md", "b.md", "c.md"]
+    assert contexts[0]["snippet"] == (sentence * 4).strip() + " … " + ("Late fees apply after that. " * 6).strip()
+
+def test_system_prompt_is_the_same_for_every_query(engine, monkeypatch):
+    import ollama_client
+    from mini_rag_answer import prompt_header
+    from ollama_stub import start_stub_server
+    server = start_stub_server(answer="The invoice total includes tax.")
+    payloads, counts = [], []
+    prompt_eval = server.prompt_eval
+    def record(payload):
+        stats = prompt_eval(payload)
+        payloads.append(payload)
+        counts.append(stats["prompt_eval_count"])
+        return stats
+    monkeypatch.setattr(server, "prompt_eval", record)
+    monkeypatch.setattr(ollama_client, "_default_client", ollama_client.OllamaClient(server.url))
+    try:
+        for query in ("invoice total tax", "order line items shipping"):
+            assert "error" not in engine.answer(query, "detailed")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert [p["system"] for p in payloads] == [prompt_header("detailed")] * 2
+    assert "QUESTION: order line items shipping" in payloads[1]["prompt"] and "ONLY" not in payloads[1]["prompt"]
+    # The instructions are a prefix the server has already evaluated, so only the request's own prompt is counted again.
+    assert counts[1] <= len(payloads[1]["prompt"].split()) < counts[0]
@@ -0,0 +1,64 @@
+import pytest
+
+from rag_metrics import REGISTRY, STAGE_SECONDS, Registry, timed_stage
+
+def test_render_in_prometheus_text_format():
+    registry = Registry()
+    requests = registry.counter("test_requests_total", "Requests.", ["kind"])
+    requests.inc(kind="a")
+    requests.inc(2, kind='quo"te')
+    registry.counter("test_unlabelled_total", "Starts at zero.")
+    latency = registry.histogram("test_seconds", "Latency.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        latency.observe(value)
+    registry.add_collector(lambda: [("test_loaded", "gauge", "Loaded things.", [({"corpus": "s1"}, 2)])])
+    registry.add_collector(lambda: 1 / 0)
+    lines = registry.render().splitlines()
+    assert lines[:5] == ["# HELP test_requests_total Requests.", "# TYPE test_requests_total counter",
+                         'test_requests_total{kind="a"} 1', 'test_requests_total{kind="quo\\"te"} 2',
+                         "# HELP test_unlabelled_total Starts at zero."]
+    assert "test_unlabelled_total 0" in lines
+    # Buckets are cumulative and end with +Inf, which equals the count.
+    assert ['test_seconds_bucket{le="0.1"} 1', 'test_seconds_bucket{le="1"} 2', 'test_seconds_bucket{le="+Inf"} 3',
+            "test_seconds_sum 5.55", "test_seconds_count 3"] == [l for l in lines if l.startswith("test_seconds_")]
+    assert 'test_loaded{corpus="s1"} 2' in lines
+    # A failing collector is reported as a comment instead of breaking the scrape.
+    assert lines[-1].startswith("# collector error:")
+
+def test_same_name_returns_the_same_metric():
+    registry = Registry()
+    assert registry.counter("test_total", "x", ["a"]) is registry.counter("test_total", "x", ["a"])
+    with pytest.raises(ValueError):
+        registry.gauge("test_total", "x", ["a"])
+    with pytest.raises(ValueError):
+        registry.counter("test_total", "x").inc(b="1")
+
+def test_timed_stage_fills_the_timing_dict_and_the_histogram():
+    before = STAGE_SECONDS.render()
+    timing = {}
+    for _ in range(2):
+        with timed_stage(timing, "test", "step"):
+            pass
+    assert set(timing) == {"step_sec"} and timing["step_sec"] >= 0
+    assert 'rag_stage_seconds_count{component="test",stage="step"} 2' in STAGE_SECONDS.render()
+    assert len(STAGE_SECONDS.render()) > len(before)
+
+def test_answers_report_their_stage_timings(build):
+    from conftest import HashEncoder
+    (build.docs / "a.md").write_text("Each order lists its line items, and the invoice shows a total that includes tax.", encoding="utf-8")
+    build()
+    import mini_rag_answer
+    engine = mini_rag_answer.RagEngine(str(build.docs), str(build.index_dir), embedder=HashEncoder())
+    assert {"chunk_store_sec", "embed_model_sec", "faiss_index_sec", "lexical_index_sec"} <= set(engine.load_timing)
+    timing = engine.answer("invoice line items", "none")["timing_stats"]
+    assert {"encode_sec", "search_sec", "filter_sec", "total_sec"} <= set(timing)
+    assert 'rag_stage_seconds_count{component="rag",stage="encode"}' in REGISTRY.render()
+    # A cached retrieval only reports the time of this request.
+    assert "encode_sec" not in engine.answer("invoice line items", "none")["timing_stats"]
+
+def test_metrics_endpoint(web_app):
+    response = web_app.app.test_client().get("/metrics")
+    assert response.status_code == 200 and response.mimetype == "text/plain"
+    body = response.get_data(as_text=True)
+    for name in ("rag_http_requests_in_flight", "rag_stage_seconds", "rag_scheduler_running", "rag_index_loaded", "rag_jobs"):
+        assert f"# TYPE {name} " in body
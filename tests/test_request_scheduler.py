@@ -0,0 +1,53 @@
+import threading
+import time
+
+import pytest
+
+from request_scheduler import LLM, RETRIEVAL, Overloaded, RequestScheduler
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+def test_llm_slots_are_limited():
+    sched = RequestScheduler(workers=3, llm_slots=1, max_queue=4, max_wait_sec=0.1)
+    llm = sched.acquire(LLM)
+    # Retrieval still runs while the only LLM slot is taken, another LLM request waits and times out.
+    sched.release(sched.acquire(RETRIEVAL))
+    with pytest.raises(Overloaded) as ex:
+        sched.acquire(LLM)
+    assert ex.value.status == 503 and ex.value.retry_after >= 1
+    sched.release(llm)
+    assert sched.stats()["running"] == {RETRIEVAL: 0, LLM: 0}
+
+def test_full_queue_is_rejected():
+    sched = RequestScheduler(workers=1, llm_slots=1, max_queue=0, max_wait_sec=1.0)
+    ticket = sched.acquire(RETRIEVAL)
+    with pytest.raises(Overloaded) as ex:
+        sched.acquire(RETRIEVAL)
+    assert ex.value.status == 429
+    sched.release(ticket)
+    sched.release(ticket)  # idempotent
+    assert sched.stats()["completed"] == 1
+
+def test_retrieval_goes_before_waiting_llm_work():
+    sched = RequestScheduler(workers=1, llm_slots=1, max_queue=4, max_wait_sec=2.0)
+    busy = sched.acquire(RETRIEVAL)
+    order = []
+
+    def run(kind):
+        with sched.slot(kind):
+            order.append(kind)
+
+    llm = threading.Thread(target=run, args=(LLM,))
+    llm.start()
+    wait_for(lambda: sched.stats()["waiting"] == 1)
+    retrieval = threading.Thread(target=run, args=(RETRIEVAL,))
+    retrieval.start()
+    wait_for(lambda: sched.stats()["waiting"] == 2)
+    sched.release(busy)
+    llm.join()
+    retrieval.join()
+    assert order == [RETRIEVAL, LLM]
@@ -0,0 +1,77 @@
+import os
+import sqlite3
+
+import pytest
+
+pytest.importorskip("langchain_community")
+pytest.importorskip("sqlalchemy")
+
+from live_sql_agent import SqlAgentService
+
+class FakeExecutor:
+    def __init__(self):
+        self.calls = 0
+
+    def invoke(self, inputs, config=None):
+        self.calls += 1
+        return {"output": f"answer {self.calls}", "intermediate_steps": []}
+
+def make_db(db_path):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE orders (id INTEGER PRIMARY KEY, total REAL)")
+        conn.execute("INSERT INTO orders (total) VALUES (10.0)")
+    return db_path
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    svc = SqlAgentService(db_path=str(make_db(tmp_path / "analytics.db")))
+    executor = FakeExecutor()
+    monkeypatch.setattr(svc, "ensure_ready", lambda: executor)
+    svc.executor = executor
+    return svc
+
+def test_answers_are_cached_until_the_data_changes(service):
+    first = service.ask("How many orders?")
+    assert first["cache"] == "miss" and first["answer"] == "answer 1"
+    second = service.ask("  how many ORDERS? ")
+    assert second["cache"] == "hit" and second["answer"] == "answer 1"
+    assert service.executor.calls == 1
+
+    with sqlite3.connect(service.db_path) as conn:
+        conn.execute("INSERT INTO orders (total) VALUES (5.0)")
+    third = service.ask("How many orders?")
+    assert third["cache"] == "miss" and service.executor.calls == 2
+
+def test_error_result_has_the_usual_shape(tmp_path):
+    result = SqlAgentService(db_path=str(tmp_path / "missing.db")).ask("How many orders?")
+    assert result["answer"].startswith("An error occurred")
+    assert result["sql"] == [] and result["cache"] == "miss"
+    assert "total_sec" in result["timing_stats"]
+
+def test_agent_is_built_once_and_refreshed_when_the_schema_changes(tmp_path, monkeypatch):
+    import live_sql_agent
+    built = []
+    monkeypatch.setattr(live_sql_agent, "ChatOllama", lambda **kwargs: object())
+    monkeypatch.setattr(live_sql_agent, "create_sql_agent", lambda llm, db, **kwargs: built.append(db) or FakeExecutor())
+    db_path = make_db(tmp_path / "analytics.db")
+    svc = SqlAgentService(db_path=str(db_path))
+    first = svc.ensure_ready()
+    engine = svc.engine
+    assert svc.ensure_ready() is first and svc.schema_refreshes == 1
+
+    # A schema change rebuilds the agent on the same pooled engine.
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE customers (id INTEGER PRIMARY KEY)")
+    assert svc.ensure_ready() is not first and svc.schema_refreshes == 2 and svc.engine is engine
+    assert "customers" in built[-1].get_usable_table_names()
+
+    # A replaced database file gets a new engine, the pooled connections point at the old file.
+    os.replace(make_db(tmp_path / "replacement.db"), db_path)
+    svc.ensure_ready()
+    assert svc.engine is not engine and svc.schema_refreshes == 3
+    assert "customers" not in built[-1].get_usable_table_names()
+
+def test_one_service_per_process(monkeypatch):
+    import live_sql_agent
+    monkeypatch.setattr(live_sql_agent, "_service", None)
+    assert live_sql_agent.get_sql_agent() is live_sql_agent.get_sql_agent()
@@ -0,0 +1,114 @@
+import json
+
+import pytest
+
+from conftest import HashEncoder
+
+DOCS = {
+    "a.md": "The order total is the sum of all line items in the shopping cart before shipping.",
+    "b.md": "Each order lists its line items, and the invoice shows a total that includes tax.",
+    "c.md": "The total order volume grew steadily over the last quarter of the year.",
+}
+
+@pytest.fixture
+def app(build, web_app, monkeypatch):
+    """web/app.py serving one freshly built corpus ("s1") from its own registry and scheduler."""
+    from index_registry import Corpus, IndexRegistry
+    from request_scheduler import RequestScheduler
+    for name, text in DOCS.items():
+        (build.docs / name).write_text(text, encoding="utf-8")
+    build()
+    corpora = {"s1": Corpus("s1", "Test corpus", str(build.docs), str(build.index_dir))}
+    monkeypatch.setattr(web_app, "registry", IndexRegistry(corpora, embedder_factory=lambda name: HashEncoder()))
+    monkeypatch.setattr(web_app, "scheduler", RequestScheduler())
+    monkeypatch.setitem(web_app.SHOWCASE_CORPUS, "1", "s1")
+    return web_app
+
+@pytest.fixture
+def ollama(monkeypatch):
+    """The stub Ollama server (ollama_stub.py), used by the engines' shared client."""
+    import ollama_client
+    from ollama_stub import start_stub_server
+    server = start_stub_server(answer="The order total adds up all line items.")
+    monkeypatch.setattr(ollama_client, "_default_client", ollama_client.OllamaClient(server.url))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def read_events(response):
+    # (event name, data) of every Server-Sent Event in a finished streaming response.
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if "data" in lines:
+            events.append((lines.get("event", "message"), json.loads(lines["data"])))
+    response.close()
+    return events
+
+def test_queries_share_one_engine(app):
+    first = app.run_query_json('"order total"', "none", corpus="s1")
+    second = app.run_query_json("invoice tax", "none", corpus="s1")
+    assert "error" not in first and "error" not in second
+    assert [d["name"] for d in first["relevant_docs"]] == ["a.md"]
+    stats = app.registry.stats()
+    assert stats["loads"] == 1 and stats["hits"] == 1 and stats["loaded"] == ["s1"]
+
+def test_missing_index_is_an_error_result(app, tmp_path, monkeypatch):
+    from index_registry import Corpus
+    monkeypatch.setitem(app.registry.corpora, "empty", Corpus("empty", "No index", str(tmp_path / "nodocs"), str(tmp_path / "noindex")))
+    result = app.run_query_json("anything", "none", corpus="empty")
+    assert result["error"].startswith("Failed to execute backend")
+    assert app.registry.stats()["load_failures"] == 1
+
+def test_stream_sends_sources_tokens_citations_and_done(app, ollama):
+    response = app.app.test_client().post("/generate_stream", data={"query": '"order total"', "mode": "detailed", "showcase_id": "1"})
+    assert response.status_code == 200 and response.mimetype == "text/event-stream"
+    events = read_events(response)
+    names = [name for name, _ in events]
+    # One token event per word the stub sends, between the sources and the closing citations and result.
+    assert names == ["sources"] + ["token"] * len(ollama.answer.split()) + ["citations", "done"]
+    assert [s["name"] for s in events[0][1]["sources"]] == ["a.md"] and not events[0][1]["abstained"]
+    assert "".join(data["text"] for name, data in events if name == "token") == ollama.answer
+    result = events[-1][1]["result"]
+    assert result["llm_answer"] == f"{ollama.answer}\n\n{events[-2][1]['text']}"
+    assert "time_to_first_token_sec" in result["timing_stats"]
+    # The scheduler slot is given back once the stream is closed.
+    assert app.scheduler.stats()["running"] == {"retrieval": 0, "llm": 0}
+
+def test_stream_of_an_abstained_query_skips_the_llm(app, ollama):
+    response = app.app.test_client().post("/generate_stream", data={"query": "volcano eruptions", "mode": "detailed", "showcase_id": "1"})
+    events = read_events(response)
+    assert [name for name, _ in events] == ["sources", "done"]
+    assert events[0][1]["abstained"] and events[-1][1]["result"]["abstained"]
+    assert ollama.request_count == 0
+
+def test_batch_endpoint(app, monkeypatch):
+    client = app.app.test_client()
+    response = client.post("/api/batch", json={"queries": ['"order total"', "invoice tax", ""], "mode": "none"})
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [r.get("query") for r in results] == ['"order total"', "invoice tax", None]
+    assert [d["name"] for d in results[0]["relevant_docs"]] == ["a.md"]
+
+    assert client.post("/api/batch", json={"queries": "invoice tax"}).status_code == 400
+    assert client.post("/api/batch", json={"queries": ["a", "b"], "corpus": "nope"}).status_code == 400
+    monkeypatch.setattr(app, "BATCH_MAX_QUERIES", 1)
+    assert client.post("/api/batch", json={"queries": ["a", "b"]}).status_code == 400
+
+@pytest.mark.parametrize("max_queue, status", [(0, 429), (4, 503)])
+def test_overloaded_requests_get_retry_after(app, monkeypatch, max_queue, status):
+    from request_scheduler import RETRIEVAL, RequestScheduler
+    scheduler = RequestScheduler(workers=1, llm_slots=1, max_queue=max_queue, max_wait_sec=0.05)
+    monkeypatch.setattr(app, "scheduler", scheduler)
+    client = app.app.test_client()
+    # A full queue is turned away at once (429), a request that waited too long for a slot gets 503.
+    busy = scheduler.acquire(RETRIEVAL)
+    for response in (client.post("/generate_stream", data={"query": "invoice tax", "mode": "detailed", "showcase_id": "1"}),
+                     client.post("/api/batch", json={"queries": ["invoice tax"]})):
+        assert response.status_code == status
+        assert int(response.headers["Retry-After"]) == response.get_json()["retry_after"] >= 1
+    page = client.post("/", data={"showcase_id": "1", "query": "invoice tax"})
+    assert page.status_code == status and int(page.headers["Retry-After"]) >= 1
+    scheduler.release(busy)
+    assert client.post("/api/batch", json={"queries": ["invoice tax"]}).status_code == 200
+    assert scheduler.stats()["running"] == {"retrieval": 0, "llm": 0}
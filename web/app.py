@@ -3,67 +3,182 @@
 import os
 import sys
 import json
-import subprocess
-from typing import Dict, Any, Optional
-from flask import Flask, render_template, request, jsonify
 import time
+from typing import Dict, Any, Optional
+from flask import Flask, Response, g, render_template, request, jsonify, stream_with_context, url_for
 
 # Initializing Flask app here, telling it where to find the templates and static files.
 app = Flask(__name__, template_folder="templates", static_folder="static")
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-SCRIPT_PATH = os.path.join(ROOT_DIR, "mini_rag_answer.py")
+sys.path.append(ROOT_DIR)
+
+from mini_rag_answer import RagEngine
+from doc_filters import parse_filter
+from index_registry import DEFAULT_CORPUS, IndexRegistry
+from answer_cache import get_answer_cache
+from generation_jobs import FINISHED, JobManager
+from rag_cache import normalize_query
+from request_scheduler import LLM, RETRIEVAL, Overloaded, RequestScheduler
+from rag_metrics import REGISTRY
 
-# Configure directories for each showcase
-SHOWCASE_DOCS_DIR = {
-    "1": "docs",
+# The SQL agent (Showcase 2) is imported once here instead of inside the route. Without LangChain installed, Showcase 1 still works.
+try:
+    from live_sql_agent import get_sql_agent
+except ImportError as e:
+    print(f"WARNING: SQL agent unavailable ({e}). Install the requirements to enable Showcase 2.")
+    get_sql_agent = None
+
+# The corpus each showcase searches when the request doesn't pick one. All corpora are configured in corpora.json (see index_registry.py).
+SHOWCASE_CORPUS = {
+    "1": DEFAULT_CORPUS,
     }
 
-def run_query_json(query: str, mode: str, docs_dir: Optional[str] = None) -> Dict[str, Any]:
+# Upper bound on queries per /api/batch request.
+BATCH_MAX_QUERIES = int(os.environ.get("RAG_BATCH_MAX_QUERIES", "256"))
+
+# How long a /generate job keeps retrying when the scheduler turns it away, before it fails with the scheduler's reason.
+JOB_ADMIT_TIMEOUT_SEC = float(os.environ.get("RAG_JOB_ADMIT_TIMEOUT_SEC", "300"))
+
+# Every RAG and SQL agent request goes through this scheduler, which bounds concurrency and sheds load with 429/503.
+scheduler = RequestScheduler()
+REGISTRY.add_collector(scheduler.collect)
+
+HTTP_SECONDS = REGISTRY.histogram("rag_http_request_seconds", "Time to produce a response (streams: until the first byte).", ["endpoint", "status"])
+HTTP_IN_FLIGHT = REGISTRY.gauge("rag_http_requests_in_flight", "Requests currently being handled.")
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    HTTP_IN_FLIGHT.inc()
+
+@app.after_request
+def observe_request(response):
+    if "request_started" in g:
+        HTTP_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=request.endpoint or "unknown", status=str(response.status_code))
+    return response
+
+@app.teardown_request
+def finish_request(exc=None):
+    if g.pop("request_started", None) is not None:
+        HTTP_IN_FLIGHT.dec()
+
+# One RagEngine per corpus, shared by all requests. Engines are loaded on first use and unloaded LRU under RAG_INDEX_MEMORY_BUDGET_MB.
+registry = IndexRegistry()
+REGISTRY.add_collector(registry.collect)
+
+def get_engine(corpus: Optional[str] = None) -> RagEngine:
     """
-    This is a helper function to run 'mini_rag_answer.py' script.
-    It runs the script as a separate process and captures its JSON output.
-    This is how the web app "talks" to the RAG agent for Showcase 1.
+    Returns the long-lived RagEngine for a corpus (the default one if not given), loading it on first use.
+    The embedding model is shared by all corpora, the FAISS index and metadata stay in memory until the registry evicts them.
     """
-    env = os.environ.copy()
-    env["RAG_JSON"] = "1"
-    env["RAG_QUIET"] = "1"
-    env["RAG_OUTPUT_MODE"] = mode
+    return registry.get(corpus)
 
-    llm_model = os.environ.get("RAG_LLM_MODEL", "llama3.2")
-    env["RAG_LLM_MODEL"] = llm_model
-    env["RAG_SYNTH_MODEL"] = os.environ.get("RAG_SYNTH_MODEL", llm_model)
+def corpus_for_request(showcase_id: str, requested: Optional[str]) -> str:
+    # A request may name any configured corpus, otherwise the showcase's own corpus is used.
+    name = (requested or "").strip() or SHOWCASE_CORPUS.get(showcase_id, DEFAULT_CORPUS)
+    registry.corpus(name)
+    return name
 
-    if docs_dir:
-        env["RAG_DOCS_DIR"] = docs_dir
-        print(f"Setting RAG_DOCS_DIR to {docs_dir}")
+def collect_engine_metrics():
+    # Retrieval cache counters and load times of every loaded engine, plus the SQL agent's answer cache, read at scrape time.
+    engines = registry.loaded()
+    caches = {corpus: engine.retrieval_cache.stats() for corpus, engine in engines.items()}
+    if get_answer_cache() is not None:
+        caches["rag_answers"] = get_answer_cache().stats()
+    if get_sql_agent is not None:
+        caches["sql_agent"] = get_sql_agent().answer_cache.stats()
+    return [
+        ("rag_cache_entries", "gauge", "Entries held by each cache.", [({"cache": name}, st["size"]) for name, st in caches.items()]),
+        ("rag_cache_evictions_total", "counter", "Cache entries evicted by the size limit.", [({"cache": name}, st["evictions"]) for name, st in caches.items()]),
+        ("rag_cache_expirations_total", "counter", "Cache entries dropped after their TTL.", [({"cache": name}, st["expirations"]) for name, st in caches.items()]),
+        ("rag_engine_load_seconds", "gauge", "How long each part of loading an engine took.",
+         [({"corpus": corpus, "part": part[:-4]}, sec) for corpus, engine in engines.items() for part, sec in engine.load_timing.items()]),
+    ]
 
-    cmd = [sys.executable, SCRIPT_PATH, query]
-    try:
-        print(f"Executing: {' '.join(cmd)} with RAG_DOCS_DIR={docs_dir}")
-        proc = subprocess.run(cmd, cwd=ROOT_DIR, env=env, capture_output=True, text=True, timeout=180)
-        stdout = proc.stdout.strip()
-        
-        if not stdout and proc.stderr:
-            print(f"Error output from RAG script: {proc.stderr}")
-            return {"error": proc.stderr}
-            
-        if not stdout:
-            return {"error": "Empty response from backend."}
-            
+REGISTRY.add_collector(collect_engine_metrics)
+
+def warm_engines():
+    """
+    Loads the showcase corpora (and the SQL agent) up front, so the first request doesn't pay for model loading.
+    Other corpora stay unloaded until someone asks for them.
+    """
+    for corpus in set(SHOWCASE_CORPUS.values()):
         try:
-            return json.loads(stdout)
-        except json.JSONDecodeError as je:
-            print(f"JSON decode error: {je}")
-            print(f"Raw output: {stdout[:200]}...")
-            return {"error": f"Invalid JSON response: {je}"}
-            
-    except subprocess.TimeoutExpired:
-        return {"error": "The request timed out. The local LLM may be busy or slow."}
+            get_engine(corpus)
+        except Exception as e:
+            print(f"WARNING: Could not load RAG engine for corpus '{corpus}': {e}")
+    if get_sql_agent is not None:
+        try:
+            get_sql_agent().ensure_ready()
+        except Exception as e:
+            print(f"WARNING: Could not initialize the SQL agent: {e}")
+
+def run_query_json(query: str, mode: str, corpus: Optional[str] = None, doc_filter: Optional[str] = None) -> Dict[str, Any]:
+    """
+    This is a helper function to run the RAG agent for Showcase 1.
+    It answers the query in-process with the corpus's shared RagEngine and returns the same JSON result
+    that 'mini_rag_answer.py' prints on the command line. doc_filter is a filter expression (see doc_filters.py).
+    """
+    try:
+        engine = get_engine(corpus)
+        print(f"Answering '{query}' in-process with mode={mode}, corpus={corpus or DEFAULT_CORPUS}" + (f", filter={doc_filter}" if doc_filter else ""))
+        return engine.answer(query, mode, parse_filter(doc_filter))
+    except ValueError as e:
+        # A filter that can't be parsed, or one this index can't answer.
+        return {"error": str(e)}
     except Exception as e:
-        print(f"Exception running RAG script: {str(e)}")
+        print(f"Exception running RAG engine: {str(e)}")
         return {"error": f"Failed to execute backend: {e}"}
 
+def request_kind(mode: str) -> str:
+    # Retrieval-only requests never reach the LLM, so they are scheduled as the cheap, high-priority kind.
+    return RETRIEVAL if (mode or "none").lower() == "none" else LLM
+
+def run_generation_job(params: Dict[str, Any]) -> Dict[str, Any]:
+    # Runs one /generate job. A job the scheduler turns away retries after Retry-After, for up to JOB_ADMIT_TIMEOUT_SEC.
+    deadline = time.monotonic() + JOB_ADMIT_TIMEOUT_SEC
+    while True:
+        try:
+            with scheduler.slot(request_kind(params["mode"])):
+                return run_query_json(query=params["query"], mode=params["mode"], corpus=params["corpus"], doc_filter=params.get("filter"))
+        except Overloaded as ex:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return {"error": f"Server busy, the job wasn't admitted within {JOB_ADMIT_TIMEOUT_SEC:g}s ({ex.reason})."}
+            time.sleep(min(ex.retry_after, remaining))
+
+# /generate jobs, run in the background and kept across restarts (see generation_jobs.py).
+jobs = JobManager(run_generation_job)
+REGISTRY.add_collector(jobs.collect)
+
+def job_response(job: Dict[str, Any], coalesced: Optional[bool] = None):
+    # A finished job answers with its result, like /generate used to; otherwise 202 with where to poll.
+    if job["status"] in FINISHED and job["result"] is not None:
+        result = dict(job["result"])
+        result["job_id"] = job["job_id"]
+        return jsonify(result)
+    body = {"job_id": job["job_id"], "status": job["status"], "poll": url_for("job_status", job_id=job["job_id"])}
+    if job["error"]:
+        body["error"] = job["error"]
+        return jsonify(body), 500
+    if coalesced is not None:
+        body["coalesced"] = coalesced
+    return jsonify(body), 202
+
+def request_wait_sec() -> float:
+    try:
+        return max(0.0, float(request.values.get("wait") or 0))
+    except ValueError:
+        return 0.0
+
+def overloaded_response(ex: Overloaded):
+    print(f"Rejected request with {ex.status}: {ex.reason}")
+    response = jsonify({"error": ex.reason, "retry_after": ex.retry_after})
+    response.status_code = ex.status
+    response.headers["Retry-After"] = str(ex.retry_after)
+    return response
+
 EXAMPLE_QUERIES_S1 = [
     "What main items included in week2 shopping list?",
     "What is blockchain and how does its consensus mechanism work?",
@@ -84,12 +199,12 @@ EXAMPLE_QUERIES_S2 = [
 # This is the main route for running the application. It handles the initial page load and the form submissions for both showcases.
 @app.route("/", methods=["GET", "POST"])
 def index():
-    sys.path.append(ROOT_DIR)
-    from live_sql_agent import query_live_database
-    
     result: Dict[str, Any] = {}
     query = ""
+    overloaded: Optional[Overloaded] = None
     showcase_id = str(request.form.get("showcase_id") or request.args.get("showcase_id") or "1")
+    corpus = request.form.get("corpus") or request.args.get("corpus") or SHOWCASE_CORPUS["1"]
+    doc_filter = (request.form.get("filter") or request.args.get("filter") or "").strip()
     
     print(f"Request for showcase {showcase_id}")
 
@@ -99,16 +214,35 @@ def index():
             # --- Main routing logic ---
             if showcase_id == "1":
                 # Showcase 1 works the same as before (document retrieval)
-                print(f"Processing S1 query '{query}' using mini_rag_answer.py")
-                docs_dir = SHOWCASE_DOCS_DIR.get("1")
-                result = run_query_json(query=query, mode="none", docs_dir=docs_dir)
+                print(f"Processing S1 query '{query}' using the in-process RAG engine")
+                try:
+                    corpus = corpus_for_request("1", corpus)
+                    parse_filter(doc_filter)
+                    with scheduler.slot(RETRIEVAL):
+                        result = run_query_json(query=query, mode="none", corpus=corpus, doc_filter=doc_filter)
+                    if result.get("error"):
+                        result = {"query": query, "abstained": True, "relevant_docs": [], "abstain_message": result["error"]}
+                except (KeyError, ValueError) as ex:
+                    result = {"query": query, "abstained": True, "relevant_docs": [], "abstain_message": ex.args[0]}
+                except Overloaded as ex:
+                    overloaded = ex
+                    result = {"query": query, "abstained": True, "relevant_docs": [],
+                              "abstain_message": f"{ex.reason} (about {ex.retry_after}s)"}
                 if result.get("abstained", False) or not result.get("relevant_docs"):
                     result["llm_answer"] = None
             
             elif showcase_id == "2":
                 # If it's Showcase 2 it directly calls the python function from the LIVE SQL AGENT.
                 print(f"Processing S2 query '{query}' using live_sql_agent.py")
-                sql_result = query_live_database(query)
+                if get_sql_agent is None:
+                    sql_result = {"answer": "The SQL agent is not available on this server."}
+                else:
+                    try:
+                        with scheduler.slot(LLM):
+                            sql_result = get_sql_agent().ask(query)
+                    except Overloaded as ex:
+                        overloaded = ex
+                        sql_result = {"answer": f"{ex.reason} (about {ex.retry_after}s)"}
                 # We build a 'result' dictionary that looks like what the template expects
                 result = {
                     "query": query,
@@ -117,14 +251,20 @@ def index():
                     "is_direct_answer": True 
                 }
 
-    return render_template(
+    page = render_template(
         "index.html",
         query=query,
         examples_s1=EXAMPLE_QUERIES_S1,
         examples_s2=EXAMPLE_QUERIES_S2,
         result=result,
         showcase_id=showcase_id,
+        corpora=list(registry.corpora.values()),
+        corpus=corpus,
+        doc_filter=doc_filter,
     )
+    if overloaded is not None:
+        return page, overloaded.status, {"Retry-After": str(overloaded.retry_after)}
+    return page
 
 @app.route("/generate", methods=["POST"])
 def generate():
@@ -132,13 +272,21 @@ def generate():
     query = request.form.get("query", "").strip()
     mode = request.form.get("mode", "detailed")
     showcase_id = str(request.form.get("showcase_id") or "1")
+    doc_filter = request.form.get("filter", "").strip()
     
     print(f"Generate request - Query: '{query}', Mode: {mode}, Showcase: {showcase_id}")
 
     if not query:
         return jsonify({"error": "No query provided for generation."})
 
-    docs_dir = SHOWCASE_DOCS_DIR.get(showcase_id, "docs")
+    try:
+        corpus = corpus_for_request(showcase_id, request.form.get("corpus"))
+        parsed_filter = parse_filter(doc_filter)
+    except KeyError as ex:
+        return jsonify({"error": ex.args[0]}), 400
+    except ValueError as ex:
+        return jsonify({"error": str(ex)}), 400
+    docs_dir = os.path.join(ROOT_DIR, registry.corpus(corpus).docs_dir)
     
     # Ensure directory exists
     if not os.path.exists(docs_dir):
@@ -149,23 +297,134 @@ def generate():
     files = os.listdir(docs_dir)
     print(f"Directory {docs_dir} contains {len(files)} files")
     
-    print(f"Running query with mode={mode}, docs_dir={docs_dir}")
-    result = run_query_json(query=query, mode=mode, docs_dir=docs_dir)
-    
-    # Log the result for debugging
-    if "error" in result:
-        print(f"Error returned: {result['error']}")
-    elif "llm_answer" in result:
-        answer_preview = result.get("llm_answer", "")[:50].replace("\n", " ")
-        print(f"Answer preview: {answer_preview}...")
-    else:
-        print(f"No answer or error in result. Keys: {list(result.keys())}")
-    
-    return jsonify(result)
+    # Returns the job's ID at once (202), or its result if it finishes within "wait" seconds. Identical queries join a running job.
+    try:
+        index_version = get_engine(corpus).index_version
+    except Exception as e:
+        print(f"Exception loading RAG engine: {str(e)}")
+        return jsonify({"error": f"Failed to execute backend: {e}"})
+    filter_key = parsed_filter.key if parsed_filter is not None else ""
+    key = json.dumps([corpus, index_version, mode, normalize_query(query), filter_key])
+    job, coalesced = jobs.submit(key, {"query": query, "mode": mode, "corpus": corpus, "filter": filter_key})
+    print(f"Generation job {job['job_id']} for mode={mode}, corpus={corpus}" + (" (joined a running job)" if coalesced else ""))
+    wait = request_wait_sec()
+    if wait > 0:
+        job = jobs.wait(job["job_id"], wait)
+    return job_response(job, coalesced)
+
+# Polls a /generate job. "?wait=<sec>" waits for it to finish first (up to RAG_JOB_MAX_WAIT_SEC).
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id: str):
+    wait = request_wait_sec()
+    job = jobs.wait(job_id, wait) if wait > 0 else jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job '{job_id}'."}), 404
+    return job_response(job)
+
+# Streaming version of /generate: relays the answer to the browser as Server-Sent Events while Ollama produces it.
+@app.route("/generate_stream", methods=["POST"])
+def generate_stream():
+    query = request.form.get("query", "").strip()
+    mode = request.form.get("mode", "detailed")
+    showcase_id = str(request.form.get("showcase_id") or "1")
+    doc_filter = request.form.get("filter", "").strip()
+
+    print(f"Streaming generate request - Query: '{query}', Mode: {mode}, Showcase: {showcase_id}")
+
+    if not query:
+        return jsonify({"error": "No query provided for generation."})
+
+    try:
+        parsed_filter = parse_filter(doc_filter)
+        engine = get_engine(corpus_for_request(showcase_id, request.form.get("corpus")))
+    except KeyError as ex:
+        return jsonify({"error": ex.args[0]}), 400
+    except ValueError as ex:
+        return jsonify({"error": str(ex)}), 400
+    except Exception as e:
+        print(f"Exception loading RAG engine: {str(e)}")
+        return jsonify({"error": f"Failed to execute backend: {e}"})
+
+    # The slot is held for the whole stream and given back when the response is closed, even if the client goes away early.
+    try:
+        ticket = scheduler.acquire(request_kind(mode))
+    except Overloaded as ex:
+        return overloaded_response(ex)
+
+    def events():
+        try:
+            for ev in engine.stream_answer(query, mode, parsed_filter):
+                yield f"event: {ev['event']}\ndata: {json.dumps(ev, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            print(f"Exception while streaming answer: {str(e)}")
+            yield f"event: error\ndata: {json.dumps({'event': 'error', 'error': str(e)})}\n\n"
+
+    response = Response(stream_with_context(events()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(lambda: scheduler.release(ticket))
+    return response
+
+# Answers many Showcase 1 queries in one request. Body: {"queries": [...], "mode", "showcase_id", and optional "corpus" and "filter"}.
+@app.route("/api/batch", methods=["POST"])
+def api_batch():
+    payload = request.get_json(silent=True) or {}
+    queries = payload.get("queries")
+    mode = str(payload.get("mode") or "none")
+    showcase_id = str(payload.get("showcase_id") or "1")
+
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) for q in queries):
+        return jsonify({"error": "Expected a non-empty list of query strings in 'queries'."}), 400
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify({"error": f"At most {BATCH_MAX_QUERIES} queries per batch."}), 400
+
+    try:
+        corpus = corpus_for_request(showcase_id, payload.get("corpus"))
+        doc_filter = parse_filter(str(payload.get("filter") or ""))
+    except KeyError as ex:
+        return jsonify({"error": ex.args[0]}), 400
+    except ValueError as ex:
+        return jsonify({"error": str(ex)}), 400
+    print(f"Batch request - {len(queries)} queries, Mode: {mode}, Showcase: {showcase_id}, Corpus: {corpus}")
+    try:
+        with scheduler.slot(request_kind(mode)):
+            results = get_engine(corpus).answer_many(queries, mode, doc_filter)
+    except Overloaded as ex:
+        return overloaded_response(ex)
+    except ValueError as ex:
+        return jsonify({"error": str(ex)}), 400
+    except Exception as e:
+        print(f"Exception running RAG engine: {str(e)}")
+        return jsonify({"error": f"Failed to execute backend: {e}"}), 500
+    return jsonify({"results": results})
+
+# Exposes the cache counters of every loaded engine and the SQL agent, plus the loaded corpora and their memory use.
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    stats: Dict[str, Any] = {corpus: {"index_version": engine.index_version, "retrieval_cache": engine.retrieval_cache.stats()}
+                             for corpus, engine in registry.loaded().items()}
+    stats["index_registry"] = registry.stats()
+    if get_answer_cache() is not None:
+        stats["answer_cache"] = get_answer_cache().stats()
+    if get_sql_agent is not None:
+        stats["sql_agent"] = get_sql_agent().stats()
+    return jsonify(stats)
+
+# Prometheus scrape endpoint: stage latency histograms, counters (cache hits, numpy fallbacks, abstentions, Ollama retries) and in-flight gauges.
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+# Scheduler counters: running and waiting requests, rejections and the service times behind Retry-After.
+@app.route("/scheduler_stats", methods=["GET"])
+def scheduler_stats():
+    stats = scheduler.stats()
+    stats["jobs"] = jobs.stats()
+    return jsonify(stats)
 
 if __name__ == "__main__":
     # Ensure docs directories exist before starting
-    for dir_key, dir_path in SHOWCASE_DOCS_DIR.items():
+    for corpus in set(SHOWCASE_CORPUS.values()):
+        dir_path = os.path.join(ROOT_DIR, registry.corpus(corpus).docs_dir)
         if not os.path.exists(dir_path):
             print(f"WARNING: Creating missing directory: {dir_path}")
             os.makedirs(dir_path, exist_ok=True)
@@ -173,5 +432,11 @@ if __name__ == "__main__":
             files = os.listdir(dir_path)
             print(f"Directory {dir_path} contains {len(files)} files")
             
+    # The debug reloader runs this block in a parent and a child process, only the serving child should load the models.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        # Picks up the /generate jobs the previous run didn't finish.
+        jobs.start()
+        warm_engines()
+
     print("Starting Flask app...")
     app.run(host="127.0.0.1", port=5000, debug=True)
\ No newline at end of file